@@ -16,6 +16,9 @@ import mari
 import mari.utils
 import sgtk
 import os
+import tempfile
+import threading
+import time
 
 # Mari versions compatibility constants
 VERSION_OLDEST_COMPATIBLE = (5, 0, 0)
@@ -203,16 +206,52 @@ Please report any issues to:
                     icon=sgtk.platform.qt.QtGui.QMessageBox.Warning,
                 )
 
-        # cache handles to the various manager instances:
         tk_mari = self.import_module("tk_mari")
-        self.__geometry_mgr = tk_mari.GeometryManager()
-        self.__project_mgr = tk_mari.ProjectManager()
-        self.__metadata_mgr = tk_mari.MetadataManager()
+
+        # enable timing instrumentation if required:
+        self.__profiler = tk_mari.get_profiler()
+        if self.get_setting("enable_timing") or os.environ.get("TK_MARI_TIMING"):
+            self.__profiler.enabled = True
+
+        # configure the process-wide publish record cache:
+        tk_mari.get_publish_record_cache().configure(
+            ttl=self.get_setting("publish_cache_ttl"),
+            max_size=self.get_setting("publish_cache_max_size"),
+        )
+
+        # cache handles to the various manager instances:
+        self.__metadata_mgr = tk_mari.MetadataManager(
+            self.get_setting("metadata_encoding")
+        )
+        geometry_cache = None
+        geometry_cache_root = self.get_setting("local_geometry_cache_root")
+        if geometry_cache_root:
+            geometry_cache = tk_mari.GeometryFileCache(
+                os.path.expanduser(os.path.expandvars(geometry_cache_root)),
+                self.get_setting("local_geometry_cache_max_size") * 1024 * 1024,
+            )
+        self.__geometry_mgr = tk_mari.GeometryManager(
+            self.__metadata_mgr, geometry_cache
+        )
+        self.__project_mgr = tk_mari.ProjectManager(
+            self.__geometry_mgr, self.__metadata_mgr
+        )
+        self.__texture_mgr = tk_mari.TextureManager(self.__metadata_mgr)
+        self.__context_cache = tk_mari.ContextCache(
+            self.sgtk, self.cache_location, self.get_setting("context_cache_ttl")
+        )
 
     def post_app_init(self):
         """
         Do any initialization after apps have been loaded
         """
+        if self.__profiler.enabled:
+            self.register_command(
+                "Write Timing Report...",
+                self.__write_timing_report,
+                {"type": "context_menu", "short_name": "write_timing_report"},
+            )
+
         if self.has_ui:
             # create the Shotgun menu
             tk_mari = self.import_module("tk_mari")
@@ -231,11 +270,64 @@ Please report any issues to:
             self.log_debug(
                 "Updating the Work Area on the current project to '%s'" % self.context
             )
-            self.__metadata_mgr.set_project_metadata(current_project, self.context)
+            with self.__profiler.span("set_project_metadata", "mari"):
+                self.__metadata_mgr.set_project_metadata(current_project, self.context)
+
+        # build the geometry index for the current project and keep it up to date
+        # as geometry is added and removed:
+        geo_index = self.__geometry_mgr.index
+        geo_index.connect()
+        if current_project:
+            geo_index.rebuild()
+            self.prefetch_publish_records()
 
         # connect to Mari project events:
         mari.utils.connect(mari.projects.opened, self.__on_project_opened)
 
+    @property
+    def context_change_allowed(self):
+        """
+        Whether the engine allows a context change without the need for a restart.
+        """
+        return True
+
+    def pre_context_change(self, old_context, new_context):
+        """
+        Called before the context of the engine is changed.
+
+        :param old_context: The context being changed away from
+        :param new_context: The context being changed to
+        """
+        self.log_debug("%s: Changing context to %s..." % (self, new_context))
+
+    def post_context_change(self, old_context, new_context):
+        """
+        Called after the context of the engine has been changed.  Only the state that
+        depends on the context is refreshed - the managers and geometry index are kept.
+
+        :param old_context: The context that was changed away from
+        :param new_context: The context that was changed to
+        """
+        tk_mari = self.import_module("tk_mari")
+
+        # cached publish records may not be valid for the new context:
+        tk_mari.get_publish_record_cache().invalidate()
+
+        if self.has_ui:
+            # rebuild the menu for the new work area and the commands registered
+            # by any apps that were restarted:
+            self._menu_generator.destroy_menu()
+            self._menu_generator.create_menu()
+
+        # and update the current Mari project with the new context:
+        current_project = mari.projects.current()
+        if current_project:
+            self.log_debug(
+                "Updating the Work Area on the current project to '%s'" % new_context
+            )
+            with self.__profiler.span("set_project_metadata", "mari"):
+                self.__metadata_mgr.set_project_metadata(current_project, new_context)
+
     def destroy_engine(self):
         """
         Called when the engine is being destroyed
@@ -249,6 +341,37 @@ Please report any issues to:
         # disconnect from Mari project events:
         mari.utils.disconnect(mari.projects.opened, self.__on_project_opened)
 
+        # and from the geometry events used to keep the geometry index current:
+        self.__geometry_mgr.index.disconnect()
+
+        tk_mari = self.import_module("tk_mari")
+        self.log_debug(
+            "Publish record cache stats: %s"
+            % tk_mari.get_publish_record_cache().stats()
+        )
+
+    @property
+    def profiler(self):
+        """
+        The Profiler used to time engine and hook operations.  Spans are only recorded
+        when timing is enabled through the enable_timing setting or the TK_MARI_TIMING
+        environment variable::
+
+            with engine.profiler.span("exportImages", "mari", path=path):
+                layer.exportImages(path)
+        """
+        return self.__profiler
+
+    @property
+    def dialog_parent(self):
+        """
+        The widget that dialogs and progress windows shown by the engine and its
+        hooks should be parented to, or None if Mari is running in terminal mode.
+        """
+        if not self.has_ui:
+            return None
+        return self._get_dialog_parent()
+
     @property
     def has_ui(self):
         """
@@ -260,6 +383,46 @@ Please report any issues to:
     def version_str(cls, version_tuple):
         return "{}.{}v{}".format(*version_tuple)
 
+    def prefetch_publish_records(self):
+        """
+        Retrieve the publish records for all Shotgun aware geometry in the current project,
+        together with all other versions of those publishes, in a background thread and add
+        them to the publish record cache.  Apps that query these publishes afterwards, e.g.
+        the loader, breakdown and publisher, can then find them without a round trip to
+        Shotgun.
+
+        :returns:   The (daemon) thread doing the work or None if there is nothing to
+                    prefetch
+        """
+        tk_mari = self.import_module("tk_mari")
+        if (
+            not self.get_setting("prefetch_publish_records")
+            or not tk_mari.get_publish_record_cache().enabled
+        ):
+            return None
+
+        # the publish ids are read from the geometry index on the main thread as
+        # this uses the Mari API:
+        publish_ids = self.__geometry_mgr.index.list_publish_ids()
+        if not publish_ids:
+            return None
+
+        def prefetch():
+            try:
+                num_records = tk_mari.utils.prefetch_publish_records(publish_ids)
+            except Exception as e:
+                self.log_debug("Failed to prefetch publish records: %s" % e)
+                return
+            self.log_debug(
+                "Prefetched %d publish records for %d geometry versions"
+                % (num_records, len(publish_ids))
+            )
+
+        thread = threading.Thread(target=prefetch, name="tk-mari-prefetch")
+        thread.daemon = True
+        thread.start()
+        return thread
+
     def find_geometry_for_publish(self, sg_publish):
         """
         Find the geometry and version info for the specified publish if it exists in the current project
@@ -270,6 +433,19 @@ Please report any issues to:
         """
         return self.__geometry_mgr.find_geometry_for_publish(sg_publish)
 
+    def find_geometries_for_publishes(self, sg_publishes):
+        """
+        Find the geometry and version info for each of the specified publishes if they exist in the
+        current project.  This only makes a single round trip to Shotgun regardless of the number of
+        publishes so should be preferred over calling find_geometry_for_publish() repeatedly.
+
+        :param sg_publishes:    A list of Shotgun publishes to find geo for.  Each entry should be a
+                                Shotgun entity dictionary containing at least the entity "type" and "id".
+        :returns:               A dictionary of publish id to a tuple containing the geo and version
+                                that match the publish if found.
+        """
+        return self.__geometry_mgr.find_geometries_for_publishes(sg_publishes)
+
     def list_geometry(self):
         """
         Find all Shotgun aware geometry in the scene.  Any non-Shotgun aware geometry is ignored!
@@ -290,6 +466,19 @@ Please report any issues to:
         """
         return self.__geometry_mgr.list_geometry_versions(geo)
 
+    def list_outdated_geometry(self):
+        """
+        Find all Shotgun aware geometry in the scene whose current version is not the latest
+        version of the publish it was loaded from.  This only makes a single query to Shotgun
+        for the latest versions regardless of the amount of geometry so should be preferred over
+        calling find_geometry_for_publish() for each geo.
+
+        :returns:   A list of dictionaries containing the "geo", its current "geo_version", the
+                    "sg_publish" the current version was loaded from and the "latest" version of
+                    that publish
+        """
+        return self.__geometry_mgr.list_outdated_geometry()
+
     def load_geometry(self, sg_publish, options=None, objects_to_load=None):
         """
         Wraps the Mari GeoManager.load() method and additionally tags newly loaded geometry with Shotgun
@@ -313,6 +502,53 @@ Please report any issues to:
         """
         return self.__metadata_mgr.get_metadata(mari_entity)
 
+    def get_texture_publish_info(self, geo_name, channel_name, layer_name=None):
+        """
+        Get the information stored on a channel, or a layer within it, when it was last published.
+
+        :param geo_name:        The name of the geometry
+        :param channel_name:    The name of the channel
+        :param layer_name:      The name of the layer or None for the whole channel
+        :returns:               A dictionary containing the "fingerprint", "version" and "path" of
+                                the last publish.  Missing values are None
+        """
+        texture = self.__texture_mgr.find_texture(geo_name, channel_name, layer_name)
+        if not texture:
+            return {"fingerprint": None, "version": None, "path": None}
+        return self.__texture_mgr.get_publish_info(texture)
+
+    def set_texture_publish_info(
+        self, geo_name, channel_name, layer_name, fingerprint, version, path
+    ):
+        """
+        Store information about a publish on the channel, or layer within it, that was published.
+
+        :param geo_name:        The name of the geometry
+        :param channel_name:    The name of the channel
+        :param layer_name:      The name of the layer or None for the whole channel
+        :param fingerprint:     The fingerprint of the published tile content
+        :param version:         The version number of the publish
+        :param path:            The path of the publish
+        """
+        texture = self.__texture_mgr.find_texture(geo_name, channel_name, layer_name)
+        if not texture:
+            raise sgtk.TankError(
+                "Failed to find channel '%s' (layer '%s') on geometry '%s'!"
+                % (channel_name, layer_name, geo_name)
+            )
+        self.__texture_mgr.set_publish_info(texture, fingerprint, version, path)
+
+    def migrate_project_metadata(self, encoding=None):
+        """
+        Convert all Shotgun metadata stored on the current project, its geometry and geometry versions
+        to the specified encoding.
+
+        :param encoding:    The encoding to migrate to, either "legacy" or "payload".  If None then the
+                            encoding specified by the metadata_encoding setting is used.
+        :returns:           The number of Mari entities that were migrated
+        """
+        return self.__metadata_mgr.migrate_project_metadata(encoding)
+
     def add_geometry_version(self, geo, sg_publish, options=None):
         """
         Wraps the Mari GeoEntity.addVersion() method and additionally tags newly loaded geometry versions
@@ -329,6 +565,70 @@ Please report any issues to:
         """
         return self.__geometry_mgr.add_geometry_version(geo, sg_publish, options)
 
+    def add_geometry_versions(
+        self, geo_publishes, options=None, set_current=True, progress_callback=None
+    ):
+        """
+        Add a new version to each of the specified geometry, e.g. to update all geometry in the project
+        to the latest version of their publishes.  The publish records are resolved with a single Shotgun
+        query and all publish paths are checked before any versions are added.  If no progress callback is
+        specified and Mari isn't running in terminal mode then a progress dialog is shown that allows the
+        user to cancel the operation.
+
+        :param geo_publishes:       A list of (geo, sg_publish) tuples containing the Mari GeoEntity to add a
+                                    version to and the publish to load as the new version, e.g. from
+                                    list_outdated_geometry()
+        :param options:             [Mari arg] - Options to be passed to the file loader when loading the
+                                    geometry.  The options will default to the options that were used to load
+                                    the current version if not specified.
+        :param set_current:         If True then each new version is made the current version of its geo
+        :param progress_callback:   An optional callable that is called before each version is added with the
+                                    number of versions processed so far, the total number of versions and the
+                                    geo.  If it returns False then no further versions are added.
+        :returns:                   A list containing a dictionary for each (geo, sg_publish) tuple with the
+                                    "geo", "sg_publish", "geo_version", "status" - one of "added", "exists",
+                                    "failed" or "cancelled" - and an "error" message for failed versions
+        """
+        progress = None
+        if progress_callback is None and self.has_ui and geo_publishes:
+            progress = sgtk.platform.qt.QtGui.QProgressDialog(
+                "", "Cancel", 0, len(geo_publishes), self.dialog_parent
+            )
+            progress.setWindowTitle("Updating Geometry")
+            # the dialog is application modal so the events processed below can
+            # only deliver user input to its Cancel button:
+            progress.setWindowModality(sgtk.platform.qt.QtCore.Qt.ApplicationModal)
+            progress.setMinimumDuration(0)
+
+            def progress_callback(count, total, geo):
+                progress.setValue(count)
+                if geo:
+                    progress.setLabelText("Updating %s..." % geo.name())
+                sgtk.platform.qt.QtCore.QCoreApplication.processEvents()
+                return not progress.wasCanceled()
+
+        try:
+            results = self.__geometry_mgr.add_geometry_versions(
+                geo_publishes, options, set_current, progress_callback
+            )
+        finally:
+            if progress:
+                progress.close()
+
+        counts = {}
+        for result in results:
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+            if result["error"]:
+                self.log_warning(
+                    "Failed to add a version to '%s': %s"
+                    % (result["geo"].name(), result["error"])
+                )
+        self.log_debug(
+            "Added geometry versions: %s"
+            % ", ".join("%d %s" % (n, status) for status, n in sorted(counts.items()))
+        )
+        return results
+
     def create_project(
         self,
         name,
@@ -398,12 +698,44 @@ Please report any issues to:
         print(msg)
         mari.utils.message(msg)
 
+    def __write_timing_report(self):
+        """
+        Write all timings recorded since the last report to a Chrome trace file
+        and log a summary of them.  The recorded timings are then discarded.
+        """
+        trace_path = os.path.join(
+            tempfile.gettempdir(),
+            "tk_mari_trace_%s.json" % time.strftime("%Y%m%d_%H%M%S"),
+        )
+        self.__profiler.write_chrome_trace(trace_path)
+        self.log_info("Timing summary:\n%s" % self.__profiler.summary())
+        self.log_info("Chrome trace written to: %s" % trace_path)
+        self.__profiler.clear()
+
     def __on_project_opened(self, opened_project, is_new):
         """
         Called when a project is opened in Mari.  This looks for Toolkit metadata on the newly opened
-        project and if it finds any, it tries to build a new context and restarts the engine with this
+        project and if it finds any, it tries to build a new context and changes the engine to this
         new context.
 
+        :param opened_project:  The mari Project instance for the newly opened project
+        :param is_new:          True if the opened project is a new project
+        """
+        # (re)build the geometry index for the opened project:
+        self.__geometry_mgr.index.rebuild()
+
+        try:
+            self.__update_context_for_project(opened_project, is_new)
+        finally:
+            # the publish record cache is cleared when the context changes so the
+            # publish records for the project are only prefetched once the context
+            # has been updated:
+            self.prefetch_publish_records()
+
+    def __update_context_for_project(self, opened_project, is_new):
+        """
+        Change the engine context to match the Toolkit metadata found on an opened project.
+
         :param opened_project:  The mari Project instance for the newly opened project
         :param is_new:          True if the opened project is a new project
         """
@@ -440,10 +772,11 @@ Please report any issues to:
             )
             return
 
-        # get the context from the context entity:
+        # get the context from the context entity.  If the context has been resolved
+        # before then this doesn't need to query Shotgun:
         ctx = None
         try:
-            ctx = self.sgtk.context_from_entity(ctx_entity["type"], ctx_entity["id"])
+            ctx = self.__context_cache.get_context(ctx_entity["type"], ctx_entity["id"])
         except sgtk.TankError as e:
             self.log_error(
                 "Work area unchanged - Failed to create context from '%s %s': %s"
@@ -455,17 +788,15 @@ Please report any issues to:
             # nothing to do - context is the same!
             return
 
-        # The context for project is different so restart engine
-        # with this context:
+        # The context for project is different so change the engine to this
+        # context.  The engine, managers and any apps that support it stay loaded:
         try:
-            self.log_debug("Restarting the engine for Work Area: %s" % ctx)
-
-            # stop current engine:
-            self.destroy()
-
-            # start new engine with the new context:
-            sgtk.platform.start_engine(self.name, ctx.sgtk, ctx)
+            self.log_debug("Changing the engine context to Work Area: %s" % ctx)
+            with self.__profiler.span("change_context", "engine"):
+                sgtk.platform.change_context(ctx)
         except sgtk.TankError as e:
-            self.log_error("Failed to start PTR engine for Work Area %s: %s" % (ctx, e))
+            self.log_error(
+                "Failed to change the PTR engine to Work Area %s: %s" % (ctx, e)
+            )
         except Exception as e:
-            self.log_exception("Failed to start PTR engine for Work Area %s" % ctx)
+            self.log_exception("Failed to change the PTR engine to Work Area %s" % ctx)
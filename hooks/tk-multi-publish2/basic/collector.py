@@ -63,6 +63,7 @@ class MariSessionCollector(HookBaseClass):
             return
 
         publisher = self.parent
+        profiler = publisher.engine.profiler
 
         icon_path = os.path.join(
             self.disk_location, os.pardir, "icons", "mari_channel.png"
@@ -77,17 +78,20 @@ class MariSessionCollector(HookBaseClass):
         )
 
         layers_item = None
-        thumbnail = self._extract_mari_thumbnail()
+        with profiler.span("_extract_mari_thumbnail", "mari"):
+            thumbnail = self._extract_mari_thumbnail()
         # Look for all layers for all channels on all geometry.  Create items for both
         # the flattened channel as well as the individual layers
         for geo in mari.geo.list():
             geo_name = geo.name()
+            num_patches = self._count_patches(geo)
 
             for channel in geo.channelList():
                 channel_name = channel.name()
 
                 # find all collected layers:
-                collected_layers = self._find_layers_r(channel.layerList())
+                with profiler.span("_find_layers_r", "mari", channel=channel_name):
+                    collected_layers = self._find_layers_r(channel.layerList())
                 if not collected_layers:
                     # no layers to publish!
                     self.logger.warning(
@@ -105,6 +109,12 @@ class MariSessionCollector(HookBaseClass):
                 channel_item.set_icon_from_path(icon_path)
                 channel_item.properties["mari_geo_name"] = geo_name
                 channel_item.properties["mari_channel_name"] = channel_name
+                # estimate the relative amount of work needed to export the channel
+                # and its layers so the largest exports can be scheduled first:
+                tile_size = num_patches * self._get_channel_area(channel)
+                channel_item.properties["mari_export_size"] = tile_size * len(
+                    collected_layers
+                )
                 channel_item.set_thumbnail_from_path(thumbnail)
 
                 if len(collected_layers) > 0 and layers_item is None:
@@ -138,8 +148,29 @@ class MariSessionCollector(HookBaseClass):
                     layer_item.properties["mari_geo_name"] = geo_name
                     layer_item.properties["mari_channel_name"] = channel_name
                     layer_item.properties["mari_layer_name"] = layer_name
+                    layer_item.properties["mari_export_size"] = tile_size
                     layer_item.set_thumbnail_from_path(thumbnail)
 
+    def _count_patches(self, geo):
+        """
+        :param geo: The Mari GeoEntity
+        :returns:   The number of patches (UDIMs) on the geometry or 0 if unknown
+        """
+        try:
+            return len(geo.patchList())
+        except Exception:
+            return 0
+
+    def _get_channel_area(self, channel):
+        """
+        :param channel: The Mari Channel
+        :returns:       The number of pixels per patch for the channel or 0 if unknown
+        """
+        try:
+            return channel.width() * channel.height()
+        except Exception:
+            return 0
+
     def _find_layers_r(self, layers):
         """
         Find all layers within the specified list of layers.  This will return
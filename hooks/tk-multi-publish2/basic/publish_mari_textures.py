@@ -13,6 +13,9 @@ import os
 import pprint
 import re
 import sgtk
+import shutil
+import tempfile
+import time
 
 HookBaseClass = sgtk.get_hook_baseclass()
 
@@ -122,6 +125,64 @@ class MariTexturesPublishPlugin(HookBaseClass):
                 "correspond to a template defined in "
                 "templates.yml.",
             },
+            "Batch Registration": {
+                "type": "bool",
+                "default": False,
+                "description": "Queue publish registrations and create them "
+                "together with a single PTR batch request when the publish "
+                "is finalized, rather than registering each publish as it is "
+                "exported.",
+            },
+            "Background Export": {
+                "type": "bool",
+                "default": False,
+                "description": "Export the textures for all items in the publish "
+                "in small steps from a queue that keeps Mari responsive, showing "
+                "progress and allowing the export to be cancelled.  Work that "
+                "doesn't use Mari, such as registration, is run on worker threads.",
+            },
+            "Staged Export": {
+                "type": "bool",
+                "default": False,
+                "description": "Export textures to a local scratch directory and "
+                "then copy the tiles to the publish location in parallel.  The "
+                "copies are verified against checksums and committed together "
+                "before the publish is registered.  A manifest of tile hashes is "
+                "written next to each publish.",
+            },
+            "Incremental Export": {
+                "type": "bool",
+                "default": False,
+                "description": "As for 'Staged Export' but tiles that are identical "
+                "to the previous version are hard linked from the previous "
+                "version's files rather than copied again.",
+            },
+            "Verify Export": {
+                "type": "bool",
+                "default": False,
+                "description": "Check that a non-empty tile exists on disk for "
+                "every UDIM of the geometry before the publish is registered.  "
+                "Only applies to publish paths containing a $UDIM token.",
+            },
+            "Tile Count Field": {
+                "type": "str",
+                "default": "",
+                "description": "Optional name of a field on the publish entity "
+                "to store the number of published tiles in.",
+            },
+            "Tile Bytes Field": {
+                "type": "str",
+                "default": "",
+                "description": "Optional name of a field on the publish entity "
+                "to store the total size in bytes of the published tiles in.",
+            },
+            "Force Publish Unchanged": {
+                "type": "bool",
+                "default": False,
+                "description": "Publish textures even when the exported tiles are "
+                "identical to the last publish of the channel or layer.  By "
+                "default, identical textures are not published again.",
+            },
         }
 
     @property
@@ -182,6 +243,7 @@ class MariTexturesPublishPlugin(HookBaseClass):
         """
 
         publisher = self.parent
+        session = self._get_session(item, "validate")
 
         # populate the publish template on the item if found
         publish_template_setting = settings.get("Publish Template")
@@ -195,27 +257,30 @@ class MariTexturesPublishPlugin(HookBaseClass):
             self.logger.error(error_msg)
             raise Exception(error_msg)
 
+        # resolve the geo, channel and layer for the item.  These are remembered
+        # for the rest of the session so they don't need to be found again:
+        geo, channel, layer = self._get_handles(session, item, refresh=True)
+
         geo_name = item.properties["mari_geo_name"]
-        geo = mari.geo.find(geo_name)
         if not geo:
             error_msg = (
-                "Failed to find geometry in the project! Validation failed." % geo_name
+                "Failed to find geometry '%s' in the project! Validation failed."
+                % geo_name
             )
             self.logger.error(error_msg)
             raise Exception(error_msg)
 
         channel_name = item.properties["mari_channel_name"]
-        channel = geo.findChannel(channel_name)
         if not channel:
             error_msg = (
-                "Failed to find channel on geometry! Validation failed." % channel_name
+                "Failed to find channel '%s' on geometry! Validation failed."
+                % channel_name
             )
             self.logger.error(error_msg)
             raise Exception(error_msg)
 
         layer_name = item.properties.get("mari_layer_name")
         if layer_name:
-            layer = channel.findLayer(layer_name)
             if not layer:
                 error_msg = (
                     "Failed to find layer for channel: %s Validation failed."
@@ -223,6 +288,11 @@ class MariTexturesPublishPlugin(HookBaseClass):
                 )
                 self.logger.error(error_msg)
                 raise Exception(error_msg)
+
+        # remember the items being published so that their exports can all be
+        # scheduled together.  Items are keyed by id as validation is run again
+        # before publishing:
+        session.setdefault("validated_items", {})[id(item)] = item
         return True
 
     def publish(self, settings, item):
@@ -234,97 +304,135 @@ class MariTexturesPublishPlugin(HookBaseClass):
             instances.
         :param item: Item to process
         """
+        session = self._get_session(item, "publish")
+        try:
+            self._publish(settings, item, session)
+        except Exception:
+            # finalize isn't run when a publish fails so stop any outstanding
+            # exports and remove the flattened channels from the project now:
+            scheduler = session.get("export_scheduler")
+            if scheduler:
+                scheduler.cancel()
+            flatten_cache = session.pop("flatten_cache", None)
+            if flatten_cache:
+                flatten_cache.clear()
+            raise
+
+    def _publish(self, settings, item, session):
+        """
+        Implementation of publish()
 
-        # Currently there is no primary publish for Mari so just save the
-        # current project to ensure nothing is lost if something goes wrong!
-        proj = mari.projects.current()
-        if proj:
-            self.logger.info("Saving the current project...")
-            proj.save()
-
+        :param settings:    The plugin settings
+        :param item:        Item to process
+        :param session:     The publish session state
+        """
         publisher = self.parent
+        profiler = publisher.engine.profiler
 
-        geo_name = item.properties["mari_geo_name"]
-        geo = mari.geo.find(geo_name)
-        channel_name = item.properties["mari_channel_name"]
-        channel = geo.findChannel(channel_name)
-        layer_name = item.properties.get("mari_layer_name")
-
-        publish_template = item.properties["publish_template"]
-
-        # Get fields from the current context
-        fields = {}
-        ctx_fields = self.parent.context.as_template_fields(publish_template)
-        fields.update(ctx_fields)
-
-        # For geo name, strip out the non-alphanumeric characters because Mari's
-        # publish template filter does not allow non-alphanumeric characters in
-        # the geo name.
-        geo_name = re.sub(r"[\W_]+", "", geo_name)
-        fields["name"] = geo_name
-
-        fields["channel"] = channel_name
-        fields["layer"] = layer_name
-        fields["UDIM"] = "$UDIM"
+        # Currently there is no primary publish for Mari so just save the
+        # current project to ensure nothing is lost if something goes wrong!
+        # This only needs to happen once per publish session, before the first
+        # export:
+        if not session.get("project_saved"):
+            self._save_project()
+            session["project_saved"] = True
 
         # get the publish name. This will ensure we get a
         # consistent name across version publishes of this file.
-        if layer_name:
-            publish_name = "%s, %s - %s" % (geo_name, channel_name, layer_name)
-        else:
-            publish_name = "%s, %s" % (geo_name, channel_name)
-
-        existing_publishes = self._find_publishes(
-            self.parent.context, publish_name, settings["Publish Type"].value
-        )
-        version = max([p["version_number"] for p in existing_publishes] or [0]) + 1
-
-        fields["version"] = version
-
-        publish_path = publish_template.apply_fields(fields)
-
-        # get the path in a normalized state. no trailing separator, separators
-        # are appropriate for current os, no double separators, etc.
-        path = sgtk.util.ShotgunPath.normalize(publish_path)
+        publish_name = self._get_publish_name(item)
+        version = self._get_publish_version(settings, item, session)
+        path = self._get_publish_path(item, version)
 
         self.logger.info("A Publish will be created in PTR and linked to:")
         self.logger.info("  %s" % (path,))
 
-        if layer_name:
-            layer = channel.findLayer(layer_name)
-            layer.exportImages(path)
-        else:
-            # publish the entire channel, flattened
-            layers = channel.layerList()
-            if len(layers) == 1:
-                # only one layer so just publish it:
-                # Note - this works around an issue that was reported (#27945) where flattening a channel
-                # with only a single layer would cause Mari to crash - this bug was not reproducible by
-                # us but happened 100% for the client!
-                layer = layers[0]
-                layer.exportImages(path)
-            elif len(layers) > 1:
-                # flatten layers in the channel and publish the flattened layer:
-                # remember the current channel:
-                current_channel = geo.currentChannel()
-                # duplicate the channel so we don't operate on the original:
-                duplicate_channel = geo.createDuplicateChannel(channel)
+        texture_args = (
+            item.properties["mari_geo_name"],
+            item.properties["mari_channel_name"],
+            item.properties.get("mari_layer_name"),
+        )
+        # tiles can only be verified if the publish path contains a $UDIM token:
+        verify_export = settings["Verify Export"].value and "$UDIM" in path
+        expected_udims = None
+        if verify_export:
+            expected_udims = self._get_expected_udims(
+                self._get_handles(session, item)[0]
+            )
+
+        # textures are exported directly to the publish path unless they're being
+        # staged, in which case they're exported to a local scratch location first:
+        export_path = self._get_export_path(settings, session, item, path)
+        tk_mari = publisher.engine.import_module("tk_mari")
+        scheduler = None
+        try:
+            if settings["Background Export"].value:
+                # the exports for all items in the session are scheduled the first
+                # time an item is published and then run in the background whilst
+                # earlier items are registered:
+                scheduler = self._get_export_scheduler(settings, session)
+                job = session["export_jobs"].get(id(item))
+                if not job:
+                    job = scheduler.add_job(
+                        publish_name,
+                        self._export_textures(item, export_path, session),
+                    )
                 try:
-                    # flatten it into a single layer:
-                    flattened_layer = duplicate_channel.flatten()
-                    # export the images for it:
-                    flattened_layer.exportImages(path)
-                finally:
-                    # set the current channel back - not doing this will result in Mari crashing
-                    # when the duplicated channel is removed!
-                    geo.setCurrentChannel(current_channel)
-                    # remove the duplicate channel, destroying the channel and the flattened layer:
-                    geo.removeChannel(duplicate_channel, geo.DESTROY_ALL)
+                    scheduler.wait(job)
+                except Exception:
+                    # stop any other exports in the session:
+                    scheduler.cancel()
+                    raise
             else:
-                self.logger.error(
-                    "Channel '%s' doesn't appear to have any layers!" % channel.name()
+                for _ in self._export_textures(item, export_path, session):
+                    pass
+
+            # fingerprint the exported tiles and skip the publish if they're
+            # identical to the last publish of this texture:
+            fingerprint, tile_digests = self._run_in_background(
+                scheduler, tk_mari.utils.fingerprint_udim_tiles, export_path
+            )
+            previous = publisher.engine.get_texture_publish_info(*texture_args)
+            if (
+                fingerprint
+                and fingerprint == previous["fingerprint"]
+                and not settings["Force Publish Unchanged"].value
+            ):
+                self._skip_unchanged_publish(item, export_path, previous)
+                return
+
+            if export_path != path:
+                # copy the exported tiles to the publish location, reusing any that
+                # are unchanged since the previous version if publishing
+                # incrementally:
+                previous_path = None
+                if settings["Incremental Export"].value:
+                    previous_path = previous["path"]
+                self._run_in_background(
+                    scheduler,
+                    tk_mari.commit_staged_tiles,
+                    export_path,
+                    path,
+                    previous_path,
+                    tile_digests,
                 )
 
+            # check what landed on disk:
+            tile_info = self._run_in_background(
+                scheduler, tk_mari.utils.verify_udim_tiles, path, expected_udims
+            )
+        finally:
+            self._remove_scratch_dir(session, item)
+        item.properties["mari_texture_fingerprint"] = fingerprint
+
+        self.logger.info(
+            "Exported %d tiles (%.1f MB)"
+            % (tile_info["count"], tile_info["bytes"] / (1024.0 * 1024.0))
+        )
+        if verify_export:
+            self._check_tiles(tile_info)
+        item.properties["mari_tile_count"] = tile_info["count"]
+        item.properties["mari_tile_bytes"] = tile_info["bytes"]
+
         # arguments for publish registration
         self.logger.info("Registering publish...")
         publish_data = {
@@ -339,6 +447,15 @@ class MariTexturesPublishPlugin(HookBaseClass):
             "dependency_paths": [],
         }
 
+        # record the tile count and size on the publish if required:
+        sg_fields = {}
+        if settings["Tile Count Field"].value:
+            sg_fields[settings["Tile Count Field"].value] = tile_info["count"]
+        if settings["Tile Bytes Field"].value:
+            sg_fields[settings["Tile Bytes Field"].value] = tile_info["bytes"]
+        if sg_fields:
+            publish_data["sg_fields"] = sg_fields
+
         # log the publish data for debugging
         self.logger.debug(
             "Populated Publish data...",
@@ -351,16 +468,25 @@ class MariTexturesPublishPlugin(HookBaseClass):
             },
         )
 
-        # create the publish and stash it in the item properties for other
-        # plugins to use.
-        item.properties["sg_publish_data"] = sgtk.util.register_publish(**publish_data)
+        if settings["Batch Registration"].value:
+            # queue the publish to be registered with all other publishes in
+            # the session when the publish is finalized:
+            session.setdefault("queued_registrations", []).append((item, publish_data))
+            self.logger.info("Publish queued for registration.")
+        else:
+            # create the publish and stash it in the item properties for other
+            # plugins to use.
+            with profiler.span("register_publish", "shotgun", name=publish_name):
+                sg_publish = self._run_in_background(
+                    scheduler, lambda: sgtk.util.register_publish(**publish_data)
+                )
+            item.properties["sg_publish_data"] = sg_publish
+            self.logger.info("Publish registered!")
 
         # inject the publish path such that children can refer to it when
         # updating dependency information
         item.properties["sg_publish_path"] = path
 
-        self.logger.info("Publish registered!")
-
         # now that we've published. keep a handle on the path that was published
         item.properties["path"] = path
 
@@ -376,17 +502,67 @@ class MariTexturesPublishPlugin(HookBaseClass):
         """
 
         publisher = self.parent
+        session = self._get_session(item, "finalize")
+
+        # all exports have finished so shut down the export scheduler:
+        scheduler = session.pop("export_scheduler", None)
+        if scheduler:
+            scheduler.shutdown()
+        self._remove_scratch_dir(session)
+
+        # and destroy the flattened channels shared by the exports:
+        flatten_cache = session.pop("flatten_cache", None)
+        if flatten_cache:
+            flatten_cache.clear()
+
+        # register all queued publishes and clear the status of all conflicting
+        # publishes for the session the first time an item is finalized:
+        if settings["Batch Registration"].value and not session.get(
+            "registrations_processed"
+        ):
+            session["registrations_processed"] = True
+            self._register_queued_publishes(settings, session)
+
+        if item.properties.get("mari_publish_skipped"):
+            self.logger.info(
+                "Textures are unchanged since the last publish: %s"
+                % item.properties["path"]
+            )
+            return
 
-        # get the data for the publish that was just created in PTR
-        publish_data = item.properties["sg_publish_data"]
+        if settings["Batch Registration"].value:
+            error = session.get("registration_errors", {}).get(id(item))
+            if error:
+                raise Exception("Failed to register publish: %s" % error)
 
-        # ensure conflicting publishes have their status cleared
-        publisher.util.clear_status_for_conflicting_publishes(
-            item.context, publish_data
-        )
+            # get the data for the publish that was just created in PTR
+            publish_data = item.properties["sg_publish_data"]
+        else:
+            # get the data for the publish that was just created in PTR
+            publish_data = item.properties["sg_publish_data"]
+
+            # ensure conflicting publishes have their status cleared
+            with publisher.engine.profiler.span(
+                "clear_status_for_conflicting_publishes", "shotgun"
+            ):
+                publisher.util.clear_status_for_conflicting_publishes(
+                    item.context, publish_data
+                )
 
         self.logger.info("Cleared the status of all previous, conflicting publishes")
 
+        # store the fingerprint of the published textures on the channel or layer:
+        fingerprint = item.properties.get("mari_texture_fingerprint")
+        if fingerprint:
+            publisher.engine.set_texture_publish_info(
+                item.properties["mari_geo_name"],
+                item.properties["mari_channel_name"],
+                item.properties.get("mari_layer_name"),
+                fingerprint,
+                item.properties["mari_publish_version"],
+                item.properties["path"],
+            )
+
         path = item.properties["path"]
         self.logger.info(
             "Publish created for file: %s" % (path,),
@@ -399,13 +575,728 @@ class MariTexturesPublishPlugin(HookBaseClass):
             },
         )
 
+    # The phases of a publish session in the order they are run by the publisher:
+    _SESSION_PHASES = ["validate", "publish", "finalize"]
+
+    def _get_session(self, item, phase):
+        """
+        Get the state shared by all items in the current publish session.
+
+        A new session is started when the items belong to a different publish
+        tree or when the publisher moves back to an earlier phase, e.g. when
+        validating again after a previous publish has been finalized.
+
+        :param item:    The item being processed
+        :param phase:   The phase being run, one of "validate", "publish" or
+                        "finalize"
+        :returns:       Dictionary of session state
+        """
+        root_item = item
+        while root_item.parent:
+            root_item = root_item.parent
+
+        phase_index = self._SESSION_PHASES.index(phase)
+        session = getattr(self, "_publish_session", None)
+        if (
+            session is None
+            or session["root_item"] is not root_item
+            or session["phase_index"] > phase_index
+        ):
+            if session and session.get("export_scheduler"):
+                # stop any exports still outstanding from the previous session:
+                session["export_scheduler"].shutdown()
+            if session:
+                self._remove_scratch_dir(session)
+                if session.get("flatten_cache"):
+                    session["flatten_cache"].clear()
+            session = {"root_item": root_item}
+            self._publish_session = session
+        session["phase_index"] = phase_index
+        return session
+
+    def _save_project(self):
+        """
+        Save the current project if it has unsaved changes, recording how long
+        the save takes in the publish log.
+        """
+        proj = mari.projects.current()
+        if not proj:
+            return
+
+        is_modified = getattr(proj, "isModified", None)
+        if is_modified and not is_modified():
+            self.logger.info("The current project has no unsaved changes.")
+            return
+
+        self.logger.info("Saving the current project...")
+        start_time = time.time()
+        with self.parent.engine.profiler.span("Project.save", "mari"):
+            proj.save()
+        self.logger.info(
+            "Saved the current project in %.1f seconds" % (time.time() - start_time)
+        )
+
+    def _get_publish_version(self, settings, item, session):
+        """
+        Get the version number to publish an item with.
+
+        :param settings:    The plugin settings
+        :param item:        The item being published
+        :param session:     The publish session state
+        :returns:           The version number
+        """
+        # the next version numbers for all texture items validated in the session
+        # are resolved together the first time they are needed:
+        if not session.get("versions_resolved"):
+            self._resolve_version_numbers(
+                settings, list(session.get("validated_items", {}).values())
+            )
+            session["versions_resolved"] = True
+        version = item.properties.get("mari_publish_version")
+        if version is None:
+            existing_publishes = self._find_publishes(
+                item.context,
+                self._get_publish_name(item),
+                settings["Publish Type"].value,
+            )
+            version = max([p["version_number"] for p in existing_publishes] or [0]) + 1
+            item.properties["mari_publish_version"] = version
+        return version
+
+    def _get_publish_path(self, item, version):
+        """
+        Get the path to publish the textures for an item to.
+
+        :param item:    The item being published
+        :param version: The version number to publish
+        :returns:       The normalized publish path, containing a $UDIM token
+        """
+        publish_template = item.properties["publish_template"]
+
+        # Get fields from the current context
+        fields = {}
+        ctx_fields = self.parent.context.as_template_fields(publish_template)
+        fields.update(ctx_fields)
+
+        fields["name"] = self._get_publish_geo_name(item)
+        fields["channel"] = item.properties["mari_channel_name"]
+        fields["layer"] = item.properties.get("mari_layer_name")
+        fields["UDIM"] = "$UDIM"
+        fields["version"] = version
+
+        publish_path = publish_template.apply_fields(fields)
+
+        # get the path in a normalized state. no trailing separator, separators
+        # are appropriate for current os, no double separators, etc.
+        return sgtk.util.ShotgunPath.normalize(publish_path)
+
+    def _export_textures(self, item, path, session):
+        """
+        Export the textures for an item.  This is a generator that yields between
+        each Mari API call so that it can be run in steps by the export scheduler.
+
+        :param item:    The item being published
+        :param path:    The path to export the textures to
+        :param session: The publish session state
+        """
+        profiler = self.parent.engine.profiler
+        geo, channel, layer = self._get_handles(session, item)
+
+        if item.properties.get("mari_layer_name"):
+            yield
+            with profiler.span("Layer.exportImages", "mari", path=path):
+                layer.exportImages(path)
+            return
+
+        flatten_cache = self._get_flatten_cache(session)
+        try:
+            # publish the entire channel, flattened
+            layers = channel.layerList()
+            if len(layers) == 1:
+                # only one layer so just publish it:
+                # Note - this works around an issue that was reported (#27945) where flattening a channel
+                # with only a single layer would cause Mari to crash - this bug was not reproducible by
+                # us but happened 100% for the client!
+                layer = layers[0]
+                yield
+                with profiler.span("Layer.exportImages", "mari", path=path):
+                    layer.exportImages(path)
+            elif len(layers) > 1:
+                # flatten layers in the channel and publish the flattened layer.
+                # The flattened layer is shared with anything else in the session
+                # that needs it:
+                yield
+                flattened_layer = flatten_cache.get_flattened_layer(geo, channel)
+                yield
+                # export the images for it:
+                with profiler.span("Layer.exportImages", "mari", path=path):
+                    flattened_layer.exportImages(path)
+            else:
+                self.logger.error(
+                    "Channel '%s' doesn't appear to have any layers!" % channel.name()
+                )
+        finally:
+            # destroy the flattened channel once everything that needs it has
+            # been exported:
+            flatten_cache.release(
+                item.properties["mari_geo_name"], item.properties["mari_channel_name"]
+            )
+
+    def _skip_unchanged_publish(self, item, path, previous):
+        """
+        Skip publishing an item whose exported tiles are identical to the last
+        publish of its channel or layer.  The exported tiles are removed and the
+        item refers to the previous publish instead.
+
+        :param item:        The item being published
+        :param path:        The path the tiles were exported to
+        :param previous:    The information stored for the last publish
+        """
+        publisher = self.parent
+        tk_mari = publisher.engine.import_module("tk_mari")
+        for tile_path in tk_mari.utils.find_udim_tiles(path).values():
+            try:
+                os.remove(tile_path)
+            except OSError as e:
+                self.logger.warning(
+                    "Failed to remove unchanged texture '%s': %s" % (tile_path, e)
+                )
+
+        self.logger.info(
+            "The exported textures are identical to version %s so they will not be "
+            "published again." % previous["version"]
+        )
+        item.properties["mari_publish_skipped"] = True
+        item.properties["sg_publish_path"] = previous["path"]
+        item.properties["path"] = previous["path"]
+
+    def _get_expected_udims(self, geo):
+        """
+        Get the UDIMs of the tiles that should be exported for an item, one for
+        each patch of the geometry.
+
+        :param geo:     The Mari GeoEntity being published
+        :returns:       A list of UDIM numbers or None if they can't be determined
+        """
+        try:
+            return [patch.udim() for patch in geo.patchList()]
+        except Exception as e:
+            self.logger.debug("Unable to determine the UDIMs to export: %s" % e)
+            return None
+
+    def _check_tiles(self, tile_info):
+        """
+        Check that the expected tiles were exported and none of them are empty.
+
+        :param tile_info:   The result of verifying the exported tiles
+        :raises Exception:  If any tiles are missing or empty
+        """
+        errors = []
+        if not tile_info["count"]:
+            errors.append("no tiles were exported")
+        if tile_info["missing"]:
+            errors.append(
+                "missing tiles for UDIMs %s"
+                % ", ".join(str(u) for u in tile_info["missing"])
+            )
+        if tile_info["empty"]:
+            errors.append(
+                "empty tiles for UDIMs %s"
+                % ", ".join(str(u) for u in tile_info["empty"])
+            )
+        if errors:
+            error_msg = "Export verification failed: %s!" % "; ".join(errors)
+            self.logger.error(error_msg)
+            raise Exception(error_msg)
+
+    def _get_handles(self, session, item, refresh=False):
+        """
+        Get the Mari geo, channel and layer for an item.  These are found by name
+        the first time they're needed and then reused for the rest of the session.
+
+        :param session: The publish session state
+        :param item:    The item being published
+        :param refresh: If True then find the handles again even if already known
+        :returns:       Tuple containing the GeoEntity, Channel and Layer for the
+                        item.  The layer is None for channel items and any handles
+                        that can't be found are None
+        """
+        key = (
+            item.properties["mari_geo_name"],
+            item.properties["mari_channel_name"],
+            item.properties.get("mari_layer_name"),
+        )
+        handles = session.setdefault("handles", {})
+        if refresh or key not in handles:
+            geo_name, channel_name, layer_name = key
+            geo = mari.geo.find(geo_name)
+            channel = geo.findChannel(channel_name) if geo else None
+            layer = None
+            if channel and layer_name:
+                layer = channel.findLayer(layer_name)
+            handles[key] = (geo, channel, layer)
+        return handles[key]
+
+    def _sort_exports(self, session, items):
+        """
+        Sort items into the order their exports should be run in: grouped by geo,
+        then channel, then layer, with the groups and items containing the most
+        work first.  The flattened channel is exported before the channel's layers.
+
+        :param session: The publish session state
+        :param items:   The items to sort
+        :returns:       A new list containing the sorted items
+        """
+        sizes = {}
+        geo_sizes = {}
+        channel_sizes = {}
+        for item in items:
+            size = item.properties.get("mari_export_size")
+            if size is None:
+                size = self._estimate_export_size(*self._get_handles(session, item))
+            geo_name = item.properties["mari_geo_name"]
+            channel_key = (geo_name, item.properties["mari_channel_name"])
+            sizes[id(item)] = size
+            geo_sizes[geo_name] = geo_sizes.get(geo_name, 0) + size
+            channel_sizes[channel_key] = channel_sizes.get(channel_key, 0) + size
+
+        def sort_key(item):
+            geo_name = item.properties["mari_geo_name"]
+            channel_name = item.properties["mari_channel_name"]
+            layer_name = item.properties.get("mari_layer_name")
+            return (
+                -geo_sizes[geo_name],
+                geo_name,
+                -channel_sizes[(geo_name, channel_name)],
+                channel_name,
+                layer_name is not None,
+                -sizes[id(item)],
+                layer_name or "",
+            )
+
+        return sorted(items, key=sort_key)
+
+    def _estimate_export_size(self, geo, channel, layer):
+        """
+        Estimate the relative amount of work needed to export a channel or layer
+        from the number of patches, the channel resolution and, when flattening,
+        the number of layers.
+
+        :param geo:     The Mari GeoEntity
+        :param channel: The Mari Channel
+        :param layer:   The Mari Layer or None to estimate for the flattened channel
+        :returns:       The estimated size
+        """
+        try:
+            size = len(geo.patchList()) * channel.width() * channel.height()
+            if not layer:
+                size *= max(len(channel.layerList()), 1)
+            return size
+        except Exception:
+            return 0
+
+    def _get_flatten_cache(self, session):
+        """
+        Get the cache of flattened channels for the publish session, creating it
+        the first time it's needed.  Each flattened channel is destroyed once all
+        exports that need it have run and any that remain are destroyed when the
+        session is finalized or a publish fails.
+
+        :param session: The publish session state
+        :returns:       The FlattenedChannelCache for the session
+        """
+        flatten_cache = session.get("flatten_cache")
+        if not flatten_cache:
+            tk_mari = self.parent.engine.import_module("tk_mari")
+            flatten_cache = tk_mari.FlattenedChannelCache()
+            session["flatten_cache"] = flatten_cache
+        return flatten_cache
+
+    def _get_export_path(self, settings, session, item, path):
+        """
+        Get the path to export the textures for an item to.  When staging the
+        export, this is in a scratch directory that is created the first time it's
+        needed and removed once the item has been published.
+
+        :param settings:    The plugin settings
+        :param session:     The publish session state
+        :param item:        The item being published
+        :param path:        The publish path for the item
+        :returns:           The path to export the textures to
+        """
+        if not (
+            settings["Staged Export"].value or settings["Incremental Export"].value
+        ):
+            return path
+
+        scratch_dirs = session.setdefault("scratch_dirs", {})
+        scratch_dir = scratch_dirs.get(id(item))
+        if not scratch_dir:
+            scratch_dir = tempfile.mkdtemp(prefix="tk_mari_export_")
+            scratch_dirs[id(item)] = scratch_dir
+        return os.path.join(scratch_dir, os.path.basename(path))
+
+    def _remove_scratch_dir(self, session, item=None):
+        """
+        Remove the scratch directory used to export the textures for an item.
+
+        :param session: The publish session state
+        :param item:    The item to remove the scratch directory for.  If None then
+                        the scratch directories for all items are removed
+        """
+        scratch_dirs = session.get("scratch_dirs", {})
+        if item is None:
+            to_remove = list(scratch_dirs.values())
+            scratch_dirs.clear()
+        else:
+            to_remove = [scratch_dirs.pop(id(item), None)]
+        for scratch_dir in to_remove:
+            if scratch_dir:
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    def _run_in_background(self, scheduler, fn, *args):
+        """
+        Run a function that doesn't use the Mari API on a worker thread of the
+        export scheduler, processing events whilst waiting for it to finish.  If
+        there is no scheduler then the function is just called.
+
+        :param scheduler:   The ExportScheduler for the session or None
+        :param fn:          The function to run
+        :returns:           The result of the function
+        """
+        if not scheduler:
+            return fn(*args)
+        return scheduler.wait_for_future(scheduler.run_in_background(fn, *args))
+
+    def _get_export_scheduler(self, settings, session):
+        """
+        Get the export scheduler for the publish session, creating it and
+        scheduling the exports for all items validated in the session the first
+        time it's needed.
+
+        :param settings:    The plugin settings
+        :param session:     The publish session state
+        :returns:           The ExportScheduler for the session
+        """
+        scheduler = session.get("export_scheduler")
+        if scheduler:
+            return scheduler
+
+        engine = self.parent.engine
+        tk_mari = engine.import_module("tk_mari")
+        scheduler = tk_mari.ExportScheduler(parent=engine.dialog_parent)
+        session["export_scheduler"] = scheduler
+        session["export_jobs"] = export_jobs = {}
+
+        # export the items grouped by geo, then channel, then layer with the
+        # largest work first so that the flattened channels shared between items
+        # are reused and the longest exports aren't left until last:
+        flatten_cache = self._get_flatten_cache(session)
+        for item in self._sort_exports(
+            session, list(session.get("validated_items", {}).values())
+        ):
+            if not item.properties.get("mari_layer_name"):
+                # keep the flattened channel until all exports that share it have run:
+                flatten_cache.add_consumer(
+                    item.properties["mari_geo_name"],
+                    item.properties["mari_channel_name"],
+                )
+            version = self._get_publish_version(settings, item, session)
+            path = self._get_publish_path(item, version)
+            export_path = self._get_export_path(settings, session, item, path)
+            export_jobs[id(item)] = scheduler.add_job(
+                self._get_publish_name(item),
+                self._export_textures(item, export_path, session),
+            )
+        return scheduler
+
+    def _register_queued_publishes(self, settings, session):
+        """
+        Register all publishes queued in the session with a single Shotgun batch
+        request, then clear the status of all conflicting publishes with a single
+        query and batch update per context.
+
+        The publish entity data is built by sgtk.util.register_publish in dry run
+        mode so that it matches what an individual registration would create.  If
+        the batch request fails, each publish is registered individually so that
+        failures are reported against the items they belong to.  Errors are stored
+        in the session keyed by the id of the item.
+
+        :param settings:    The plugin settings
+        :param session:     The publish session state
+        """
+        publisher = self.parent
+        profiler = publisher.engine.profiler
+        queued = session.get("queued_registrations", [])
+        errors = session.setdefault("registration_errors", {})
+        if not queued:
+            return
+
+        self.logger.info("Registering %d publishes..." % len(queued))
+        publish_entity_type = sgtk.util.get_published_file_entity_type(publisher.sgtk)
+
+        registered = []
+        try:
+            # build the publish entity data for each item.  The publish type is
+            # resolved once for all items rather than per item:
+            publish_type = self._find_or_create_publish_type(
+                settings["Publish Type"].value
+            )
+            requests = []
+            for item, publish_data in queued:
+                dry_run_data = dict(publish_data)
+                dry_run_data.update(
+                    {
+                        "published_file_type": None,
+                        "thumbnail_path": None,
+                        "dry_run": True,
+                    }
+                )
+                data = sgtk.util.register_publish(**dry_run_data)
+                data.pop("type", None)
+                if publish_type:
+                    if publish_entity_type == "PublishedFile":
+                        data["published_file_type"] = publish_type
+                    else:
+                        data["tank_type"] = publish_type
+                requests.append(
+                    {
+                        "request_type": "create",
+                        "entity_type": publish_entity_type,
+                        "data": data,
+                    }
+                )
+
+            with profiler.span("batch register_publish", "shotgun", count=len(queued)):
+                sg_results = publisher.shotgun.batch(requests)
+
+            for (item, publish_data), sg_publish in zip(queued, sg_results):
+                registered.append((item, publish_data, sg_publish))
+        except Exception as e:
+            self.logger.warning(
+                "Batch registration failed, registering publishes individually: %s" % e
+            )
+            registered = []
+            for item, publish_data in queued:
+                try:
+                    with profiler.span(
+                        "register_publish", "shotgun", name=publish_data["name"]
+                    ):
+                        sg_publish = sgtk.util.register_publish(**publish_data)
+                except Exception as e:
+                    errors[id(item)] = str(e)
+                    self.logger.error(
+                        "Failed to register publish '%s': %s"
+                        % (publish_data["name"], e)
+                    )
+                    continue
+                # the thumbnail has already been uploaded:
+                registered.append(
+                    (item, dict(publish_data, thumbnail_path=None), sg_publish)
+                )
+
+        for item, publish_data, sg_publish in registered:
+            # stash the publish in the item properties for other plugins to use:
+            item.properties["sg_publish_data"] = sg_publish
+
+            # upload the thumbnail.  This can't be batched so failures are just
+            # logged:
+            thumbnail_path = publish_data.get("thumbnail_path")
+            if thumbnail_path:
+                try:
+                    with profiler.span("upload_thumbnail", "shotgun"):
+                        publisher.shotgun.upload_thumbnail(
+                            publish_entity_type, sg_publish["id"], thumbnail_path
+                        )
+                except Exception as e:
+                    self.logger.warning(
+                        "Failed to upload thumbnail for publish '%s': %s"
+                        % (publish_data["name"], e)
+                    )
+
+        self.logger.info("Registered %d publishes!" % len(registered))
+
+        # clear the status of conflicting publishes in the context of each item,
+        # with a single query for all items sharing a context:
+        context_groups = []
+        for item, _, sg_publish in registered:
+            for ctx, sg_publishes in context_groups:
+                if ctx == item.context:
+                    break
+            else:
+                sg_publishes = []
+                context_groups.append((item.context, sg_publishes))
+            sg_publishes.append(sg_publish)
+        for ctx, sg_publishes in context_groups:
+            self._clear_status_for_conflicting_publishes(
+                ctx, settings["Publish Type"].value, sg_publishes
+            )
+
+    def _find_or_create_publish_type(self, publish_type):
+        """
+        Find the Shotgun publish type entity for a publish type name, creating it
+        if it doesn't exist.
+
+        :param publish_type:    The name of the publish type
+        :returns:               The publish type entity or None if no name was given
+        """
+        if not publish_type:
+            return None
+
+        publisher = self.parent
+        publish_entity_type = sgtk.util.get_published_file_entity_type(publisher.sgtk)
+        if publish_entity_type == "PublishedFile":
+            type_entity_type = "PublishedFileType"
+        else:
+            type_entity_type = "TankType"
+
+        filters = [["code", "is", publish_type]]
+        if type_entity_type == "TankType":
+            filters.append(["project", "is", publisher.context.project])
+        sg_type = publisher.shotgun.find_one(type_entity_type, filters)
+        if not sg_type:
+            data = {"code": publish_type}
+            if type_entity_type == "TankType":
+                data["project"] = publisher.context.project
+            sg_type = publisher.shotgun.create(type_entity_type, data)
+        return sg_type
+
+    def _clear_status_for_conflicting_publishes(self, ctx, publish_type, sg_publishes):
+        """
+        Clear the status of all previous publishes that conflict with the specified
+        publishes, i.e. that have the same name and type in the same context, using
+        a single query and a single batch update.
+
+        :param ctx:             Context the publishes were registered in
+        :param publish_type:    The type of the publishes
+        :param sg_publishes:    The list of newly registered publishes
+        """
+        if not sg_publishes:
+            return
+
+        publisher = self.parent
+        publish_entity_type = sgtk.util.get_published_file_entity_type(publisher.sgtk)
+        if publish_entity_type == "PublishedFile":
+            publish_type_field = "published_file_type.PublishedFileType.code"
+        else:
+            publish_type_field = "tank_type.TankType.code"
+
+        # construct filters from the context, names and type:
+        filters = [["project", "is", ctx.project]]
+        if ctx.entity:
+            filters.append(["entity", "is", ctx.entity])
+        if ctx.task:
+            filters.append(["task", "is", ctx.task])
+        filters.append(["name", "in", list(set(p["name"] for p in sg_publishes))])
+        if publish_type:
+            filters.append([publish_type_field, "is", publish_type])
+        filters.extend(
+            [
+                ["id", "not_in", [p["id"] for p in sg_publishes]],
+                ["sg_status_list", "is_not", None],
+            ]
+        )
+
+        try:
+            with publisher.engine.profiler.span(
+                "clear_status_for_conflicting_publishes", "shotgun"
+            ):
+                conflicting = publisher.shotgun.find(publish_entity_type, filters)
+                if conflicting:
+                    publisher.shotgun.batch(
+                        [
+                            {
+                                "request_type": "update",
+                                "entity_type": publish_entity_type,
+                                "entity_id": sg_publish["id"],
+                                "data": {"sg_status_list": None},
+                            }
+                            for sg_publish in conflicting
+                        ]
+                    )
+        except Exception as e:
+            self.logger.warning(
+                "Failed to clear the status of previous, conflicting publishes: %s" % e
+            )
+
+    def _get_publish_geo_name(self, item):
+        """
+        Get the geo name to use in the publish path and name for an item.
+
+        For geo name, strip out the non-alphanumeric characters because Mari's
+        publish template filter does not allow non-alphanumeric characters in
+        the geo name.
+
+        :param item:    The item being published
+        :returns:       The geo name
+        """
+        return re.sub(r"[\W_]+", "", item.properties["mari_geo_name"])
+
+    def _get_publish_name(self, item):
+        """
+        Get the publish name for an item.  This is consistent across version
+        publishes of the same geo, channel and layer.
+
+        :param item:    The item being published
+        :returns:       The publish name
+        """
+        geo_name = self._get_publish_geo_name(item)
+        channel_name = item.properties["mari_channel_name"]
+        layer_name = item.properties.get("mari_layer_name")
+        if layer_name:
+            return "%s, %s - %s" % (geo_name, channel_name, layer_name)
+        else:
+            return "%s, %s" % (geo_name, channel_name)
+
+    def _resolve_version_numbers(self, settings, items):
+        """
+        Resolve the next version number for the specified texture items using a
+        single Shotgun query per context and store it on each item in the
+        "mari_publish_version" property.  Items with the same context and publish
+        name are given consecutive version numbers in the order specified.
+
+        :param settings:    The plugin settings
+        :param items:       The items being published
+        """
+        # group the items by context and then by publish name:
+        context_groups = []
+        for item in items:
+            for ctx, items_by_name in context_groups:
+                if ctx == item.context:
+                    break
+            else:
+                items_by_name = {}
+                context_groups.append((item.context, items_by_name))
+            items_by_name.setdefault(self._get_publish_name(item), []).append(item)
+
+        for ctx, items_by_name in context_groups:
+            existing_publishes = self._find_publishes(
+                ctx,
+                list(items_by_name.keys()),
+                settings["Publish Type"].value,
+            )
+            latest_versions = {}
+            for sg_publish in existing_publishes:
+                name = sg_publish.get("name")
+                latest_versions[name] = max(
+                    latest_versions.get(name, 0), sg_publish.get("version_number") or 0
+                )
+
+            for publish_name, publish_items in items_by_name.items():
+                version = latest_versions.get(publish_name, 0)
+                for item in publish_items:
+                    version += 1
+                    item.properties["mari_publish_version"] = version
+
     def _find_publishes(self, ctx, publish_name, publish_type):
         """
         Given a context, publish name and type, find all publishes from Shotgun
         that match.
 
         :param ctx:             Context to use when looking for publishes
-        :param publish_name:    The name of the publishes to look for
+        :param publish_name:    The name of the publishes to look for.  This can also
+                                be a list of names to find publishes for all of them
+                                with a single query
         :param publish_type:    The type of publishes to look for
 
         :returns:               A list of Shotgun publish records that match the search
@@ -425,7 +1316,9 @@ class MariTexturesPublishPlugin(HookBaseClass):
             filters.append(["task", "is", ctx.task])
 
         # add in name & type:
-        if publish_name:
+        if isinstance(publish_name, (list, tuple)):
+            filters.append(["name", "in", list(publish_name)])
+        elif publish_name:
             filters.append(["name", "is", publish_name])
         if publish_type:
             filters.append([publish_type_field, "is", publish_type])
@@ -433,10 +1326,11 @@ class MariTexturesPublishPlugin(HookBaseClass):
         # retrieve a list of all matching publishes from Shotgun:
         sg_publishes = []
         try:
-            query_fields = ["version_number"]
-            sg_publishes = self.parent.shotgun.find(
-                publish_entity_type, filters, query_fields
-            )
+            query_fields = ["name", "version_number"]
+            with self.parent.engine.profiler.span("_find_publishes", "shotgun"):
+                sg_publishes = self.parent.shotgun.find(
+                    publish_entity_type, filters, query_fields
+                )
         except Exception as e:
             self.logger.error(
                 "Failed to find publishes of type '%s', called '%s', for context %s: %s"
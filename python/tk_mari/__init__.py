@@ -11,4 +11,13 @@
 from .menu_generation import MenuGenerator
 from .metadata import MetadataManager
 from .project import ProjectManager
-from .geometry import GeometryManager
+from .geometry import GeometryManager, GeometryNameAllocator
+from .geometry_index import GeometryIndex
+from .publish_cache import PublishRecordCache, get_publish_record_cache
+from .geometry_cache import GeometryFileCache
+from .timing import Profiler, get_profiler
+from .export_scheduler import ExportScheduler, ExportJob
+from .texture import TextureManager
+from .tiles import TileManifest, commit_staged_tiles
+from .flatten_cache import FlattenedChannelCache
+from .context_cache import ContextCache
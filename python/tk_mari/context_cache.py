@@ -0,0 +1,220 @@
+# Copyright (c) 2014 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+On-disk cache of contexts resolved from Shotgun entities
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+import sgtk
+
+from .timing import get_profiler
+
+
+class ContextCache(object):
+    """
+    Persistent cache of the contexts resolved for Shotgun entities, keyed by
+    site and entity.
+
+    Contexts are stored in their serialized dictionary form in a single JSON file
+    so that resolving the context for a project that has been opened before
+    doesn't need any Shotgun queries.  Cached contexts are revalidated in the
+    background each time they're used so the cache stays current.
+    """
+
+    # Name of the cache file:
+    __CACHE_FILE = "context_cache.json"
+
+    def __init__(self, tk, root, ttl):
+        """
+        Construction
+
+        :param tk:      The Toolkit API instance used to resolve contexts
+        :param root:    The directory to store the cache file in
+        :param ttl:     Time in seconds that a cached context remains valid for.
+                        If 0 then the cache is disabled
+        """
+        self.ttl = ttl
+        self.__tk = tk
+        self.__path = os.path.join(root, ContextCache.__CACHE_FILE)
+        self.__lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """
+        :returns:   True if the cache is enabled
+        """
+        return self.ttl > 0
+
+    def get_context(self, entity_type, entity_id):
+        """
+        Get the context for an entity.  If the context is cached then it's returned
+        without any Shotgun queries and revalidated in the background, otherwise
+        it's resolved and added to the cache.
+
+        :param entity_type: The Shotgun entity type
+        :param entity_id:   The Shotgun entity id
+        :returns:           The context for the entity
+        :raises TankError:  If the context couldn't be resolved
+        """
+        if not self.enabled:
+            return self.__resolve(entity_type, entity_id)
+
+        ctx = self.get(entity_type, entity_id)
+        if ctx:
+            self.revalidate(entity_type, entity_id, ctx)
+            return ctx
+
+        ctx = self.__resolve(entity_type, entity_id)
+        self.put(entity_type, entity_id, ctx)
+        return ctx
+
+    def get(self, entity_type, entity_id):
+        """
+        Get a cached context.
+
+        :param entity_type: The Shotgun entity type
+        :param entity_id:   The Shotgun entity id
+        :returns:           The cached context or None if it isn't cached, has
+                            expired or can't be deserialized
+        """
+        engine = sgtk.platform.current_bundle()
+        with self.__lock:
+            entry = self.__read().get(self.__key(entity_type, entity_id))
+        if not entry or time.time() - entry.get("timestamp", 0) > self.ttl:
+            return None
+        try:
+            return sgtk.Context.from_dict(self.__tk, entry["context"])
+        except Exception as e:
+            engine.log_debug(
+                "Ignoring invalid cached context for %s %s: %s"
+                % (entity_type, entity_id, e)
+            )
+            return None
+
+    def put(self, entity_type, entity_id, ctx):
+        """
+        Add a context to the cache.
+
+        :param entity_type: The Shotgun entity type
+        :param entity_id:   The Shotgun entity id
+        :param ctx:         The context to cache
+        """
+        engine = sgtk.platform.current_bundle()
+        try:
+            with self.__lock:
+                entries = self.__read()
+                now = time.time()
+                # drop any expired entries whilst we're here:
+                for key, entry in list(entries.items()):
+                    if now - entry.get("timestamp", 0) > self.ttl:
+                        del entries[key]
+                entries[self.__key(entity_type, entity_id)] = {
+                    "timestamp": now,
+                    "context": ctx.to_dict(),
+                }
+                self.__write(entries)
+        except Exception as e:
+            engine.log_warning("Failed to cache context %s: %s" % (ctx, e))
+
+    def revalidate(self, entity_type, entity_id, ctx=None):
+        """
+        Resolve the context for an entity in a background thread and update the
+        cache with the result.
+
+        :param entity_type: The Shotgun entity type
+        :param entity_id:   The Shotgun entity id
+        :param ctx:         The currently cached context, if any
+        :returns:           The (daemon) thread doing the work
+        """
+        engine = sgtk.platform.current_bundle()
+
+        def revalidate():
+            try:
+                new_ctx = self.__resolve(entity_type, entity_id)
+            except Exception as e:
+                engine.log_debug(
+                    "Failed to revalidate the cached context for %s %s: %s"
+                    % (entity_type, entity_id, e)
+                )
+                return
+            if ctx is not None and new_ctx != ctx:
+                engine.log_debug(
+                    "Cached context for %s %s has changed from %s to %s"
+                    % (entity_type, entity_id, ctx, new_ctx)
+                )
+            self.put(entity_type, entity_id, new_ctx)
+
+        thread = threading.Thread(target=revalidate, name="tk-mari-context-cache")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def clear(self):
+        """
+        Remove all cached contexts.
+        """
+        with self.__lock:
+            if os.path.exists(self.__path):
+                os.remove(self.__path)
+
+    def __resolve(self, entity_type, entity_id):
+        """
+        :param entity_type: The Shotgun entity type
+        :param entity_id:   The Shotgun entity id
+        :returns:           The context resolved from Shotgun for the entity
+        """
+        with get_profiler().span("context_from_entity", "shotgun"):
+            return self.__tk.context_from_entity(entity_type, entity_id)
+
+    def __key(self, entity_type, entity_id):
+        """
+        :param entity_type: The Shotgun entity type
+        :param entity_id:   The Shotgun entity id
+        :returns:           The cache key for the entity on the current site
+        """
+        return "%s|%s|%s" % (self.__tk.shotgun_url, entity_type, entity_id)
+
+    def __read(self):
+        """
+        Read all cache entries.  Must be called with the lock held.
+
+        :returns:   The cache entries or an empty dictionary if the cache doesn't
+                    exist or can't be read
+        """
+        try:
+            with open(self.__path, "r") as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def __write(self, entries):
+        """
+        Atomically write all cache entries.  Must be called with the lock held.
+
+        :param entries: The cache entries to write
+        """
+        root = os.path.dirname(self.__path)
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        fd, tmp_path = tempfile.mkstemp(dir=root, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.__path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -0,0 +1,329 @@
+# Copyright (c) 2014 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Scheduler that runs texture exports without freezing the Mari UI
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sgtk
+from sgtk import TankError
+from sgtk.platform.qt import QtCore, QtGui
+
+from .timing import get_profiler
+
+
+class ExportJob(object):
+    """
+    A unit of main thread work run by the ExportScheduler.
+
+    The work is provided as a generator that performs a single Mari API call
+    between each yield so that the scheduler can return control to the Qt event
+    loop between calls.  The value returned by the generator is the result of
+    the job.
+    """
+
+    PENDING, RUNNING, DONE, FAILED, CANCELLED = range(5)
+
+    def __init__(self, label, steps):
+        """
+        Construction
+
+        :param label:   A label describing the job, shown in the progress dialog
+        :param steps:   A generator that performs the work of the job
+        """
+        self.label = label
+        self.state = ExportJob.PENDING
+        self.result = None
+        self.error = None
+        self._steps = steps
+
+    @property
+    def finished(self):
+        """
+        :returns:   True if the job has completed, failed or been cancelled
+        """
+        return self.state in (ExportJob.DONE, ExportJob.FAILED, ExportJob.CANCELLED)
+
+
+class ExportScheduler(object):
+    """
+    Runs queued export jobs on the main thread in small time slices driven by a
+    Qt timer, keeping Mari responsive while textures are exported.  Work that
+    doesn't touch the Mari API, e.g. verification, copying and registration, is
+    run on a pool of worker threads.
+
+    A modal progress dialog shows the job being run and allows the user to cancel
+    all outstanding work.
+    """
+
+    def __init__(
+        self, title="Exporting Textures", time_slice=0.05, max_workers=4, parent=None
+    ):
+        """
+        Construction
+
+        :param title:       The title of the progress dialog
+        :param time_slice:  The time in seconds that jobs are run for before control
+                            is returned to the Qt event loop
+        :param max_workers: The maximum number of worker threads for background work
+        :param parent:      The parent widget for the progress dialog
+        """
+        self.time_slice = time_slice
+        self.__title = title
+        self.__parent = parent
+        self.__jobs = []
+        self.__current_job = None
+        self.__in_slice = False
+        self.__cancel_requested = False
+        self.__cancelled = False
+        self.__futures = []
+        self.__executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="tk-mari-export"
+        )
+        self.__progress = None
+        self.__total = 0
+        self.__timer = QtCore.QTimer()
+        self.__timer.setInterval(0)
+        self.__timer.timeout.connect(self.__run_slice)
+
+    @property
+    def cancelled(self):
+        """
+        :returns:   True if the user has cancelled the scheduled work
+        """
+        return self.__cancelled or self.__cancel_requested
+
+    def add_job(self, label, steps):
+        """
+        Queue a job to be run on the main thread.
+
+        :param label:   A label describing the job, shown in the progress dialog
+        :param steps:   A generator that performs the work of the job, yielding
+                        between each Mari API call
+        :returns:       The queued ExportJob
+        """
+        job = ExportJob(label, steps)
+        if self.cancelled:
+            job.state = ExportJob.CANCELLED
+            steps.close()
+        else:
+            self.__jobs.append(job)
+            self.__total += 1
+            self.__update_progress()
+            if not self.__timer.isActive():
+                self.__timer.start()
+        return job
+
+    def run_in_background(self, fn, *args, **kwargs):
+        """
+        Run a function on a worker thread.  The function must not use the Mari
+        API.
+
+        :param fn:  The function to run
+        :returns:   A concurrent.futures.Future for the result of the function
+        """
+        if self.cancelled:
+            raise TankError("The export was cancelled!")
+        future = self.__executor.submit(fn, *args, **kwargs)
+        self.__futures.append(future)
+        return future
+
+    def wait(self, job):
+        """
+        Process events and run queued jobs until the specified job has finished.
+
+        :param job:         The ExportJob to wait for
+        :returns:           The result of the job
+        :raises TankError:  If the job failed or was cancelled
+        """
+        while not job.finished:
+            self.__run_slice()
+            self.__process_events()
+
+        if job.state == ExportJob.CANCELLED:
+            raise TankError("Export of '%s' was cancelled!" % job.label)
+        if job.state == ExportJob.FAILED:
+            raise TankError("Export of '%s' failed: %s" % (job.label, job.error))
+        return job.result
+
+    def wait_for_future(self, future):
+        """
+        Process events and run queued jobs until the specified background work has
+        finished.
+
+        :param future:  The future returned by run_in_background()
+        :returns:       The result of the background work
+        :raises:        Any exception raised by the background work, or TankError
+                        if it was cancelled
+        """
+        while not future.done():
+            if self.__jobs or self.__current_job:
+                self.__run_slice()
+            self.__process_events()
+            if not future.done() and not (self.__jobs or self.__current_job):
+                time.sleep(0.01)
+
+        if future.cancelled():
+            raise TankError("The export was cancelled!")
+        return future.result()
+
+    def cancel(self):
+        """
+        Cancel all outstanding jobs and any background work that hasn't started.
+        The job currently being run is stopped at the next yield.
+        """
+        self.__cancel_requested = True
+        if not self.__in_slice:
+            self.__handle_cancel()
+
+    def shutdown(self, wait=True):
+        """
+        Stop the scheduler, cancelling any outstanding jobs, and shut down the
+        worker threads.
+
+        :param wait:    If True, wait for any running background work to finish
+        """
+        if self.__jobs or self.__current_job:
+            self.cancel()
+        self.__timer.stop()
+        self.__executor.shutdown(wait=wait)
+        self.__close_progress()
+
+    def __process_events(self):
+        """
+        Process pending events whilst waiting for work to finish.  The progress
+        dialog is application modal so, while it's shown, the only user input that
+        can be delivered is to the dialog itself.  Otherwise user input is left
+        queued so that nothing can start more work in the nested event loop.
+        """
+        if self.__progress:
+            flags = QtCore.QEventLoop.AllEvents
+        else:
+            flags = QtCore.QEventLoop.ExcludeUserInputEvents
+        QtCore.QCoreApplication.processEvents(flags, 10)
+
+    def __run_slice(self):
+        """
+        Run queued jobs until the time slice has been used or there are no jobs
+        left to run.
+        """
+        if self.__in_slice:
+            # a Mari call being run by a job is processing events:
+            return
+
+        self.__in_slice = True
+        try:
+            end_time = time.perf_counter() + self.time_slice
+            while time.perf_counter() < end_time:
+                if self.__cancel_requested:
+                    self.__handle_cancel()
+                    break
+                if not self.__current_job:
+                    if not self.__jobs:
+                        break
+                    self.__current_job = self.__jobs.pop(0)
+                    self.__current_job.state = ExportJob.RUNNING
+                    self.__update_progress()
+                self.__step(self.__current_job)
+        finally:
+            self.__in_slice = False
+
+        if self.__cancel_requested:
+            self.__handle_cancel()
+        if not self.__jobs and not self.__current_job:
+            self.__timer.stop()
+            self.__close_progress()
+
+    def __step(self, job):
+        """
+        Run the next step of a job.
+
+        :param job: The ExportJob to run
+        """
+        try:
+            with get_profiler().span("ExportScheduler.step", "mari", job=job.label):
+                next(job._steps)
+            return
+        except StopIteration as e:
+            job.result = e.value
+            job.state = ExportJob.DONE
+        except Exception as e:
+            engine = sgtk.platform.current_bundle()
+            engine.log_debug("Export of '%s' failed: %s" % (job.label, e))
+            job.error = e
+            job.state = ExportJob.FAILED
+        self.__current_job = None
+        self.__update_progress()
+
+    def __handle_cancel(self):
+        """
+        Cancel all outstanding work.  Must not be called whilst a job step is
+        being run.
+        """
+        self.__cancel_requested = False
+        self.__cancelled = True
+
+        jobs = self.__jobs
+        if self.__current_job:
+            jobs.insert(0, self.__current_job)
+        self.__jobs = []
+        self.__current_job = None
+        for job in jobs:
+            # closing the generator runs any clean-up in the job:
+            try:
+                job._steps.close()
+            except Exception as e:
+                engine = sgtk.platform.current_bundle()
+                engine.log_warning(
+                    "Failed to clean up cancelled export of '%s': %s" % (job.label, e)
+                )
+            job.state = ExportJob.CANCELLED
+
+        for future in self.__futures:
+            future.cancel()
+        self.__futures = []
+
+        self.__timer.stop()
+        self.__close_progress()
+
+    def __update_progress(self):
+        """
+        Show or update the progress dialog.
+        """
+        num_jobs = len(self.__jobs) + (1 if self.__current_job else 0)
+        if not num_jobs:
+            return
+
+        if not self.__progress:
+            self.__progress = QtGui.QProgressDialog("", "Cancel", 0, 0, self.__parent)
+            self.__progress.setWindowTitle(self.__title)
+            self.__progress.setWindowModality(QtCore.Qt.ApplicationModal)
+            self.__progress.setMinimumDuration(0)
+            self.__progress.setAutoClose(False)
+            self.__progress.setAutoReset(False)
+            self.__progress.canceled.connect(self.cancel)
+
+        label = self.__current_job.label if self.__current_job else ""
+        self.__progress.setMaximum(self.__total)
+        self.__progress.setValue(self.__total - num_jobs)
+        self.__progress.setLabelText("Exporting %s..." % label if label else "")
+
+    def __close_progress(self):
+        """
+        Close the progress dialog if it's open.
+        """
+        if self.__progress:
+            self.__progress.canceled.disconnect(self.cancel)
+            self.__progress.close()
+            self.__progress = None
+        self.__total = 0
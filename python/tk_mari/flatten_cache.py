@@ -0,0 +1,160 @@
+# Copyright (c) 2014 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Cache of flattened copies of Mari channels
+"""
+
+import sgtk
+
+from .timing import get_profiler
+
+
+class FlattenedChannelCache(object):
+    """
+    Cache of flattened copies of channels keyed by geometry and channel name.
+
+    Flattening a channel requires it to be duplicated so that the original isn't
+    modified.  The duplicate is created and flattened the first time it's needed
+    and then shared by everything that needs the flattened result.  Consumers of
+    a flattened channel can be registered up front, in which case the duplicate
+    is destroyed as soon as the last of them has released it, otherwise it's
+    destroyed when it's first released.  Any remaining duplicates are destroyed
+    when the cache is cleared.
+
+    Mari will crash if the current channel of a geometry is removed, so the cache
+    also manages the current channel: it is restored as soon as a duplicate has
+    been created and again before the duplicates are destroyed.
+    """
+
+    def __init__(self):
+        """
+        Construction
+        """
+        # (geo name, channel name) -> (geo, duplicate channel, flattened layer)
+        self.__entries = {}
+        # geo name -> the current channel before any duplicates were created
+        self.__current_channels = {}
+        # (geo name, channel name) -> number of consumers yet to release the entry
+        self.__consumers = {}
+
+    def add_consumer(self, geo_name, channel_name):
+        """
+        Register something that will need the flattened copy of a channel so that
+        the copy is kept until it has been released by all consumers.
+
+        :param geo_name:        The name of the geometry the channel belongs to
+        :param channel_name:    The name of the channel
+        """
+        key = (geo_name, channel_name)
+        self.__consumers[key] = self.__consumers.get(key, 0) + 1
+
+    def release(self, geo_name, channel_name):
+        """
+        Release the flattened copy of a channel.  The copy is destroyed once all
+        registered consumers have released it.
+
+        :param geo_name:        The name of the geometry the channel belongs to
+        :param channel_name:    The name of the channel
+        """
+        key = (geo_name, channel_name)
+        remaining = self.__consumers.get(key, 0) - 1
+        if remaining > 0:
+            self.__consumers[key] = remaining
+            return
+        self.__consumers.pop(key, None)
+
+        entry = self.__entries.pop(key, None)
+        if not entry:
+            return
+        geo, duplicate_channel, _ = entry
+        current_channel = self.__current_channels[geo_name]
+        if not any(name == geo_name for name, _ in self.__entries):
+            # no more duplicates of this geo's channels:
+            del self.__current_channels[geo_name]
+        try:
+            self.__remove_channel(geo, duplicate_channel, current_channel)
+        except Exception as e:
+            engine = sgtk.platform.current_bundle()
+            engine.log_warning(
+                "Failed to remove the flattened copy of channel '%s' on '%s': %s"
+                % (channel_name, geo_name, e)
+            )
+
+    def get_flattened_layer(self, geo, channel):
+        """
+        Get a layer containing the flattened content of a channel, creating it if
+        needed.
+
+        :param geo:     The Mari GeoEntity the channel belongs to
+        :param channel: The Mari Channel to flatten
+        :returns:       The flattened Mari Layer
+        """
+        key = (geo.name(), channel.name())
+        entry = self.__entries.get(key)
+        if entry:
+            return entry[2]
+
+        profiler = get_profiler()
+        # remember the current channel:
+        if key[0] not in self.__current_channels:
+            self.__current_channels[key[0]] = geo.currentChannel()
+        current_channel = self.__current_channels[key[0]]
+
+        # duplicate the channel so we don't operate on the original:
+        with profiler.span("GeoEntity.createDuplicateChannel", "mari"):
+            duplicate_channel = geo.createDuplicateChannel(channel)
+        try:
+            # flatten it into a single layer:
+            with profiler.span("Channel.flatten", "mari"):
+                flattened_layer = duplicate_channel.flatten()
+        except Exception:
+            self.__remove_channel(geo, duplicate_channel, current_channel)
+            raise
+        finally:
+            geo.setCurrentChannel(current_channel)
+
+        self.__entries[key] = (geo, duplicate_channel, flattened_layer)
+        return flattened_layer
+
+    def clear(self):
+        """
+        Destroy all duplicated channels and their flattened layers.
+        """
+        engine = sgtk.platform.current_bundle()
+        for (geo_name, channel_name), (geo, duplicate_channel, _) in list(
+            self.__entries.items()
+        ):
+            current_channel = self.__current_channels[geo_name]
+            try:
+                self.__remove_channel(geo, duplicate_channel, current_channel)
+            except Exception as e:
+                engine.log_warning(
+                    "Failed to remove the flattened copy of channel '%s' on '%s': %s"
+                    % (channel_name, geo_name, e)
+                )
+        self.__entries = {}
+        self.__current_channels = {}
+        self.__consumers = {}
+
+    def __remove_channel(self, geo, duplicate_channel, current_channel):
+        """
+        Remove a duplicated channel, ensuring it's not the current channel first.
+
+        :param geo:                 The Mari GeoEntity the channel belongs to
+        :param duplicate_channel:   The duplicated channel to remove
+        :param current_channel:     The channel to make current
+        """
+        # set the current channel back - not doing this will result in Mari crashing
+        # when the duplicated channel is removed!
+        geo.setCurrentChannel(current_channel)
+        # remove the duplicate channel, destroying the channel and the flattened layer:
+        with get_profiler().span("GeoEntity.removeChannel", "mari"):
+            geo.removeChannel(duplicate_channel, geo.DESTROY_ALL)
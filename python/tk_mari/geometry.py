@@ -19,7 +19,62 @@ import os
 import mari
 
 from .metadata import MetadataManager
-from .utils import update_publish_records, get_publish_type_field
+from .geometry_index import GeometryIndex
+from .timing import get_profiler
+from .utils import (
+    update_publish_records,
+    get_publish_type_field,
+    find_publish_versions,
+    find_latest_publishes,
+    find_missing_paths,
+    get_required_publish_fields,
+)
+
+
+class GeometryNameAllocator(object):
+    """
+    Allocates unique geometry names for a batch of geometry.  The names of the
+    existing geometry in the project are read once and the next free numeric
+    suffix is tracked for each base name so that naming many geos with the same
+    base name doesn't repeatedly probe every previously allocated name.
+    """
+
+    def __init__(self, existing_names=None):
+        """
+        Construction
+
+        :param existing_names:  The names already in use.  If None then the names
+                                of all geometry in the current project are used
+        """
+        if existing_names is None:
+            existing_names = mari.geo.names()
+        self.__names = set(existing_names)
+        self.__next_suffix = {}
+
+    def allocate(self, base_name, current_name=None):
+        """
+        Allocate a unique name.  The base name is used if it's free, otherwise the
+        first free name of the form 'base_name_N' is used.
+
+        :param base_name:       The name to make unique
+        :param current_name:    The current name of the geo being renamed.  This
+                                name is released once a new name is allocated
+        :returns:               The unique name
+        """
+        name = base_name
+        if name in self.__names:
+            suffix = self.__next_suffix.get(base_name, 1)
+            while True:
+                name = "%s_%d" % (base_name, suffix)
+                suffix += 1
+                if name not in self.__names:
+                    break
+            self.__next_suffix[base_name] = suffix
+
+        self.__names.add(name)
+        if current_name is not None and current_name != name:
+            self.__names.discard(current_name)
+        return name
 
 
 class GeometryManager(object):
@@ -27,11 +82,25 @@ class GeometryManager(object):
     Provides various utility methods that deal with Mari geometry
     """
 
-    def __init__(self):
+    def __init__(self, md_mgr=None, file_cache=None):
         """
         Construction
+
+        :param md_mgr:      The MetadataManager instance to use.  If None then a new
+                            instance will be created
+        :param file_cache:  An optional GeometryFileCache used to load geometry from
+                            a local copy of the publish files
         """
-        self.__md_mgr = MetadataManager()
+        self.__md_mgr = md_mgr or MetadataManager()
+        self.__index = GeometryIndex(self.__md_mgr)
+        self.__file_cache = file_cache
+
+    @property
+    def index(self):
+        """
+        :returns:   The GeometryIndex for the current project
+        """
+        return self.__index
 
     def find_geometry_for_publish(self, sg_publish):
         """
@@ -43,94 +112,90 @@ class GeometryManager(object):
         :returns:           Tuple containing the geo and version that match the publish
                             if found.
         """
-        engine = sgtk.platform.current_bundle()
+        return self.find_geometries_for_publishes([sg_publish])[sg_publish["id"]]
 
-        # ensure that sg_publish contains the information we need:
+    def find_geometries_for_publishes(self, sg_publishes):
+        """
+        Find the geometry and version instances for each of the specified publishes if they
+        exist in the current project.  This is equivalent to calling find_geometry_for_publish()
+        for each publish but only makes a single round trip to Shotgun to find other versions
+        of the publishes.
+
+        :param sg_publishes:    A list of Shotgun publishes to find geo for.  Each entry should be
+                                a Shotgun entity dictionary containing at least the entity "type"
+                                and "id".
+        :returns:               A dictionary of publish id to a tuple containing the geo and version
+                                that match the publish if found.  If a geo is found that contains a
+                                different version of the publish then the version will be None.
+        """
+        with get_profiler().span(
+            "find_geometries_for_publishes", "engine", count=len(sg_publishes)
+        ):
+            return self.__find_geometries_for_publishes(sg_publishes)
+
+    def __find_geometries_for_publishes(self, sg_publishes):
+        """
+        Implementation of find_geometries_for_publishes()
+
+        :param sg_publishes:    A list of Shotgun publishes to find geo for.
+        :returns:               A dictionary of publish id to a (geo, version) tuple
+        """
+        results = {}
+
+        # look for perfect matches first:
+        unmatched = []
+        for sg_publish in sg_publishes:
+            geo, geo_version = self.__index.find_publish(sg_publish["id"])
+            if geo_version:
+                results[sg_publish["id"]] = (geo, geo_version)
+            else:
+                results[sg_publish["id"]] = (None, None)
+                unmatched.append(sg_publish)
+
+        if not unmatched:
+            return results
+
+        # ensure that the publishes contain the information we need:
         publish_type_field = get_publish_type_field()
         update_publish_records(
-            [sg_publish], ["project", "entity", "task", "name", publish_type_field]
+            unmatched, ["project", "entity", "task", "name", publish_type_field]
         )
-        publish_entity = sg_publish["entity"]
-        publish_task = sg_publish["task"]
-
-        # enumerate through all geometry in project that has Shotgun metadata:
-        found_geo = None
-        sg_publish_version_ids = None
-        for geo, entity, task in [
-            (g.get("geo"), g.get("entity"), g.get("task")) for g in self.list_geometry()
-        ]:
-            if not geo:
-                continue
 
-            # we can rule out the entire geo if it doesn't match the entity and/or task:
-            if publish_entity and entity:
-                if (
-                    entity["type"] != publish_entity["type"]
-                    or entity["id"] != publish_entity["id"]
+        # find all geometry in the project that could contain a different version
+        # of each publish and that has at least one Shotgun aware version:
+        candidates = {}
+        for sg_publish in unmatched:
+            candidate_geo_names = [
+                geo_name
+                for geo_name in self.__index.find_candidate_geometry(
+                    sg_publish["entity"], sg_publish["task"]
+                )
+                if self.__index.get_publish_ids(geo_name)
+            ]
+            if candidate_geo_names:
+                candidates[sg_publish["id"]] = (sg_publish, candidate_geo_names)
+
+        if not candidates:
+            # didn't find any matches :(
+            return results
+
+        # get the publish versions from Shotgun that match all remaining publishes:
+        publish_versions = find_publish_versions(
+            [sg_publish for sg_publish, _ in candidates.values()]
+        )
+
+        for publish_id, (sg_publish, candidate_geo_names) in candidates.items():
+            sg_publish_version_ids = publish_versions.get(publish_id, set())
+            for geo_name in candidate_geo_names:
+                if sg_publish_version_ids.intersection(
+                    self.__index.get_publish_ids(geo_name)
                 ):
-                    continue
-            if publish_task and task:
-                if task["id"] != publish_task["id"]:
-                    continue
-
-            # enumerate through all versions of this geo that have Shotgun metadata:
-            matches_geo = False
-            for version_item in self.list_geometry_versions(geo):
-                geo_version = version_item.get("geo_version")
-                if not geo_version:
-                    continue
-
-                geo_version_publish_id = version_item.get("publish_id")
-                if geo_version_publish_id == None:
-                    # can't do much without a publish id!
-                    continue
-
-                if geo_version_publish_id == sg_publish["id"]:
-                    # perfect match!
-                    return (geo, geo_version)
-                elif not matches_geo:
-                    # didn't find an exact match so lets see if this is
-                    # is a different version of the publish
-                    if sg_publish_version_ids == None:
-                        # get a list of publish versions from Shotgun that match sg_publish:
-                        filters = [["project", "is", sg_publish["project"]]]
-                        if publish_entity:
-                            filters.append(["entity", "is", publish_entity])
-                        if publish_task:
-                            filters.append(["task", "is", publish_task])
-                        if sg_publish["name"]:
-                            filters.append(["name", "is", sg_publish["name"]])
-                        if sg_publish[publish_type_field]:
-                            filters.append(
-                                [
-                                    publish_type_field,
-                                    "is",
-                                    sg_publish[publish_type_field],
-                                ]
-                            )
-                        sg_res = []
-                        try:
-                            sg_res = engine.shotgun.find(
-                                sg_publish["type"], filters, []
-                            )
-                        except Exception as e:
-                            raise TankError(
-                                "Failed to query publish versions for publish '%s': %s"
-                                % (sg_publish["name"], e)
-                            )
-                        sg_publish_version_ids = set([res["id"] for res in sg_res])
-
-                    if geo_version_publish_id in sg_publish_version_ids:
-                        # found a matching publish that just differs by version
-                        matches_geo = True
-
-            if matches_geo:
-                # didn't find an exact match for the version but did find the geo
-                # so return that instead:
-                return (geo, None)
-
-        # didn't find a match :(
-        return (None, None)
+                    # didn't find an exact match for the version but did find the geo
+                    # so return that instead:
+                    results[publish_id] = (self.__index.get_geo(geo_name), None)
+                    break
+
+        return results
 
     def list_geometry(self):
         """
@@ -139,16 +204,7 @@ class GeometryManager(object):
         :returns:   A list of dictionaries containing the geo together with any Shotgun metadata
                     that was found on it
         """
-        all_geo = []
-        for geo in mari.geo.list():
-            metadata = self.__md_mgr.get_geo_metadata(geo)
-            if not metadata:
-                continue
-
-            metadata["geo"] = geo
-            all_geo.append(metadata)
-
-        return all_geo
+        return self.__index.list_geometry()
 
     def list_geometry_versions(self, geo):
         """
@@ -170,6 +226,93 @@ class GeometryManager(object):
 
         return all_geo_versions
 
+    def list_outdated_geometry(self):
+        """
+        Find all Shotgun aware geometry in the scene whose current version was loaded from
+        a publish that isn't the latest version of that publish.  The latest versions of
+        all publishes are found with a single Shotgun query.
+
+        :returns:   A list of dictionaries, in project order, containing the "geo", its
+                    current "geo_version", the "sg_publish" the current version was loaded
+                    from and the "latest" version of that publish
+        """
+        with get_profiler().span("list_outdated_geometry", "engine"):
+            return self.__list_outdated_geometry()
+
+    def __list_outdated_geometry(self):
+        """
+        Implementation of list_outdated_geometry()
+
+        :returns:   A list of dictionaries containing the outdated geometry
+        """
+        engine = sgtk.platform.current_bundle()
+
+        # find the publish each geo's current version was loaded from:
+        current_versions = []
+        for geo_info in self.__index.list_geometry():
+            geo = geo_info["geo"]
+            version_publish_ids = self.__index.get_version_publish_ids(geo.name())
+            if not version_publish_ids:
+                continue
+            geo_version = geo.currentVersion()
+            if not geo_version:
+                continue
+            publish_id = version_publish_ids.get(geo_version.name())
+            if publish_id is not None:
+                current_versions.append((geo, geo_version, publish_id))
+
+        if not current_versions:
+            return []
+
+        # ensure that the publishes contain the information we need:
+        publish_entity_type = sgtk.util.get_published_file_entity_type(engine.sgtk)
+        sg_publishes = {}
+        for _, _, publish_id in current_versions:
+            sg_publishes[publish_id] = {"type": publish_entity_type, "id": publish_id}
+        update_publish_records(
+            list(sg_publishes.values()),
+            min_fields=get_required_publish_fields() + ["version_number"],
+        )
+
+        # publishes that no longer exist won't have been updated:
+        existing_publishes = [
+            sg_publish for sg_publish in sg_publishes.values() if "name" in sg_publish
+        ]
+        latest_publishes = find_latest_publishes(existing_publishes)
+
+        outdated = []
+        for geo, geo_version, publish_id in current_versions:
+            sg_publish = sg_publishes[publish_id]
+            sg_latest = latest_publishes.get(publish_id)
+            # only a strictly newer version is an update - another publish with
+            # the same version number isn't:
+            if not sg_latest or (sg_latest.get("version_number") or 0) <= (
+                sg_publish.get("version_number") or 0
+            ):
+                continue
+            outdated.append(
+                {
+                    "geo": geo,
+                    "geo_version": geo_version,
+                    "sg_publish": sg_publish,
+                    "latest": sg_latest,
+                }
+            )
+        return outdated
+
+    def get_load_path(self, publish_path):
+        """
+        Get the path that the specified publish file should be loaded from.  This is
+        a local copy of the file if the local geometry cache is enabled, otherwise
+        it's the publish path itself.
+
+        :param publish_path:    The path of the publish file
+        :returns:               The path to pass to Mari when loading the file
+        """
+        if not self.__file_cache:
+            return publish_path
+        return self.__file_cache.get_local_path(publish_path)
+
     def load_geometry(self, sg_publish, options, objects_to_load):
         """
         Wraps the Mari GeoManager.load() method and additionally tags newly loaded geometry with Shotgun
@@ -195,15 +338,21 @@ class GeometryManager(object):
             # (AD) Note - passing options as a named parameter (e.g. options=options) seems to
             # stop any channels specified in the options list from being created so just pass
             # as indexed parameters instead!
-            new_geo = mari.geo.load(publish_path, options, objects_to_load)
+            load_path = self.get_load_path(publish_path)
+            with get_profiler().span("mari.geo.load", "mari", path=load_path):
+                new_geo = mari.geo.load(load_path, options, objects_to_load)
         except Exception as e:
             raise TankError(
                 "Failed to load published geometry from '%s': %s" % (publish_path, e)
             )
 
-        # and initialize all new geo:
+        # and initialize all new geo, naming them all from a single snapshot of
+        # the existing geo names:
+        name_allocator = GeometryNameAllocator()
         for geo in new_geo:
-            self.initialise_new_geometry(geo, publish_path, sg_publish)
+            self.initialise_new_geometry(
+                geo, publish_path, sg_publish, name_allocator=name_allocator
+            )
 
         return new_geo
 
@@ -231,6 +380,139 @@ class GeometryManager(object):
         if not publish_path or not os.path.exists(publish_path):
             raise TankError("Publish '%s' couldn't be found on disk!" % publish_path)
 
+        return self.__add_geometry_version(geo, sg_publish, publish_path, options)
+
+    def add_geometry_versions(
+        self, geo_publishes, options=None, set_current=True, progress_callback=None
+    ):
+        """
+        Add a new version to each of the specified geometry, e.g. to update them all to the
+        latest version of their publishes.  This is equivalent to calling add_geometry_version()
+        for each geo but the publish records are resolved with a single Shotgun query and all
+        publish paths are checked in parallel before any versions are added.  A failure to add
+        one version doesn't stop the remaining versions from being added.
+
+        :param geo_publishes:       A list of (geo, sg_publish) tuples containing the Mari GeoEntity
+                                    to add a version to and the publish to load as the new version.
+                                    Each publish should be a Shotgun entity dictionary containing at
+                                    least the entity "type" and "id".
+        :param options:             [Mari arg] - Options to be passed to the file loader when loading
+                                    the geometry.  The options will default to the options that were
+                                    used to load the current version if not specified.
+        :param set_current:         If True then each new version is made the current version of its
+                                    geo
+        :param progress_callback:   An optional callable that is called before each version is added
+                                    with the number of versions processed so far, the total number of
+                                    versions and the geo.  If it returns False then the operation is
+                                    cancelled and no further versions are added.
+        :returns:                   A list containing a dictionary for each (geo, sg_publish) tuple, in
+                                    the order specified, with the "geo", "sg_publish", the "geo_version"
+                                    if one was added or already exists, the "status" - one of
+                                    "added", "exists", "failed" or "cancelled" - and an "error"
+                                    message if the version couldn't be added
+        """
+        with get_profiler().span(
+            "add_geometry_versions", "engine", count=len(geo_publishes)
+        ):
+            return self.__add_geometry_versions(
+                geo_publishes, options, set_current, progress_callback
+            )
+
+    def __add_geometry_versions(
+        self, geo_publishes, options, set_current, progress_callback
+    ):
+        """
+        Implementation of add_geometry_versions()
+
+        :param geo_publishes:       A list of (geo, sg_publish) tuples
+        :param options:             [Mari arg] - Options to be passed to the file loader
+        :param set_current:         If True then each new version is made current
+        :param progress_callback:   An optional callable used to report progress and cancel
+        :returns:                   A list of result dictionaries
+        """
+        results = [
+            {
+                "geo": geo,
+                "sg_publish": sg_publish,
+                "geo_version": None,
+                "status": None,
+                "error": None,
+            }
+            for geo, sg_publish in geo_publishes
+        ]
+        if not results:
+            return results
+
+        # ensure that all publishes contain the information we need:
+        update_publish_records(
+            [sg_publish for _, sg_publish in geo_publishes],
+            min_fields=["id", "path", "version_number"],
+        )
+
+        # and that all publish files exist:
+        publish_paths = [
+            self.__get_publish_path(sg_publish) for _, sg_publish in geo_publishes
+        ]
+        missing_paths = set(find_missing_paths(publish_paths))
+
+        cancelled = False
+        for i, (result, publish_path) in enumerate(zip(results, publish_paths)):
+            geo = result["geo"]
+            sg_publish = result["sg_publish"]
+
+            if not cancelled and progress_callback:
+                cancelled = progress_callback(i, len(results), geo) is False
+            if cancelled:
+                result["status"] = "cancelled"
+                continue
+
+            if not publish_path or publish_path in missing_paths:
+                result["status"] = "failed"
+                result["error"] = (
+                    "Publish '%s' couldn't be found on disk!" % publish_path
+                )
+                continue
+
+            try:
+                # skip geo that already has a version loaded from the publish:
+                existing_geo, geo_version = self.__index.find_publish(sg_publish["id"])
+                if existing_geo and existing_geo.name() == geo.name():
+                    result["status"] = "exists"
+                else:
+                    geo_version = self.__add_geometry_version(
+                        geo, sg_publish, publish_path, options
+                    )
+                    result["status"] = "added"
+                result["geo_version"] = geo_version
+
+                current_version = geo.currentVersion()
+                if set_current and (
+                    not current_version or current_version.name() != geo_version.name()
+                ):
+                    with get_profiler().span("GeoEntity.setCurrentVersion", "mari"):
+                        geo.setCurrentVersion(geo_version.name())
+            except TankError as e:
+                result["status"] = "failed"
+                result["error"] = str(e)
+            except Exception as e:
+                result["status"] = "failed"
+                result["error"] = "Failed to update '%s': %s" % (geo.name(), e)
+
+        if progress_callback and not cancelled:
+            progress_callback(len(results), len(results), None)
+
+        return results
+
+    def __add_geometry_version(self, geo, sg_publish, publish_path, options):
+        """
+        Add a version that has been checked to exist on disk to a geometry.
+
+        :param geo:             The Mari GeoEntity to add a version to
+        :param sg_publish:      The publish to load as a new version
+        :param publish_path:    The path of the publish file
+        :param options:         [Mari arg] - Options to be passed to the file loader
+        :returns:               The new GeoEntityVersion instance
+        """
         # determine the name of the new version:
         version = sg_publish.get("version_number")
         version_name = "v%03d" % (version or 0)
@@ -242,7 +524,9 @@ class GeometryManager(object):
 
         # add the version
         try:
-            geo.addVersion(publish_path, version_name, options)
+            load_path = self.get_load_path(publish_path)
+            with get_profiler().span("GeoEntity.addVersion", "mari", path=load_path):
+                geo.addVersion(load_path, version_name, options)
         except Exception as e:
             raise TankError(
                 "Failed to load published geometry version from '%s': %s"
@@ -259,18 +543,34 @@ class GeometryManager(object):
         geo_version = geo.version(version_name)
 
         # initialise the version:
-        self.initialise_new_geometry_version(geo_version, publish_path, sg_publish)
+        self.initialise_new_geometry_version(geo_version, publish_path, sg_publish, geo)
 
         return geo_version
 
-    def initialise_new_geometry(self, geo, publish_path, sg_publish):
+    def initialise_new_geometry(
+        self,
+        geo,
+        publish_path,
+        sg_publish,
+        metadata_updates=None,
+        name_allocator=None,
+    ):
         """
         Initialise a new geometry.  This sets the name and updates the Shotgun metadata.
 
-        :param geo:             The geometry to initialise
-        :param publish_path:    The path of the publish this geometry was loaded from
-        :param sg_publish:      The Shotgun publish record for this geometry.  This should be a Shotgun
-                                entity dictionary containing at least the entity "type" and "id".
+        :param geo:                 The geometry to initialise
+        :param publish_path:        The path of the publish this geometry was loaded from
+        :param sg_publish:          The Shotgun publish record for this geometry.  This should be a
+                                    Shotgun entity dictionary containing at least the entity "type"
+                                    and "id".
+        :param metadata_updates:    If specified, the metadata isn't written to the geometry but is
+                                    instead added to this dictionary of keyword arguments for
+                                    MetadataManager.apply_metadata() so that the caller can write the
+                                    metadata for many entities in one go.  The caller is then also
+                                    responsible for rebuilding the geometry index.
+        :param name_allocator:      The GeometryNameAllocator to use to make the geometry name unique.
+                                    When initialising many geos, a single allocator should be shared
+                                    between them.  If None then a new allocator is created.
         """
         # determine the name to use:
         publish_name = sg_publish.get("name")
@@ -287,16 +587,8 @@ class GeometryManager(object):
 
         if geo_name != current_name:
             # make sure the name is unique:
-            test_name = geo_name
-            test_index = 1
-            existing_names = mari.geo.names()
-            while True:
-                if test_name not in existing_names:
-                    # have unique name!
-                    break
-                test_name = "%s_%d" % (geo_name, test_index)
-                test_index += 1
-            geo_name = test_name
+            name_allocator = name_allocator or GeometryNameAllocator()
+            geo_name = name_allocator.allocate(geo_name, current_name)
 
             # set the geo name:
             if geo_name != current_name:
@@ -306,7 +598,13 @@ class GeometryManager(object):
         sg_project = sg_publish.get("project")
         sg_entity = sg_publish.get("entity")
         sg_task = sg_publish.get("task")
-        self.__md_mgr.set_geo_metadata(geo, sg_project, sg_entity, sg_task)
+        if metadata_updates is not None:
+            metadata_updates.setdefault("geo_updates", []).append(
+                (geo, sg_project, sg_entity, sg_task)
+            )
+        else:
+            self.__md_mgr.set_geo_metadata(geo, sg_project, sg_entity, sg_task)
+            self.__index.update_geo(geo)
 
         # there should be a single version for the geo:
         geo_versions = geo.versionList()
@@ -317,16 +615,27 @@ class GeometryManager(object):
             )
 
         # finally, initialize the geometry version:
-        self.initialise_new_geometry_version(geo_versions[0], publish_path, sg_publish)
+        self.initialise_new_geometry_version(
+            geo_versions[0], publish_path, sg_publish, geo, metadata_updates
+        )
 
-    def initialise_new_geometry_version(self, geo_version, publish_path, sg_publish):
+    def initialise_new_geometry_version(
+        self, geo_version, publish_path, sg_publish, geo=None, metadata_updates=None
+    ):
         """
         Initialise a new geometry version.  This sets the name and updates the Shotgun metadata.
 
-        :param geo_version:     The geometry version to initialise
-        :param publish_path:    The path of the publish this geometry was loaded from
-        :param sg_publish:      The Shotgun publish record for this geometry version.  This should be a
-                                Shotgun entity dictionary containing at least the entity "type" and "id".
+        :param geo_version:         The geometry version to initialise
+        :param publish_path:        The path of the publish this geometry was loaded from
+        :param sg_publish:          The Shotgun publish record for this geometry version.  This should
+                                    be a Shotgun entity dictionary containing at least the entity "type"
+                                    and "id".
+        :param geo:                 The geometry the version belongs to.  If specified, the geometry
+                                    index is updated in place, otherwise it's invalidated and rebuilt on
+                                    next use.
+        :param metadata_updates:    If specified, the metadata is added to this dictionary of keyword
+                                    arguments for MetadataManager.apply_metadata() rather than being
+                                    written to the geometry version - see initialise_new_geometry().
         """
         sg_publish_id = sg_publish.get("id")
         sg_version = sg_publish.get("version_number")
@@ -337,9 +646,15 @@ class GeometryManager(object):
             geo_version.setName(geo_version_name)
 
         # and store metadata:
-        self.__md_mgr.set_geo_version_metadata(
-            geo_version, publish_path, sg_publish_id, sg_version
-        )
+        if metadata_updates is not None:
+            metadata_updates.setdefault("geo_version_updates", []).append(
+                (geo_version, publish_path, sg_publish_id, sg_version)
+            )
+        else:
+            self.__md_mgr.set_geo_version_metadata(
+                geo_version, publish_path, sg_publish_id, sg_version
+            )
+            self.__index.update_geo_version(geo, geo_version, sg_publish_id)
 
     def __get_publish_path(self, sg_publish):
         """
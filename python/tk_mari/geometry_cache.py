@@ -0,0 +1,224 @@
+# Copyright (c) 2014 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Local disk cache for geometry publishes stored on network storage
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import sgtk
+
+from .timing import get_profiler
+
+
+class GeometryFileCache(object):
+    """
+    Content-addressed cache of geometry publish files on local disk.
+
+    Each cached file is stored as '<root>/<sha256>/<original file name>' so that
+    identical content is only stored once while the file name Mari sees when
+    loading the geometry is unchanged.  An index maps each source path, size and
+    modification time to the digest of its content so that the source file only
+    needs to be stat'ed to find its cached copy.  The least recently used files
+    are evicted once the cache grows beyond its maximum size.
+    """
+
+    # Name of the index file in the cache root:
+    __INDEX_FILE = "index.json"
+    # Size of each read when copying and hashing files:
+    __CHUNK_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, root, max_size):
+        """
+        Construction
+
+        :param root:        The root directory of the cache on local disk
+        :param max_size:    The maximum size of the cache in bytes
+        """
+        self.root = root
+        self.max_size = max_size
+        self.__lock = threading.Lock()
+
+    def get_local_path(self, path):
+        """
+        Get the path of a local copy of the specified file, copying it into the
+        cache first if needed.  If the file can't be cached for any reason then
+        the original path is returned.
+
+        :param path:    The path of the source file
+        :returns:       The path to load the file from
+        """
+        engine = sgtk.platform.current_bundle()
+        try:
+            with self.__lock:
+                return self.__get_local_path(path)
+        except Exception as e:
+            engine.log_warning(
+                "Failed to cache '%s' in '%s' - it will be loaded from its "
+                "original location: %s" % (path, self.root, e)
+            )
+            return path
+
+    def __get_local_path(self, path):
+        """
+        Get the path of a local copy of the specified file, copying it into the
+        cache first if needed.  Must be called with the lock held.
+
+        :param path:    The path of the source file
+        :returns:       The path of the local copy
+        """
+        engine = sgtk.platform.current_bundle()
+        stat = os.stat(path)
+        file_name = os.path.basename(path)
+        index = self.__read_index()
+
+        entry = index.get(path)
+        if (
+            entry
+            and entry.get("size") == stat.st_size
+            and entry.get("mtime") == stat.st_mtime
+        ):
+            local_path = os.path.join(self.root, entry["digest"], file_name)
+            if os.path.isfile(local_path):
+                # touch the file so that it's the most recently used:
+                os.utime(local_path, None)
+                engine.log_debug("Loading '%s' from cache: %s" % (path, local_path))
+                return local_path
+
+        # copy the file into the cache:
+        engine.log_debug("Caching '%s' in '%s'..." % (path, self.root))
+        with get_profiler().span("GeometryFileCache.copy", "io", path=path):
+            digest = self.__copy_to_cache(path, file_name)
+
+        index[path] = {"size": stat.st_size, "mtime": stat.st_mtime, "digest": digest}
+        self.__evict(index, keep_digest=digest)
+        self.__write_index(index)
+
+        return os.path.join(self.root, digest, file_name)
+
+    def __copy_to_cache(self, path, file_name):
+        """
+        Copy a file into the cache.  The file is hashed whilst being copied to a
+        temporary file which is then verified against the hash before being
+        renamed into place.
+
+        :param path:        The path of the source file
+        :param file_name:   The name to store the file under
+        :returns:           The sha256 digest of the file content
+        """
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+        source_hash = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as dst, open(path, "rb") as src:
+                while True:
+                    chunk = src.read(GeometryFileCache.__CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    source_hash.update(chunk)
+                    dst.write(chunk)
+            digest = source_hash.hexdigest()
+
+            # verify the local copy:
+            if self.__hash_file(tmp_path) != digest:
+                raise IOError("Checksum mismatch for local copy of '%s'" % path)
+
+            digest_dir = os.path.join(self.root, digest)
+            if not os.path.isdir(digest_dir):
+                os.makedirs(digest_dir)
+            os.replace(tmp_path, os.path.join(digest_dir, file_name))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        return digest
+
+    def __hash_file(self, path):
+        """
+        :param path:    The path of the file to hash
+        :returns:       The sha256 digest of the file content
+        """
+        file_hash = hashlib.sha256()
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(GeometryFileCache.__CHUNK_SIZE)
+                if not chunk:
+                    break
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    def __evict(self, index, keep_digest=None):
+        """
+        Remove the least recently used files until the cache is within its size
+        limit and drop index entries for files that are no longer cached.
+
+        :param index:       The cache index to update
+        :param keep_digest: The digest of a file that must not be evicted
+        """
+        cached_files = []
+        total_size = 0
+        for digest in os.listdir(self.root):
+            digest_dir = os.path.join(self.root, digest)
+            if not os.path.isdir(digest_dir):
+                continue
+            for file_name in os.listdir(digest_dir):
+                file_path = os.path.join(digest_dir, file_name)
+                stat = os.stat(file_path)
+                cached_files.append((stat.st_mtime, stat.st_size, digest, file_path))
+                total_size += stat.st_size
+
+        # oldest files first:
+        cached_files.sort()
+        for _, size, digest, file_path in cached_files:
+            if total_size <= self.max_size:
+                break
+            if digest == keep_digest:
+                continue
+            os.remove(file_path)
+            digest_dir = os.path.dirname(file_path)
+            if not os.listdir(digest_dir):
+                os.rmdir(digest_dir)
+            total_size -= size
+
+        existing_digests = set(os.listdir(self.root))
+        for path, entry in list(index.items()):
+            if entry.get("digest") not in existing_digests:
+                del index[path]
+
+    def __read_index(self):
+        """
+        :returns:   The cache index or an empty index if it doesn't exist or
+                    can't be read
+        """
+        index_path = os.path.join(self.root, GeometryFileCache.__INDEX_FILE)
+        try:
+            with open(index_path, "r") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def __write_index(self, index):
+        """
+        Atomically write the cache index.
+
+        :param index:   The index to write
+        """
+        index_path = os.path.join(self.root, GeometryFileCache.__INDEX_FILE)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp_")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
@@ -0,0 +1,490 @@
+# Copyright (c) 2014 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+In-memory index of the Shotgun aware geometry in the current Mari project
+"""
+
+import mari
+
+from .timing import get_profiler
+
+
+class GeometryIndex(object):
+    """
+    Maintains a per-project index of all Shotgun aware geometry and geometry
+    versions so that lookups by publish id, entity or task don't have to walk
+    every geo & version and read their metadata through the Mari API.
+
+    The index is built once when a project is opened and then kept current
+    from the Mari geo signals as well as explicitly by the GeometryManager
+    whenever it initialises new geometry or geometry versions.
+
+    Entries are keyed by name as Mari guarantees that geo names are unique in
+    a project and that version names are unique for a geo.
+    """
+
+    # Signals emitted by the Mari GeoManager mapped to the index slots:
+    __GEO_MANAGER_SIGNALS = {
+        "entityAdded": "_on_geo_added",
+        "entityRemoved": "_on_geo_removed",
+    }
+
+    # Signals emitted by Mari GeoEntity instances that the index listens to:
+    __GEO_SIGNALS = ["nameChanged", "versionAdded", "versionRemoved"]
+
+    def __init__(self, md_mgr):
+        """
+        Construction
+
+        :param md_mgr:  The MetadataManager instance used to read geo and
+                        geo version metadata
+        """
+        self.__md_mgr = md_mgr
+        self.__is_built = False
+        self.__connected = False
+
+        # geo name -> {"geo", "metadata", "versions": {version name: publish id}}
+        self.__geos = {}
+        # publish id -> (geo name, version name)
+        self.__publish_ids = {}
+        # (entity type, entity id) -> set of geo names
+        self.__entity_geos = {}
+        # task id -> set of geo names
+        self.__task_geos = {}
+        # list of (signal, slot, owner geo) tuples for all signal connections made:
+        self.__connections = []
+
+    @property
+    def is_built(self):
+        """
+        :returns:   True if the index has been built for the current project
+        """
+        return self.__is_built
+
+    def connect(self):
+        """
+        Connect to the Mari GeoManager signals so that the index is kept up to
+        date as geometry is added to and removed from the project, and to the
+        project closed signal so the index is cleared with the project.
+        """
+        if self.__connected:
+            return
+        self.__connected = True
+        for signal_name, slot_name in GeometryIndex.__GEO_MANAGER_SIGNALS.items():
+            self.__connect_signal(mari.geo, signal_name, getattr(self, slot_name))
+        self.__connect_signal(mari.projects, "closed", self._on_project_closed)
+
+    def disconnect(self):
+        """
+        Disconnect from all Mari signals and clear the index.
+        """
+        for signal, slot, _ in self.__connections:
+            try:
+                mari.utils.disconnect(signal, slot)
+            except Exception:
+                # the object emitting the signal may have been destroyed
+                pass
+        self.__connections = []
+        self.__connected = False
+        self.__clear()
+        self.__md_mgr.clear_snapshot()
+
+    def invalidate(self):
+        """
+        Invalidate the index.  It will be rebuilt the next time it's used.
+        """
+        self.__disconnect_geo_signals()
+        self.__clear()
+        self.__md_mgr.clear_snapshot()
+
+    def rebuild(self):
+        """
+        Rebuild the index from the geometry in the current project.
+        """
+        self.__disconnect_geo_signals()
+        self.__clear()
+
+        # read all metadata for the project in a single pass and build the
+        # index from the snapshot:
+        with get_profiler().span("GeometryIndex.rebuild", "mari"):
+            self.__md_mgr.refresh_snapshot()
+            for geo, metadata, versions in self.__md_mgr.get_snapshot_geometry():
+                self.__add_geo(geo, metadata, index_versions=False)
+                geo_name = geo.name()
+                for geo_version, version_md in versions:
+                    publish_id = version_md.get("publish_id")
+                    if publish_id is not None:
+                        self.__add_version(geo_name, geo_version.name(), publish_id)
+        self.__is_built = True
+
+    def list_geometry(self):
+        """
+        List all Shotgun aware geometry in the index.
+
+        :returns:   A list of dictionaries containing the geo together with any
+                    Shotgun metadata that was found on it
+        """
+        self.__ensure_built()
+        all_geo = []
+        for geo_name in self.__geo_order():
+            entry = self.__geos[geo_name]
+            if not entry["metadata"]:
+                continue
+            metadata = dict(entry["metadata"])
+            metadata["geo"] = entry["geo"]
+            all_geo.append(metadata)
+        return all_geo
+
+    def find_publish(self, publish_id):
+        """
+        Find the geo and geo version that were loaded from the specified publish.
+
+        :param publish_id:  The id of the publish to look for
+        :returns:           Tuple containing the geo and geo version if found,
+                            otherwise (None, None)
+        """
+        self.__ensure_built()
+        geo, geo_version = self.__resolve_publish(publish_id)
+        if not geo_version and publish_id in self.__publish_ids:
+            # the index is out of sync with the project so rebuild it
+            # and try again:
+            self.rebuild()
+            geo, geo_version = self.__resolve_publish(publish_id)
+        if not geo_version:
+            return (None, None)
+        return (geo, geo_version)
+
+    def find_publish_geo(self, publish_id):
+        """
+        Find the geo that contains a version loaded from the specified publish
+        without resolving the version itself.
+
+        :param publish_id:  The id of the publish to look for
+        :returns:           The geo if found, otherwise None
+        """
+        self.__ensure_built()
+        key = self.__publish_ids.get(publish_id)
+        if not key or key[0] not in self.__geos:
+            return None
+        return self.__geos[key[0]]["geo"]
+
+    def find_candidate_geometry(self, entity, task):
+        """
+        Find all geometry that could contain a version of a publish with the
+        specified entity and task.  Geometry is ruled out if it is linked to a
+        different entity or task - geometry without entity or task metadata is
+        always a candidate.
+
+        :param entity:  The Shotgun entity of the publish or None
+        :param task:    The Shotgun task of the publish or None
+        :returns:       A list of geo names in project order
+        """
+        self.__ensure_built()
+        candidates = set(
+            name for name, entry in self.__geos.items() if entry["metadata"]
+        )
+        if entity:
+            linked = set()
+            for geo_names in self.__entity_geos.values():
+                linked.update(geo_names)
+            matching = self.__entity_geos.get((entity["type"], entity["id"]), set())
+            candidates -= linked - matching
+        if task:
+            linked = set()
+            for geo_names in self.__task_geos.values():
+                linked.update(geo_names)
+            matching = self.__task_geos.get(task["id"], set())
+            candidates -= linked - matching
+        return [name for name in self.__geo_order() if name in candidates]
+
+    def get_geo(self, geo_name):
+        """
+        :param geo_name:    The name of the geo to return
+        :returns:           The Mari GeoEntity for the name if it's in the index
+        """
+        self.__ensure_built()
+        entry = self.__geos.get(geo_name)
+        return entry["geo"] if entry else None
+
+    def get_publish_ids(self, geo_name):
+        """
+        :param geo_name:    The name of the geo to return publish ids for
+        :returns:           A list of the publish ids for all Shotgun aware
+                            versions of the geo
+        """
+        self.__ensure_built()
+        entry = self.__geos.get(geo_name)
+        if not entry:
+            return []
+        return list(entry["versions"].values())
+
+    def get_version_publish_ids(self, geo_name):
+        """
+        :param geo_name:    The name of the geo to return publish ids for
+        :returns:           A dictionary of version name to publish id for all
+                            Shotgun aware versions of the geo
+        """
+        self.__ensure_built()
+        entry = self.__geos.get(geo_name)
+        if not entry:
+            return {}
+        return dict(entry["versions"])
+
+    def list_publish_ids(self):
+        """
+        :returns:   A list of the publish ids for all Shotgun aware versions
+                    of all geo in the index
+        """
+        self.__ensure_built()
+        return list(self.__publish_ids.keys())
+
+    def update_geo(self, geo, metadata=None):
+        """
+        Add or update a geo in the index.
+
+        :param geo:         The Mari GeoEntity to add or update
+        :param metadata:    The Shotgun metadata for the geo.  If None then
+                            the metadata will be read from the geo
+        """
+        if not self.__is_built:
+            return
+        geo_name = geo.name()
+        entry = self.__geos.get(geo_name)
+        versions = dict(entry["versions"]) if entry else {}
+        self.__remove_geo_named(geo_name)
+        self.__add_geo(geo, metadata, index_versions=False)
+        for version_name, publish_id in versions.items():
+            self.__add_version(geo_name, version_name, publish_id)
+
+    def update_geo_version(self, geo, geo_version, publish_id):
+        """
+        Add or update a geo version in the index.
+
+        :param geo:         The Mari GeoEntity the version belongs to.  If None
+                            then the index will be invalidated instead
+        :param geo_version: The Mari GeoEntityVersion to add or update
+        :param publish_id:  The id of the publish the version was loaded from
+        """
+        if not self.__is_built:
+            return
+        if geo is None:
+            self.invalidate()
+            return
+
+        geo_name = geo.name()
+        if geo_name not in self.__geos:
+            self.__add_geo(geo, index_versions=False)
+        self.__add_version(geo_name, geo_version.name(), publish_id)
+
+    def _on_geo_added(self, geo):
+        """
+        Called when a geo is added to the current project.
+        """
+        if self.__is_built and geo:
+            self.__remove_geo_named(geo.name())
+            self.__add_geo(geo)
+
+    def _on_geo_removed(self, geo):
+        """
+        Called when a geo is removed from the current project.  The geo may be
+        in the process of being destroyed so the index is synced with the list
+        of geo names in the project rather than by querying the geo.
+        """
+        if not self.__is_built:
+            return
+        existing_names = set(mari.geo.names()) if mari.projects.current() else set()
+        for geo_name in list(self.__geos.keys()):
+            if geo_name not in existing_names:
+                self.__remove_geo_named(geo_name)
+
+    def _on_project_closed(self, *args):
+        """
+        Called when the current project is closed.  Invalidating the index also
+        clears the metadata snapshot so no records for the closed project's objects
+        are kept alive.
+        """
+        self.invalidate()
+
+    def __resolve_publish(self, publish_id):
+        """
+        Look up the geo and geo version for a publish in the index.
+
+        :param publish_id:  The id of the publish to look for
+        :returns:           Tuple containing the geo and geo version.  Either may
+                            be None if the publish isn't in the index or the
+                            indexed geometry no longer exists
+        """
+        key = self.__publish_ids.get(publish_id)
+        if not key:
+            return (None, None)
+        geo_name, version_name = key
+        entry = self.__geos.get(geo_name)
+        if not entry:
+            return (None, None)
+        geo = entry["geo"]
+        try:
+            geo_version = geo.version(version_name)
+        except Exception:
+            geo_version = None
+        return (geo, geo_version)
+
+    def __ensure_built(self):
+        """
+        Make sure the index has been built for the current project.
+        """
+        if not self.__is_built:
+            self.rebuild()
+
+    def __clear(self):
+        """
+        Clear all entries from the index.
+        """
+        self.__geos = {}
+        self.__publish_ids = {}
+        self.__entity_geos = {}
+        self.__task_geos = {}
+        self.__is_built = False
+
+    def __geo_order(self):
+        """
+        :returns:   The names of all geo in the index in insertion order
+        """
+        return list(self.__geos.keys())
+
+    def __add_geo(self, geo, metadata=None, index_versions=True):
+        """
+        Add a geo and optionally all of its versions to the index.
+
+        :param geo:             The Mari GeoEntity to add
+        :param metadata:        The Shotgun metadata for the geo.  If None then
+                                the metadata will be read from the geo
+        :param index_versions:  If True then all versions of the geo will be
+                                added to the index as well
+        """
+        geo_name = geo.name()
+        if metadata is None:
+            metadata = self.__md_mgr.get_geo_metadata(geo)
+
+        self.__geos[geo_name] = {"geo": geo, "metadata": metadata, "versions": {}}
+
+        entity = metadata.get("entity")
+        if entity:
+            key = (entity["type"], entity["id"])
+            self.__entity_geos.setdefault(key, set()).add(geo_name)
+        task = metadata.get("task")
+        if task:
+            self.__task_geos.setdefault(task["id"], set()).add(geo_name)
+
+        if index_versions:
+            for geo_version in geo.versionList():
+                version_md = self.__md_mgr.get_geo_version_metadata(geo_version)
+                publish_id = version_md.get("publish_id")
+                if publish_id is not None:
+                    self.__add_version(geo_name, geo_version.name(), publish_id)
+
+        self.__connect_geo_signals(geo)
+
+    def __add_version(self, geo_name, version_name, publish_id):
+        """
+        Add a geo version to the index.
+
+        :param geo_name:        The name of the geo the version belongs to
+        :param version_name:    The name of the version
+        :param publish_id:      The id of the publish the version was loaded from
+        """
+        versions = self.__geos[geo_name]["versions"]
+        previous_id = versions.get(version_name)
+        if previous_id is not None and previous_id != publish_id:
+            self.__publish_ids.pop(previous_id, None)
+        if publish_id is None:
+            versions.pop(version_name, None)
+            return
+        versions[version_name] = publish_id
+        self.__publish_ids[publish_id] = (geo_name, version_name)
+
+    def __remove_geo_named(self, geo_name):
+        """
+        Remove a geo and all of its versions from the index.
+
+        :param geo_name:    The name of the geo to remove
+        """
+        entry = self.__geos.pop(geo_name, None)
+        if not entry:
+            return
+        for publish_id in entry["versions"].values():
+            if self.__publish_ids.get(publish_id, (None,))[0] == geo_name:
+                del self.__publish_ids[publish_id]
+        for lookup in (self.__entity_geos, self.__task_geos):
+            for key in list(lookup.keys()):
+                lookup[key].discard(geo_name)
+                if not lookup[key]:
+                    del lookup[key]
+        self.__disconnect_geo_signals(entry["geo"])
+
+    def __reindex_geo(self, geo):
+        """
+        Re-index a geo after it's been renamed or its versions have changed.
+
+        :param geo: The Mari GeoEntity to re-index
+        """
+        if not self.__is_built:
+            return
+        for geo_name, entry in list(self.__geos.items()):
+            if entry["geo"] is geo:
+                self.__remove_geo_named(geo_name)
+                break
+        self.__add_geo(geo)
+
+    def __connect_geo_signals(self, geo):
+        """
+        Connect to the signals emitted by a geo that affect the index.
+
+        :param geo: The Mari GeoEntity to connect to
+        """
+        slot = lambda *args: self.__reindex_geo(geo)
+        for signal_name in GeometryIndex.__GEO_SIGNALS:
+            self.__connect_signal(geo, signal_name, slot, owner=geo)
+
+    def __disconnect_geo_signals(self, geo=None):
+        """
+        Disconnect from the signals emitted by one or all geos.
+
+        :param geo: The Mari GeoEntity to disconnect from.  If None then all
+                    geo signals are disconnected
+        """
+        remaining = []
+        for connection in self.__connections:
+            signal, slot, owner = connection
+            if owner is None or (geo is not None and owner is not geo):
+                remaining.append(connection)
+                continue
+            try:
+                mari.utils.disconnect(signal, slot)
+            except Exception:
+                # the geo may have been destroyed
+                pass
+        self.__connections = remaining
+
+    def __connect_signal(self, obj, signal_name, slot, owner=None):
+        """
+        Connect a slot to a Mari signal if the signal is available in the
+        running version of Mari.
+
+        :param obj:         The Mari object that emits the signal
+        :param signal_name: The name of the signal to connect to
+        :param slot:        The callable to connect
+        :param owner:       The geo that owns the connection if any
+        """
+        signal = getattr(obj, signal_name, None)
+        if signal is None:
+            return
+        mari.utils.connect(signal, slot)
+        self.__connections.append((signal, slot, owner))
@@ -44,8 +44,49 @@ for geo in mari.geo.list():
         print "     - %s" % geo_version.metadata("tk_version")
 """
 
+import json
+
 import mari
 
+from .timing import get_profiler
+
+
+class _MetadataRecord(object):
+    """
+    Compact record of the Toolkit metadata read from a single Mari object
+    as part of a project metadata snapshot.
+    """
+
+    __slots__ = (
+        "obj",
+        "metadata",
+        "attributes",
+        "legacy_values",
+        "has_payload",
+        "payload_data",
+    )
+
+    def __init__(self, obj, metadata, legacy_values, has_payload, payload_data=None):
+        """
+        Construction
+
+        :param obj:             The Mari object the metadata was read from
+        :param metadata:        Dictionary of all Toolkit metadata found on the object
+                                keyed by name without the 'tk_' prefix, with values in
+                                the payload taking precedence
+        :param legacy_values:   Dictionary of the values stored as individual 'tk_*'
+                                metadata entries
+        :param has_payload:     True if the object has a 'tk_payload' metadata entry
+        :param payload_data:    Dictionary of the values stored in the payload
+        """
+        self.obj = obj
+        self.metadata = metadata
+        self.legacy_values = legacy_values
+        self.has_payload = has_payload
+        self.payload_data = payload_data or {}
+        # (display name, flags) for each metadata name, populated lazily:
+        self.attributes = {}
+
 
 class MetadataManager(object):
     """
@@ -131,11 +172,179 @@ class MetadataManager(object):
         },
     }
 
-    def __init__(self):
+    # Shotgun metadata definition for a published Mari Channel or Layer
+    __TEXTURE_METADATA_INFO = {
+        "texture_fingerprint": {
+            "display_name": "Flow Production Tracking Texture Fingerprint",
+            "visible": False,
+        },
+        "texture_version": {
+            "display_name": "Flow Production Tracking Texture Version",
+            "visible": True,
+        },
+        "texture_path": {
+            "display_name": "Flow Production Tracking Texture Path",
+            "visible": True,
+            "default_value": "",
+        },
+    }
+
+    # Prefix used for the names of all Toolkit metadata:
+    __METADATA_PREFIX = "tk_"
+
+    # Supported metadata encodings.  The legacy encoding stores each value as an
+    # individual 'tk_*' metadata entry whilst the payload encoding stores all values
+    # for an object in a single serialized 'tk_payload' entry:
+    LEGACY_ENCODING = "legacy"
+    PAYLOAD_ENCODING = "payload"
+
+    # Name and definition of the metadata entry used by the payload encoding:
+    __PAYLOAD_NAME = "payload"
+    __PAYLOAD_DETAILS = {
+        "display_name": "Flow Production Tracking Data",
+        "visible": False,
+    }
+    # Version of the payload format written:
+    __PAYLOAD_VERSION = 1
+
+    def __init__(self, encoding=LEGACY_ENCODING):
         """
         Construction
+
+        :param encoding:    The encoding to use when writing metadata, either
+                            LEGACY_ENCODING or PAYLOAD_ENCODING.  Metadata in
+                            either encoding is always readable.
         """
-        pass
+        if encoding not in (
+            MetadataManager.LEGACY_ENCODING,
+            MetadataManager.PAYLOAD_ENCODING,
+        ):
+            raise ValueError("Unsupported metadata encoding '%s'" % encoding)
+        self.__encoding = encoding
+
+        # snapshot of the metadata for the current project keyed by the id of
+        # the Mari object.  The records hold a reference to their object so the
+        # id can't be reused while the snapshot is alive.  PythonQt may return a
+        # new wrapper for the same Mari object on each call so lookups also check
+        # the record is for the same wrapper, and the snapshot is only ever
+        # populated by refresh_snapshot() so it can't grow between refreshes.
+        self.__snapshot = None
+        # (geo record, [geo version records]) for all geometry in project order:
+        self.__snapshot_geometry = []
+
+    def refresh_snapshot(self):
+        """
+        Read all Toolkit metadata for the current project, its geometry and
+        all geometry versions in a single pass.  Until the snapshot is cleared,
+        metadata for these objects is served from the snapshot rather than being
+        read through the Mari API.  Metadata written through this manager keeps
+        the snapshot up to date.
+        """
+        snapshot = {}
+        snapshot_geometry = []
+        project = mari.projects.current()
+        if project:
+            with get_profiler().span("MetadataManager.refresh_snapshot", "mari"):
+                self.__add_to_snapshot(snapshot, project)
+                for geo in mari.geo.list():
+                    geo_record = self.__add_to_snapshot(snapshot, geo)
+                    version_records = [
+                        self.__add_to_snapshot(snapshot, geo_version)
+                        for geo_version in geo.versionList()
+                    ]
+                    snapshot_geometry.append((geo_record, version_records))
+        self.__snapshot = snapshot
+        self.__snapshot_geometry = snapshot_geometry
+
+    def migrate_project_metadata(self, encoding=None):
+        """
+        Convert the Toolkit metadata on the current project, all of its geometry and
+        all geometry versions to the specified encoding, removing the metadata entries
+        used by the other encoding.
+
+        :param encoding:    The encoding to migrate to.  If None then the encoding
+                            this manager was constructed with is used
+        :returns:           The number of Mari objects that were migrated
+        """
+        encoding = encoding or self.__encoding
+        project = mari.projects.current()
+        if not project:
+            return 0
+
+        to_migrate = [(project, MetadataManager.__PROJECT_METADATA_INFO)]
+        for geo in mari.geo.list():
+            to_migrate.append((geo, MetadataManager.__GEO_METADATA_INFO))
+            for geo_version in geo.versionList():
+                to_migrate.append(
+                    (geo_version, MetadataManager.__GEO_VERSION_METADATA_INFO)
+                )
+
+        num_migrated = 0
+        for obj, md_details in to_migrate:
+            record = self.__get_record(obj)
+            if encoding == MetadataManager.PAYLOAD_ENCODING:
+                if not record.legacy_values:
+                    continue
+                values = dict(
+                    (name, value)
+                    for name, value in record.metadata.items()
+                    if name in md_details
+                )
+                self.__write_payload(record, values)
+                for name in list(record.legacy_values):
+                    obj.removeMetadata("tk_%s" % name)
+                    record.attributes.pop(name, None)
+                record.legacy_values.clear()
+            else:
+                if not record.has_payload:
+                    continue
+                for name, value in record.metadata.items():
+                    if name in md_details:
+                        self.__write_entry(record, name, value, md_details[name])
+                obj.removeMetadata("tk_%s" % MetadataManager.__PAYLOAD_NAME)
+                record.attributes.pop(MetadataManager.__PAYLOAD_NAME, None)
+                record.has_payload = False
+                record.payload_data = {}
+            num_migrated += 1
+
+        return num_migrated
+
+    def get_snapshot_geometry(self):
+        """
+        Get the metadata for all geometry and geometry versions in the current project
+        from the snapshot, refreshing the snapshot first if needed.  This doesn't make
+        any further calls through the Mari API.
+
+        :returns:   A list of (geo, geo metadata, versions) tuples in project order where
+                    versions is a list of (geo_version, geo version metadata) tuples.
+                    The metadata is in the same form as returned by get_geo_metadata()
+                    and get_geo_version_metadata().
+        """
+        if self.__snapshot is None:
+            self.refresh_snapshot()
+
+        geo_version_keys = MetadataManager.__GEO_VERSION_METADATA_INFO.keys()
+        all_geo = []
+        for geo_record, version_records in self.__snapshot_geometry:
+            versions = []
+            for version_record in version_records:
+                version_md = dict(
+                    (k, v)
+                    for k, v in version_record.metadata.items()
+                    if k in geo_version_keys
+                )
+                versions.append((version_record.obj, version_md))
+            geo_md = self.__process_geo_metadata(geo_record.metadata)
+            all_geo.append((geo_record.obj, geo_md, versions))
+        return all_geo
+
+    def clear_snapshot(self):
+        """
+        Clear the project metadata snapshot.  Metadata will be read directly
+        through the Mari API until the snapshot is refreshed.
+        """
+        self.__snapshot = None
+        self.__snapshot_geometry = []
 
     def get_metadata(self, mari_entity):
         """
@@ -196,6 +405,38 @@ class MetadataManager(object):
         :param mari_project:    The mari project entity to set the metadata on
         :param ctx:             The context to use when setting the metadata
         """
+        self.__set_metadata(mari_project, *self.__build_project_metadata(ctx))
+
+    def apply_metadata(
+        self, project_updates=None, geo_updates=None, geo_version_updates=None
+    ):
+        """
+        Set the Toolkit metadata on many Mari entities in a single pass.  Each update is
+        a tuple containing the same arguments as the corresponding set_*_metadata method.
+        As with the individual methods, only metadata that differs from the current values
+        is written.
+
+        :param project_updates:     A list of (mari_project, ctx) tuples
+        :param geo_updates:         A list of (geo, project, entity, task) tuples
+        :param geo_version_updates: A list of (geo_version, path, publish_id, version) tuples
+        """
+        for mari_project, ctx in project_updates or []:
+            self.__set_metadata(mari_project, *self.__build_project_metadata(ctx))
+        for geo, project, entity, task in geo_updates or []:
+            self.__set_metadata(geo, *self.__build_geo_metadata(project, entity, task))
+        for geo_version, path, publish_id, version in geo_version_updates or []:
+            self.__set_metadata(
+                geo_version,
+                *self.__build_geo_version_metadata(path, publish_id, version)
+            )
+
+    def __build_project_metadata(self, ctx):
+        """
+        Build the Toolkit metadata to store on a project
+
+        :param ctx: The context to use when building the metadata
+        :returns:   Tuple containing the metadata and the metadata definitions
+        """
         metadata = {}
         metadata["project_id"] = ctx.project["id"]
         if ctx.entity:
@@ -206,9 +447,7 @@ class MetadataManager(object):
         if ctx.task:
             metadata["task_id"] = ctx.task["id"]
 
-        self.__set_metadata(
-            mari_project, metadata, MetadataManager.__PROJECT_METADATA_INFO
-        )
+        return (metadata, MetadataManager.__PROJECT_METADATA_INFO)
 
     def get_project_metadata(self, mari_project):
         """
@@ -230,6 +469,17 @@ class MetadataManager(object):
         :param entity:  The Shotgun entity to use when setting the metadata
         :param task:    The Shotgun task to use when setting the metadata
         """
+        self.__set_metadata(geo, *self.__build_geo_metadata(project, entity, task))
+
+    def __build_geo_metadata(self, project, entity, task):
+        """
+        Build the Toolkit metadata to store on a GeoEntity
+
+        :param project: The Shotgun project to use when building the metadata
+        :param entity:  The Shotgun entity to use when building the metadata
+        :param task:    The Shotgun task to use when building the metadata
+        :returns:       Tuple containing the metadata and the metadata definitions
+        """
         metadata_info = MetadataManager.__GEO_METADATA_INFO.copy()
 
         # define the metadata we want to store:
@@ -248,7 +498,7 @@ class MetadataManager(object):
             metadata["task_id"] = task["id"]
             metadata["task"] = task["name"]
 
-        self.__set_metadata(geo, metadata, metadata_info)
+        return (metadata, metadata_info)
 
     def get_geo_metadata(self, geo):
         """
@@ -258,8 +508,15 @@ class MetadataManager(object):
         :returns:       A dictionary of all metadata found on the GeoEntity
         """
         raw_md = self.__get_metadata(geo, MetadataManager.__GEO_METADATA_INFO)
+        return self.__process_geo_metadata(raw_md)
+
+    def __process_geo_metadata(self, raw_md):
+        """
+        Process raw GeoEntity metadata back into Shotgun entities
 
-        # process the metadata back into Shotgun entities:
+        :param raw_md:  The raw metadata read from the GeoEntity
+        :returns:       A dictionary of Shotgun entities found in the metadata
+        """
         md = {}
         if "project_id" in raw_md:
             project = {"type": "Project", "id": raw_md["project_id"]}
@@ -290,12 +547,23 @@ class MetadataManager(object):
         :param publish_id:  The publish id to use when setting the metadata
         :param version:     The publish version number to use when setting the metadata
         """
+        self.__set_metadata(
+            geo_version, *self.__build_geo_version_metadata(path, publish_id, version)
+        )
+
+    def __build_geo_version_metadata(self, path, publish_id, version):
+        """
+        Build the Toolkit metadata to store on a GeoEntityVersion
+
+        :param path:        The publish path to use when building the metadata
+        :param publish_id:  The publish id to use when building the metadata
+        :param version:     The publish version number to use when building the metadata
+        :returns:           Tuple containing the metadata and the metadata definitions
+        """
         # define the metadata we want to store:
         metadata = {"path": path, "publish_id": publish_id, "version": version}
 
-        self.__set_metadata(
-            geo_version, metadata, MetadataManager.__GEO_VERSION_METADATA_INFO
-        )
+        return (metadata, MetadataManager.__GEO_VERSION_METADATA_INFO)
 
     def get_geo_version_metadata(self, geo_version):
         """
@@ -308,30 +576,173 @@ class MetadataManager(object):
             geo_version, MetadataManager.__GEO_VERSION_METADATA_INFO
         )
 
+    def set_texture_metadata(self, texture, fingerprint, version, path):
+        """
+        Set the Toolkit metadata on a published Channel or Layer
+
+        :param texture:     The mari Channel or Layer to set the metadata on
+        :param fingerprint: The fingerprint of the published texture content
+        :param version:     The publish version number to use when setting the metadata
+        :param path:        The publish path to use when setting the metadata
+        """
+        metadata = {
+            "texture_fingerprint": fingerprint,
+            "texture_version": version,
+            "texture_path": path,
+        }
+        self.__set_metadata(texture, metadata, MetadataManager.__TEXTURE_METADATA_INFO)
+
+    def get_texture_metadata(self, texture):
+        """
+        Get the toolkit metadata for a published Channel or Layer
+
+        :param texture: The mari Channel or Layer to retrieve the metadata from
+        :returns:       A dictionary of all metadata found on the Channel or Layer
+        """
+        return self.__get_metadata(texture, MetadataManager.__TEXTURE_METADATA_INFO)
+
     def __set_metadata(self, obj, metadata, md_details):
         """
-        Set the specified metadata on the specified object
+        Set the specified metadata on the specified object.  Only values, display names
+        and flags that differ from those already on the object are written so that
+        re-applying the same metadata doesn't modify the project.
 
         :param obj:         The Mari object to add the metadata to
         :param metadata:    The metadata to add
         :param md_details:  Definitions of the metadata to add.
         """
+        record = self.__get_record(obj)
+
+        values = {}
         for name, details in md_details.items():
             value = metadata.get(name, details.get("default_value"))
             if value == None:
                 continue
+            values[name] = value
 
-            md_name = "tk_%s" % name
+        if self.__encoding == MetadataManager.LEGACY_ENCODING:
+            for name, value in values.items():
+                self.__write_entry(record, name, value, md_details[name])
+        if self.__encoding == MetadataManager.PAYLOAD_ENCODING or record.has_payload:
+            # values in the payload take precedence when reading so it must be
+            # kept up to date even when writing the legacy encoding:
+            self.__write_payload(record, values)
 
-            obj.setMetadata(md_name, value)
-            if "display_name" in details:
-                obj.setMetadataDisplayName(md_name, details["display_name"])
+    def __write_payload(self, record, values):
+        """
+        Write metadata values to the single 'tk_payload' entry on an object if
+        any of them differ from the current values.  Existing values not being
+        written are preserved in the payload.
+
+        :param record:  The _MetadataRecord for the object to write to
+        :param values:  Dictionary of metadata values to write
+        """
+        # compare with the payload itself rather than the merged metadata as
+        # the legacy entries may have just been updated:
+        if record.has_payload and all(
+            name in record.payload_data and record.payload_data[name] == value
+            for name, value in values.items()
+        ):
+            # nothing to do!
+            return
+
+        data = dict(record.metadata)
+        data.update(values)
+        payload = json.dumps(
+            {"version": MetadataManager.__PAYLOAD_VERSION, "data": data},
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        self.__write_entry(
+            record,
+            MetadataManager.__PAYLOAD_NAME,
+            payload,
+            MetadataManager.__PAYLOAD_DETAILS,
+            value_changed=True,
+        )
+        record.metadata = data
+        record.payload_data = dict(data)
+        record.has_payload = True
+
+    def __write_entry(self, record, name, value, details, value_changed=None):
+        """
+        Write a single 'tk_*' metadata entry on an object together with its
+        display name and flags, skipping anything that's already up to date.
+
+        :param record:          The _MetadataRecord for the object to write to
+        :param name:            The name of the entry without the 'tk_' prefix
+        :param value:           The value to write
+        :param details:         The definition of the metadata entry
+        :param value_changed:   True if the value is known to have changed.  If
+                                None then the value is compared with the record
+        """
+        obj = record.obj
+        md_name = "tk_%s" % name
 
-            flags = obj.METADATA_SAVED
-            visible = details.get("visible", True)
-            if visible:
-                flags |= obj.METADATA_VISIBLE
+        if name == MetadataManager.__PAYLOAD_NAME:
+            exists = record.has_payload
+        else:
+            exists = name in record.legacy_values
+        if value_changed is None:
+            value_changed = not exists or record.legacy_values.get(name) != value
+        if value_changed:
+            obj.setMetadata(md_name, value)
+            if name != MetadataManager.__PAYLOAD_NAME:
+                record.metadata[name] = value
+                record.legacy_values[name] = value
+
+        display_name = details.get("display_name")
+        flags = obj.METADATA_SAVED
+        visible = details.get("visible", True)
+        if visible:
+            flags |= obj.METADATA_VISIBLE
+
+        current_attributes = record.attributes.get(name)
+        if current_attributes is None and exists:
+            current_attributes = self.__read_attributes(obj, md_name)
+        if current_attributes is None:
+            current_attributes = (None, None)
+
+        if display_name is not None and current_attributes[0] != display_name:
+            obj.setMetadataDisplayName(md_name, display_name)
+        if current_attributes[1] != flags:
             obj.setMetadataFlags(md_name, flags)
+        record.attributes[name] = (
+            display_name if display_name is not None else current_attributes[0],
+            flags,
+        )
+
+    def __read_attributes(self, obj, md_name):
+        """
+        Read the display name and flags for an existing metadata entry.
+
+        :param obj:     The Mari object to read the attributes from
+        :param md_name: The full name of the metadata entry
+        :returns:       A (display name, flags) tuple or None if the attributes
+                        couldn't be read
+        """
+        try:
+            return (obj.metadataDisplayName(md_name), obj.metadataFlags(md_name))
+        except Exception:
+            return None
+
+    def __get_record(self, obj):
+        """
+        Get the metadata record for an object, either from the snapshot or by
+        reading the metadata from the object.  The record is used to write
+        metadata so if the object isn't in the snapshot then the snapshot is
+        cleared - it may hold a record for the same Mari object under a different
+        wrapper that would otherwise become stale.
+
+        :param obj: The Mari object to get the record for
+        :returns:   The _MetadataRecord for the object
+        """
+        if self.__snapshot is not None:
+            record = self.__snapshot.get(id(obj))
+            if record and record.obj is obj:
+                return record
+            self.clear_snapshot()
+        return self.__read_record(obj)
 
     def __get_metadata(self, obj, md_details):
         """
@@ -342,9 +753,91 @@ class MetadataManager(object):
 
         :returns:           A dictionary containing the metadata retrieved from the object
         """
+        all_metadata = None
+        if self.__snapshot is not None:
+            record = self.__snapshot.get(id(obj))
+            if record and record.obj is obj:
+                all_metadata = record.metadata
+        if all_metadata is None:
+            all_metadata = self.__read_record(obj).metadata
+
         metadata = {}
-        for name, _ in md_details.items():
-            md_name = "tk_%s" % name
-            if obj.hasMetadata(md_name):
-                metadata[name] = obj.metadata(md_name)
+        for name in md_details.keys():
+            if name in all_metadata:
+                metadata[name] = all_metadata[name]
         return metadata
+
+    def __read_record(self, obj):
+        """
+        Read all Toolkit metadata from the specified object.  Where possible, the
+        metadata names are enumerated once rather than checking for each known
+        name individually.  Metadata in both the legacy per-entry encoding and
+        the single payload encoding is read, with values in the payload taking
+        precedence.
+
+        :param obj: The Mari object to read the metadata from
+        :returns:   A _MetadataRecord containing all Toolkit metadata found on the
+                    object keyed by name without the 'tk_' prefix
+        """
+        prefix = MetadataManager.__METADATA_PREFIX
+        try:
+            md_names = [n for n in obj.metadataNames() if n.startswith(prefix)]
+        except AttributeError:
+            # metadataNames isn't available so check for all known names:
+            all_names = set([MetadataManager.__PAYLOAD_NAME])
+            for md_details in (
+                MetadataManager.__PROJECT_METADATA_INFO,
+                MetadataManager.__GEO_METADATA_INFO,
+                MetadataManager.__GEO_VERSION_METADATA_INFO,
+                MetadataManager.__TEXTURE_METADATA_INFO,
+            ):
+                all_names.update(md_details.keys())
+            md_names = [
+                prefix + name for name in all_names if obj.hasMetadata(prefix + name)
+            ]
+
+        legacy_values = {}
+        has_payload = False
+        payload_data = {}
+        for md_name in md_names:
+            name = md_name[len(prefix) :]
+            if name == MetadataManager.__PAYLOAD_NAME:
+                has_payload = True
+                payload_data = self.__decode_payload(obj.metadata(md_name))
+            else:
+                legacy_values[name] = obj.metadata(md_name)
+        metadata = dict(legacy_values)
+        metadata.update(payload_data)
+
+        return _MetadataRecord(obj, metadata, legacy_values, has_payload, payload_data)
+
+    def __decode_payload(self, payload):
+        """
+        Decode the value of a 'tk_payload' metadata entry.
+
+        :param payload: The serialized payload
+        :returns:       Dictionary of the metadata values in the payload.  This is
+                        empty if the payload is invalid or of an unknown version
+        """
+        try:
+            decoded = json.loads(payload)
+        except (TypeError, ValueError):
+            return {}
+        if not isinstance(decoded, dict) or not isinstance(decoded.get("data"), dict):
+            return {}
+        if decoded.get("version", 0) > MetadataManager.__PAYLOAD_VERSION:
+            # written by a newer version of the engine that we don't understand
+            return {}
+        return decoded["data"]
+
+    def __add_to_snapshot(self, snapshot, obj):
+        """
+        Read all Toolkit metadata from an object and add it to a snapshot.
+
+        :param snapshot:    The snapshot dictionary to add the object to
+        :param obj:         The Mari object to read the metadata from
+        :returns:           The new snapshot record for the object
+        """
+        record = self.__read_record(obj)
+        snapshot[id(obj)] = record
+        return record
@@ -15,12 +15,12 @@ Additional Shotgun functionality that deals with Mari Projects
 import sgtk
 from sgtk import TankError
 
-import os
 import mari
 
 from .metadata import MetadataManager
-from .geometry import GeometryManager
-from .utils import update_publish_records
+from .geometry import GeometryManager, GeometryNameAllocator
+from .timing import get_profiler
+from .utils import update_publish_records, find_missing_paths, warm_page_cache
 
 
 class ProjectManager(object):
@@ -28,12 +28,17 @@ class ProjectManager(object):
     Provides various utility methods that deal with Mari Projects
     """
 
-    def __init__(self):
+    def __init__(self, geo_mgr=None, md_mgr=None):
         """
         Construction
+
+        :param geo_mgr: The GeometryManager instance to use.  If None then a new
+                        instance will be created
+        :param md_mgr:  The MetadataManager instance to use.  If None then a new
+                        instance will be created
         """
-        self.geo_mgr = GeometryManager()
-        self.md_mgr = MetadataManager()
+        self.md_mgr = md_mgr or MetadataManager()
+        self.geo_mgr = geo_mgr or GeometryManager(self.md_mgr)
 
     def create_project(
         self,
@@ -74,30 +79,47 @@ class ProjectManager(object):
         # ensure that all sg_publishes contain the information we need:
         update_publish_records(sg_publishes)
 
-        # extract the file path for the first publish:
+        # extract the file paths for all publishes and make sure they all exist
+        # before closing the current project:
         # (TODO) - move this to use a centralized method in core
-        publish_path = sg_publishes[0].get("path", {}).get("local_path")
-        if not publish_path or not os.path.exists(publish_path):
-            raise TankError("Publish '%s' couldn't be found on disk!" % publish_path)
+        publish_paths = [
+            sg_publish.get("path", {}).get("local_path") for sg_publish in sg_publishes
+        ]
+        missing_paths = find_missing_paths(publish_paths)
+        if missing_paths:
+            raise TankError(
+                "Publish '%s' couldn't be found on disk!"
+                % "', '".join([str(p) for p in missing_paths])
+            )
+        publish_path = publish_paths[0]
 
         # close existing project if it's open:
         if mari.projects.current():
-            mari.projects.close()
+            with get_profiler().span("mari.projects.close", "mari"):
+                mari.projects.close()
             if mari.projects.current():
                 # the user cancelled and the project wasn't closed
                 return
 
+        # whilst Mari creates the project from the first geometry, optionally read
+        # the remaining geometry in the background so it's in the OS page cache
+        # by the time it's loaded:
+        if engine.get_setting("warm_geometry_page_cache", False):
+            warm_page_cache(publish_paths[1:])
+
         # create the project with the first geometry specified:
         try:
             engine.log_debug("Creating a new project called: %s" % name)
-            mari.projects.create(
-                name,
-                publish_path,
-                channels_to_create,
-                channels_to_import,
-                project_meta_options,
-                objects_to_load,
-            )
+            load_path = self.geo_mgr.get_load_path(publish_path)
+            with get_profiler().span("mari.projects.create", "mari", path=load_path):
+                mari.projects.create(
+                    name,
+                    load_path,
+                    channels_to_create,
+                    channels_to_import,
+                    project_meta_options,
+                    objects_to_load,
+                )
         except Exception as e:
             raise TankError("Failed to create new project: %s" % e)
 
@@ -106,13 +128,18 @@ class ProjectManager(object):
         if not new_project or new_project.name() != name:
             raise TankError("Newly created project '%s' wasn't opened!" % name)
 
-        # add metadata to the project so that we can track the context:
-        self.md_mgr.set_project_metadata(new_project, engine.context)
-
+        # add metadata to the project so that we can track the context and
         # update the metadata, name and version on the geometry that was
-        # loaded as part of the project creation:
+        # loaded as part of the project creation.  The metadata for all
+        # entities is written in a single pass:
+        metadata_updates = {"project_updates": [(new_project, engine.context)]}
+        name_allocator = GeometryNameAllocator()
         for geo in mari.geo.list():
-            self.geo_mgr.initialise_new_geometry(geo, publish_path, sg_publishes[0])
+            self.geo_mgr.initialise_new_geometry(
+                geo, publish_path, sg_publishes[0], metadata_updates, name_allocator
+            )
+        self.md_mgr.apply_metadata(**metadata_updates)
+        self.geo_mgr.index.rebuild()
 
         # finally, load in any additional geometry that was selected:
         for sg_publish in sg_publishes[1:]:
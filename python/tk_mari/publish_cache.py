@@ -0,0 +1,189 @@
+# Copyright (c) 2014 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Process-wide cache of Shotgun publish records
+"""
+
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+import sgtk
+
+
+class PublishRecordCache(object):
+    """
+    A TTL & LRU cache of Shotgun publish records keyed by (entity type, id).
+
+    Fields retrieved for the same record by different queries are merged
+    so that a record can satisfy any later request for a subset of the
+    fields already retrieved.  The cache is cleared whenever the context
+    of the current engine changes.
+    """
+
+    # default time in seconds that a cached record remains valid for:
+    DEFAULT_TTL = 300
+    # default maximum number of records held in the cache:
+    DEFAULT_MAX_SIZE = 2000
+
+    def __init__(self, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        """
+        Construction
+
+        :param ttl:         Time in seconds that a cached record remains valid for
+        :param max_size:    Maximum number of records to hold in the cache
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__records = OrderedDict()
+        self.__context = None
+        self.__lock = threading.Lock()
+
+    def configure(self, ttl=None, max_size=None):
+        """
+        Update the cache limits.  A ttl or max_size of 0 disables the cache.
+
+        :param ttl:         Time in seconds that a cached record remains valid for
+        :param max_size:    Maximum number of records to hold in the cache
+        """
+        with self.__lock:
+            if ttl is not None:
+                self.ttl = ttl
+            if max_size is not None:
+                self.max_size = max_size
+            self.__evict()
+
+    @property
+    def enabled(self):
+        """
+        :returns:   True if the cache is enabled
+        """
+        return self.ttl > 0 and self.max_size > 0
+
+    def get(self, entity_type, entity_id, fields):
+        """
+        Get a cached record if it contains all of the specified fields.
+
+        :param entity_type: The Shotgun entity type of the record
+        :param entity_id:   The id of the record
+        :param fields:      The fields that the record must contain
+        :returns:           A copy of the cached record or None if the record
+                            isn't cached, has expired or is missing any fields
+        """
+        if not self.enabled:
+            return None
+
+        with self.__lock:
+            self.__check_context()
+            key = (entity_type, entity_id)
+            entry = self.__records.get(key)
+            if entry:
+                timestamp, record = entry
+                if time.time() - timestamp > self.ttl:
+                    del self.__records[key]
+                elif all(field in record for field in fields):
+                    self.__records.move_to_end(key)
+                    self.hits += 1
+                    return copy.deepcopy(record)
+            self.misses += 1
+            return None
+
+    def update(self, entity_type, record):
+        """
+        Add a record to the cache, merging its fields with any fields
+        already cached for the same record.
+
+        :param entity_type: The Shotgun entity type of the record
+        :param record:      The Shotgun record to cache.  This must contain
+                            at least the "id" field
+        """
+        if not self.enabled:
+            return
+
+        with self.__lock:
+            self.__check_context()
+            key = (entity_type, record["id"])
+            now = time.time()
+            entry = self.__records.pop(key, None)
+            if entry and now - entry[0] <= self.ttl:
+                merged = entry[1]
+                merged.update(copy.deepcopy(record))
+            else:
+                merged = copy.deepcopy(record)
+            self.__records[key] = (now, merged)
+            self.__evict()
+
+    def invalidate(self, entity_type=None, entity_id=None):
+        """
+        Remove records from the cache.
+
+        :param entity_type: The Shotgun entity type of the record to remove.
+                            If None then all records are removed
+        :param entity_id:   The id of the record to remove.  If None then all
+                            records of the entity type are removed
+        """
+        with self.__lock:
+            if entity_type is None:
+                self.__records.clear()
+            elif entity_id is None:
+                for key in list(self.__records.keys()):
+                    if key[0] == entity_type:
+                        del self.__records[key]
+            else:
+                self.__records.pop((entity_type, entity_id), None)
+
+    def stats(self):
+        """
+        :returns:   A dictionary containing the current size of the cache
+                    together with the hit & miss counts
+        """
+        with self.__lock:
+            return {
+                "size": len(self.__records),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def __check_context(self):
+        """
+        Clear the cache if the context of the current engine has changed since
+        the cache was last used.  Must be called with the lock held.
+        """
+        engine = sgtk.platform.current_engine()
+        context = engine.context if engine else None
+        if context != self.__context:
+            self.__records.clear()
+            self.__context = context
+
+    def __evict(self):
+        """
+        Evict the least recently used records until the cache is within its size
+        limit.  Must be called with the lock held.
+        """
+        if not self.enabled:
+            self.__records.clear()
+            return
+        while len(self.__records) > self.max_size:
+            self.__records.popitem(last=False)
+
+
+# the process-wide publish record cache:
+_publish_record_cache = PublishRecordCache()
+
+
+def get_publish_record_cache():
+    """
+    :returns:   The process-wide PublishRecordCache instance
+    """
+    return _publish_record_cache
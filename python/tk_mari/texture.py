@@ -0,0 +1,81 @@
+# Copyright (c) 2014 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Track the published state of Mari channels and layers
+"""
+
+import mari
+
+from .metadata import MetadataManager
+
+
+class TextureManager(object):
+    """
+    Handle texture publish fingerprints stored in metadata on Mari channels and
+    layers.
+
+    A fingerprint of the exported tile content is stored for each published
+    channel or layer, together with the version and path of the publish, so that
+    identical content isn't published again.
+    """
+
+    def __init__(self, md_mgr=None):
+        """
+        Construction
+
+        :param md_mgr:  The MetadataManager used to read and write the fingerprints
+        """
+        self.__md_mgr = md_mgr or MetadataManager()
+
+    def find_texture(self, geo_name, channel_name, layer_name=None):
+        """
+        Find the Mari channel, or the layer within the channel, for a texture.
+
+        :param geo_name:        The name of the geometry
+        :param channel_name:    The name of the channel
+        :param layer_name:      The name of the layer.  If None then the channel
+                                is returned
+        :returns:               The Mari Channel or Layer or None if not found
+        """
+        geo = mari.geo.find(geo_name)
+        if not geo:
+            return None
+        channel = geo.findChannel(channel_name)
+        if not channel or not layer_name:
+            return channel
+        return channel.findLayer(layer_name)
+
+    def get_publish_info(self, texture):
+        """
+        Get the fingerprint, version and path stored on a channel or layer when it
+        was last published.
+
+        :param texture: The Mari Channel or Layer
+        :returns:       A dictionary containing the "fingerprint", "version" and
+                        "path" stored on the texture.  Missing values are None
+        """
+        md = self.__md_mgr.get_texture_metadata(texture)
+        return {
+            "fingerprint": md.get("texture_fingerprint"),
+            "version": md.get("texture_version"),
+            "path": md.get("texture_path"),
+        }
+
+    def set_publish_info(self, texture, fingerprint, version, path):
+        """
+        Store the fingerprint, version and path of a publish on a channel or layer.
+
+        :param texture:     The Mari Channel or Layer
+        :param fingerprint: The fingerprint of the published tile content
+        :param version:     The version number of the publish
+        :param path:        The path of the publish
+        """
+        self.__md_mgr.set_texture_metadata(texture, fingerprint, version, path)
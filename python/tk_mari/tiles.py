@@ -0,0 +1,340 @@
+# Copyright (c) 2014 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Staged and incremental publishing of UDIM texture tiles
+"""
+
+import json
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import sgtk
+from sgtk import TankError
+
+from .timing import get_profiler
+from .utils import find_udim_tiles, hash_files
+
+
+class TileManifest(object):
+    """
+    Manifest of the content hash of each tile of a published texture.  The manifest
+    is written next to the published tiles so that later versions can reuse any
+    tiles that haven't changed.
+    """
+
+    # Version of the manifest format written:
+    VERSION = 1
+
+    def __init__(self, path, tiles=None):
+        """
+        Construction
+
+        :param path:    The texture path containing a $UDIM token
+        :param tiles:   Dictionary of UDIM number to a dictionary containing the
+                        "file" name, "sha256" digest and "size" of each tile
+        """
+        self.path = path
+        self.tiles = tiles or {}
+
+    @staticmethod
+    def get_manifest_path(path):
+        """
+        :param path:    The texture path containing a $UDIM token
+        :returns:       The path of the manifest for the texture
+        """
+        return "%s.json" % path.replace("$UDIM", "manifest")
+
+    @classmethod
+    def read(cls, path):
+        """
+        Read the manifest for a texture.
+
+        :param path:    The texture path containing a $UDIM token
+        :returns:       The TileManifest or None if it doesn't exist, can't be read
+                        or was written by a newer version of the engine
+        """
+        try:
+            with open(TileManifest.get_manifest_path(path), "r") as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(data, dict) or data.get("version", 0) > cls.VERSION:
+            return None
+        tiles = dict(
+            (int(udim), entry) for udim, entry in (data.get("tiles") or {}).items()
+        )
+        return cls(path, tiles)
+
+    def write(self, dir_name=None):
+        """
+        Atomically write the manifest next to the texture tiles.
+
+        :param dir_name:    The directory to write the manifest to if not the
+                            directory containing the tiles, e.g. when staging
+        """
+        manifest_path = TileManifest.get_manifest_path(self.path)
+        if dir_name:
+            manifest_path = os.path.join(dir_name, os.path.basename(manifest_path))
+        else:
+            dir_name = os.path.dirname(manifest_path)
+        data = {
+            "version": TileManifest.VERSION,
+            "path": self.path,
+            "tiles": dict((str(udim), entry) for udim, entry in self.tiles.items()),
+        }
+        fd, tmp_path = _make_temp_file(dir_name)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, manifest_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get_tile_path(self, udim):
+        """
+        :param udim:    The UDIM number of the tile
+        :returns:       The path of the tile or None if it isn't in the manifest
+        """
+        entry = self.tiles.get(udim)
+        if not entry:
+            return None
+        return os.path.join(os.path.dirname(self.path), entry["file"])
+
+
+def commit_staged_tiles(
+    export_path, publish_path, previous_path=None, tile_digests=None, max_workers=8
+):
+    """
+    Publish texture tiles exported to a local scratch location.  The tiles are copied
+    in parallel to a staging directory on the publish storage, verified against the
+    checksums of the exported tiles and then committed to the publish location
+    together with a manifest of the tile hashes.  Nothing is written to the publish
+    location until all tiles have been staged and verified.
+
+    If the publish path of a previous version is specified then tiles that are
+    identical to a tile of that version are hard linked, or copied if linking isn't
+    possible, from the previous version's files rather than from the export.
+
+    This doesn't use the Mari API so can be run on a worker thread.
+
+    :param export_path:     The path the tiles were exported to, containing a $UDIM token
+    :param publish_path:    The path to publish the tiles to, containing a $UDIM token
+    :param previous_path:   The publish path of the previous version to reuse unchanged
+                            tiles from, if any
+    :param tile_digests:    Dictionary of UDIM number to the sha256 digest of each exported
+                            tile if already known
+    :param max_workers:     The maximum number of tiles to copy at once
+    :returns:               The TileManifest for the published tiles
+    :raises TankError:      If the tiles couldn't be published
+    """
+    engine = sgtk.platform.current_bundle()
+    exported_tiles = find_udim_tiles(export_path)
+    if tile_digests is None or set(tile_digests) != set(exported_tiles):
+        file_digests = hash_files(list(exported_tiles.values()))
+        tile_digests = dict(
+            (udim, file_digests[path]) for udim, path in exported_tiles.items()
+        )
+
+    previous_manifest = TileManifest.read(previous_path) if previous_path else None
+
+    # stage the tiles in a directory next to the publish directory if it doesn't
+    # exist yet so that the whole directory can be committed with a single rename,
+    # otherwise in a hidden directory within it:
+    publish_dir, publish_file = os.path.split(publish_path)
+    commit_dir = not os.path.isdir(publish_dir)
+    try:
+        if commit_dir:
+            parent_dir = os.path.dirname(publish_dir)
+            if not os.path.isdir(parent_dir):
+                os.makedirs(parent_dir)
+            staging_dir = _make_temp_dir(parent_dir)
+        else:
+            staging_dir = _make_temp_dir(publish_dir)
+    except (IOError, OSError) as e:
+        raise TankError(
+            "Failed to create a staging directory for '%s': %s" % (publish_path, e)
+        )
+
+    def stage_tile(udim):
+        tile_path = exported_tiles[udim]
+        file_name = publish_file.replace("$UDIM", "%04d" % udim)
+        staged_path = os.path.join(staging_dir, file_name)
+        entry = {
+            "file": file_name,
+            "sha256": tile_digests[udim],
+            "size": os.path.getsize(tile_path),
+        }
+
+        previous_entry = (
+            previous_manifest.tiles.get(udim) if previous_manifest else None
+        )
+        if previous_entry and previous_entry.get("sha256") == entry["sha256"]:
+            previous_tile = previous_manifest.get_tile_path(udim)
+            if (
+                os.path.isfile(previous_tile)
+                and os.path.getsize(previous_tile) == entry["size"]
+            ):
+                if _link_or_copy(previous_tile, staged_path):
+                    return (entry, "linked")
+                return (entry, "reused")
+
+        _copy(tile_path, staged_path)
+        # verify the copy:
+        if hash_files([staged_path], max_workers=1)[staged_path] != entry["sha256"]:
+            raise TankError(
+                "Checksum mismatch for '%s' copied to '%s'" % (tile_path, staged_path)
+            )
+        return (entry, "copied")
+
+    manifest = TileManifest(publish_path)
+    counts = {"linked": 0, "reused": 0, "copied": 0}
+    try:
+        if exported_tiles:
+            with get_profiler().span(
+                "stage_tiles", "io", count=len(exported_tiles)
+            ), ThreadPoolExecutor(
+                max_workers=min(max_workers, len(exported_tiles))
+            ) as executor:
+                udims = sorted(exported_tiles)
+                for udim, (entry, action) in zip(
+                    udims, executor.map(stage_tile, udims)
+                ):
+                    manifest.tiles[udim] = entry
+                    counts[action] += 1
+
+        # write the manifest to the staging directory:
+        manifest.write(staging_dir)
+
+        # and commit the staged files:
+        with get_profiler().span("commit_tiles", "io", path=publish_path):
+            _commit(
+                staging_dir,
+                publish_dir,
+                commit_dir,
+                os.path.basename(TileManifest.get_manifest_path(publish_path)),
+            )
+    except TankError:
+        raise
+    except Exception as e:
+        raise TankError("Failed to publish tiles to '%s': %s" % (publish_path, e))
+    finally:
+        if os.path.isdir(staging_dir):
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    engine.log_debug(
+        "Published %d tiles to '%s': %d linked and %d copied from the previous "
+        "version, %d copied from the export"
+        % (
+            len(exported_tiles),
+            publish_path,
+            counts["linked"],
+            counts["reused"],
+            counts["copied"],
+        )
+    )
+    return manifest
+
+
+def _commit(staging_dir, publish_dir, commit_dir, manifest_name):
+    """
+    Move all staged files into the publish directory.  The manifest is moved last
+    so that its presence indicates that all tiles have been published.
+
+    :param staging_dir:     The directory containing the staged files
+    :param publish_dir:     The publish directory
+    :param commit_dir:      True if the staging directory should be renamed to the publish
+                            directory.  If this fails because the publish directory has
+                            since been created then the files are moved individually
+    :param manifest_name:   The file name of the manifest
+    """
+    if commit_dir:
+        try:
+            os.rename(staging_dir, publish_dir)
+            return
+        except OSError:
+            if not os.path.isdir(publish_dir):
+                raise
+
+    file_names = sorted(os.listdir(staging_dir), key=lambda n: n == manifest_name)
+    for file_name in file_names:
+        os.replace(
+            os.path.join(staging_dir, file_name), os.path.join(publish_dir, file_name)
+        )
+
+
+def _link_or_copy(src, dst):
+    """
+    Hard link a file, falling back to a copy if the file can't be linked, e.g. when
+    the destination is on a different file system.
+
+    :param src: The path of the file to link to
+    :param dst: The path of the link to create
+    :returns:   True if the file was linked, False if it was copied
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return True
+    except (OSError, AttributeError):
+        _copy(src, dst)
+        return False
+
+
+def _copy(src, dst):
+    """
+    Copy a file to a temporary file next to the destination which is then renamed
+    into place so that a partially written file is never left at the destination.
+
+    :param src: The path of the file to copy
+    :param dst: The destination path
+    """
+    fd, tmp_path = _make_temp_file(os.path.dirname(dst))
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except (IOError, OSError) as e:
+        raise TankError("Failed to copy '%s' to '%s': %s" % (src, dst, e))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _make_temp_file(dir_name):
+    """
+    Create a uniquely named temporary file.  Unlike tempfile.mkstemp(), the file is
+    created with the permissions the process umask gives new files so that it can
+    be renamed into the publish location as is.
+
+    :param dir_name:    The directory to create the file in
+    :returns:           Tuple containing the open file descriptor and the path of
+                        the file
+    """
+    path = os.path.join(dir_name, ".tmp_%s" % uuid.uuid4().hex)
+    return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), path
+
+
+def _make_temp_dir(dir_name):
+    """
+    Create a uniquely named staging directory.  Unlike tempfile.mkdtemp(), the
+    directory is created with the permissions the process umask gives new
+    directories so that it can be renamed into the publish location as is.
+
+    :param dir_name:    The directory to create the staging directory in
+    :returns:           The path of the staging directory
+    """
+    path = os.path.join(dir_name, ".tk_staging_%s" % uuid.uuid4().hex)
+    os.mkdir(path)
+    return path
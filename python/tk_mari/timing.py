@@ -0,0 +1,197 @@
+# Copyright (c) 2014 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Lightweight timing instrumentation for the engine and its hooks
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+
+
+class _NullSpan(object):
+    """
+    Span returned when timing is disabled.  Entering and exiting it does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    """
+    Context manager that records a single timed span with the profiler.
+    """
+
+    __slots__ = ("_profiler", "_name", "_category", "_args", "_start")
+
+    def __init__(self, profiler, name, category, args):
+        """
+        Construction
+
+        :param profiler:    The Profiler to record the span with
+        :param name:        The name of the span
+        :param category:    The category of the span, e.g. "mari" or "shotgun"
+        :param args:        Dictionary of additional information to record
+        """
+        self._profiler = profiler
+        self._name = name
+        self._category = category
+        self._args = args
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        self._profiler._record(
+            self._name, self._category, self._start, end - self._start, self._args
+        )
+        return False
+
+
+class Profiler(object):
+    """
+    Records timed spans for Mari API calls, Shotgun queries, exports and file I/O.
+
+    When disabled, span() returns a shared no-op context manager so instrumented
+    code costs no more than a single attribute check and method call.  Recorded
+    spans can be written out as a Chrome trace (load it in chrome://tracing or
+    https://ui.perfetto.dev) or summarized as a table.  Only the most recent
+    MAX_EVENTS spans are kept.
+    """
+
+    # the maximum number of spans kept, oldest first out:
+    MAX_EVENTS = 100000
+
+    def __init__(self):
+        """
+        Construction
+        """
+        self.enabled = False
+        self.__events = collections.deque(maxlen=Profiler.MAX_EVENTS)
+        self.__origin = time.perf_counter()
+        self.__lock = threading.Lock()
+
+    def span(self, name, category="engine", **args):
+        """
+        Time a block of code::
+
+            with profiler.span("mari.geo.load", "mari", path=path):
+                mari.geo.load(path)
+
+        :param name:        The name of the span
+        :param category:    The category of the span, e.g. "mari", "shotgun" or "io"
+        :param args:        Additional information to record with the span
+        :returns:           A context manager that times the block
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, category, args)
+
+    def clear(self):
+        """
+        Discard all recorded spans.
+        """
+        with self.__lock:
+            self.__events.clear()
+            self.__origin = time.perf_counter()
+
+    def write_chrome_trace(self, path):
+        """
+        Write all recorded spans to a Chrome trace JSON file.
+
+        :param path:    The path of the file to write
+        """
+        pid = os.getpid()
+        with self.__lock:
+            events = list(self.__events)
+        trace_events = []
+        for name, category, start, duration, thread_id, args in events:
+            trace_events.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": (start - self.__origin) * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": pid,
+                    "tid": thread_id,
+                    "args": dict((k, str(v)) for k, v in args.items()),
+                }
+            )
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+    def summary(self):
+        """
+        Summarize the recorded spans by name.
+
+        :returns:   A string containing a table of the count, total, mean and
+                    maximum time for each span name, slowest total first
+        """
+        with self.__lock:
+            events = list(self.__events)
+
+        totals = {}
+        for name, category, _, duration, _, _ in events:
+            entry = totals.setdefault((category, name), [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] = max(entry[2], duration)
+
+        lines = [
+            "%-10s %-50s %7s %10s %10s %10s"
+            % ("Category", "Span", "Count", "Total(s)", "Mean(s)", "Max(s)")
+        ]
+        for (category, name), (count, total, longest) in sorted(
+            totals.items(), key=lambda item: -item[1][1]
+        ):
+            lines.append(
+                "%-10s %-50s %7d %10.3f %10.3f %10.3f"
+                % (category, name[:50], count, total, total / count, longest)
+            )
+        return "\n".join(lines)
+
+    def _record(self, name, category, start, duration, args):
+        """
+        Record a completed span.
+
+        :param name:        The name of the span
+        :param category:    The category of the span
+        :param start:       The perf_counter time the span started
+        :param duration:    The duration of the span in seconds
+        :param args:        Dictionary of additional information for the span
+        """
+        event = (name, category, start, duration, threading.get_ident(), args)
+        with self.__lock:
+            self.__events.append(event)
+
+
+# the process-wide profiler:
+_profiler = Profiler()
+
+
+def get_profiler():
+    """
+    :returns:   The process-wide Profiler instance
+    """
+    return _profiler
@@ -8,9 +8,19 @@
 # agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
 # not expressly granted therein are reserved by Shotgun Software Inc.
 
+import hashlib
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import sgtk
 from sgtk import TankError
 
+from .publish_cache import get_publish_record_cache
+from .timing import get_profiler
+
 
 def get_publish_type_field():
     """
@@ -27,6 +37,21 @@ def get_publish_type_field():
         return "tank_type.TankType.code"
 
 
+def get_required_publish_fields():
+    """
+    :returns:   The list of publish fields required by the engine helper methods
+    """
+    return [
+        "name",
+        "version",
+        "path",
+        "project",
+        "entity",
+        "task",
+        get_publish_type_field(),
+    ]
+
+
 def update_publish_records(sg_publishes, min_fields=None):
     """
     If needed, update Shotgun publish records with fields required for
@@ -40,17 +65,7 @@ def update_publish_records(sg_publishes, min_fields=None):
     engine = sgtk.platform.current_bundle()
 
     # ensure that all sg_publishes contain the information we need:
-    required_fields = set(
-        [
-            "name",
-            "version",
-            "path",
-            "project",
-            "entity",
-            "task",
-            get_publish_type_field(),
-        ]
-    )
+    required_fields = set(get_required_publish_fields())
     if min_fields:
         required_fields.update(min_fields)
     else:
@@ -58,28 +73,409 @@ def update_publish_records(sg_publishes, min_fields=None):
     required_fields = list(required_fields)
 
     # check all publishes and find any that are missing one or more
-    # required fields:
+    # required fields.  Where possible, missing fields are filled in
+    # from the publish record cache:
+    cache = get_publish_record_cache()
     to_update = {}
     for sg_publish in sg_publishes:
         for field in min_fields:
             if field not in sg_publish:
-                # add to the list that need updating:
-                to_update[sg_publish["id"]] = sg_publish
+                cached_record = cache.get(
+                    sg_publish["type"], sg_publish["id"], min_fields
+                )
+                if cached_record:
+                    sg_publish.update(cached_record)
+                else:
+                    # add to the list that need updating:
+                    to_update[sg_publish["id"]] = sg_publish
                 break
 
     if to_update:
         try:
             # query shotgun for the record of any publishes that need updating:
             filters = [["id", "in", list(to_update.keys())]]
-            sg_res = engine.shotgun.find(
-                sg_publishes[0]["type"], filters, required_fields
-            )
+            with get_profiler().span(
+                "update_publish_records", "shotgun", count=len(to_update)
+            ):
+                sg_res = engine.shotgun.find(
+                    sg_publishes[0]["type"], filters, required_fields
+                )
 
-            # update the publish records:
+            # update the publish records and the cache:
             for sg_item in sg_res:
+                cache.update(sg_item["type"], sg_item)
                 to_update[sg_item["id"]].update(sg_item)
         except Exception as e:
             raise TankError(
                 "Failed to retrieve publish details from Flow Production Tracking: %s"
                 % e
             )
+
+
+def find_publish_versions(sg_publishes, fields=None):
+    """
+    Find all versions of the specified publishes using a single Shotgun query.
+    Publishes are considered to be versions of each other if they share the same
+    project, entity, task, name and publish type.
+
+    The publishes must already contain the "project", "entity", "task", "name"
+    and publish type fields - see update_publish_records().
+
+    :param sg_publishes:    The list of publishes to find versions for
+    :param fields:          Additional fields to retrieve for each version so that
+                            they are available from the publish record cache
+    :returns:               A dictionary of publish id to a set containing the ids
+                            of all versions of that publish
+    """
+    publish_versions = {}
+    for publish_id, sg_versions in _find_publish_version_records(
+        sg_publishes, fields
+    ).items():
+        publish_versions[publish_id] = set(
+            sg_version["id"] for sg_version in sg_versions
+        )
+    return publish_versions
+
+
+def find_latest_publishes(sg_publishes, fields=None):
+    """
+    Find the latest version of each of the specified publishes using a single Shotgun
+    query.  Publishes are considered to be versions of each other if they share the
+    same project, entity, task, name and publish type.
+
+    The publishes must already contain the "project", "entity", "task", "name"
+    and publish type fields - see update_publish_records().
+
+    :param sg_publishes:    The list of publishes to find the latest versions for
+    :param fields:          Additional fields to retrieve for the latest versions.  The
+                            fields required by the engine helper methods and the
+                            "version_number" are always retrieved
+    :returns:               A dictionary of publish id to the record of the latest
+                            version of that publish, ranked by version number
+    """
+    all_fields = set(get_required_publish_fields())
+    all_fields.add("version_number")
+    all_fields.update(fields or [])
+
+    latest_publishes = {}
+    for publish_id, sg_versions in _find_publish_version_records(
+        sg_publishes, all_fields
+    ).items():
+        if sg_versions:
+            latest_publishes[publish_id] = max(
+                sg_versions, key=lambda v: (v.get("version_number") or 0, v["id"])
+            )
+    return latest_publishes
+
+
+def _find_publish_version_records(sg_publishes, fields=None):
+    """
+    Implementation of find_publish_versions() and find_latest_publishes()
+
+    :param sg_publishes:    The list of publishes to find versions for
+    :param fields:          Additional fields to retrieve for each version
+    :returns:               A dictionary of publish id to a list containing the
+                            records of all versions of that publish
+    """
+    if not sg_publishes:
+        return {}
+
+    engine = sgtk.platform.current_bundle()
+    publish_type_field = get_publish_type_field()
+
+    # build a sub-filter for each unique publish key and 'or' them together:
+    def make_key(sg_publish):
+        key = [("project", _entity_key(sg_publish.get("project")))]
+        for field in ["entity", "task"]:
+            if sg_publish.get(field):
+                key.append((field, _entity_key(sg_publish[field])))
+        for field in ["name", publish_type_field]:
+            if sg_publish.get(field):
+                key.append((field, sg_publish[field]))
+        return tuple(key)
+
+    keys = {}
+    for sg_publish in sg_publishes:
+        keys.setdefault(make_key(sg_publish), []).append(sg_publish)
+
+    sub_filters = []
+    for publishes in keys.values():
+        sg_publish = publishes[0]
+        filters = [["project", "is", sg_publish["project"]]]
+        for field in ["entity", "task", "name", publish_type_field]:
+            if sg_publish.get(field):
+                filters.append([field, "is", sg_publish[field]])
+        sub_filters.append({"filter_operator": "all", "filters": filters})
+
+    try:
+        with get_profiler().span("find_publish_versions", "shotgun", count=len(keys)):
+            sg_res = engine.shotgun.find(
+                sg_publishes[0]["type"],
+                [{"filter_operator": "any", "filters": sub_filters}],
+                list(
+                    set(["project", "entity", "task", "name", publish_type_field])
+                    | set(fields or [])
+                ),
+            )
+    except Exception as e:
+        raise TankError(
+            "Failed to query publish versions from Flow Production Tracking: %s" % e
+        )
+
+    # the results are complete records for the fields queried so add them
+    # to the publish record cache:
+    cache = get_publish_record_cache()
+    for sg_res_item in sg_res:
+        cache.update(sg_res_item["type"], sg_res_item)
+
+    # match the results back to the publish keys:
+    publish_versions = {}
+    for key, publishes in keys.items():
+        sg_versions = []
+        for sg_res_item in sg_res:
+            for field, value in key:
+                res_value = sg_res_item.get(field)
+                if field in ("project", "entity", "task"):
+                    res_value = _entity_key(res_value)
+                if res_value != value:
+                    break
+            else:
+                sg_versions.append(sg_res_item)
+        for sg_publish in publishes:
+            publish_versions[sg_publish["id"]] = sg_versions
+
+    return publish_versions
+
+
+def prefetch_publish_records(publish_ids):
+    """
+    Retrieve the records for the specified publishes together with the records of
+    all other versions of those publishes and add them to the publish record cache
+    so that later queries for them don't need a round trip to Shotgun.  The records
+    are retrieved with one query for all publishes followed by one query for all of
+    their versions.
+
+    This doesn't use the Mari API so can be run on a worker thread.
+
+    :param publish_ids: The ids of the publishes to prefetch
+    :returns:           The number of publish records added to the cache
+    :raises TankError:  If the records couldn't be retrieved
+    """
+    if not publish_ids:
+        return 0
+
+    engine = sgtk.platform.current_bundle()
+    publish_entity_type = sgtk.util.get_published_file_entity_type(engine.sgtk)
+    sg_publishes = [
+        {"type": publish_entity_type, "id": publish_id}
+        for publish_id in sorted(set(publish_ids))
+    ]
+
+    required_fields = get_required_publish_fields()
+    with get_profiler().span(
+        "prefetch_publish_records", "shotgun", count=len(sg_publishes)
+    ):
+        update_publish_records(sg_publishes)
+
+        # publishes that no longer exist won't have been updated:
+        sg_publishes = [
+            sg_publish for sg_publish in sg_publishes if "name" in sg_publish
+        ]
+        publish_versions = find_publish_versions(sg_publishes, required_fields)
+
+    version_ids = set()
+    for ids in publish_versions.values():
+        version_ids.update(ids)
+    return len(version_ids.union(p["id"] for p in sg_publishes))
+
+
+def _entity_key(sg_entity):
+    """
+    :param sg_entity:   A Shotgun entity dictionary or None
+    :returns:           A hashable (type, id) tuple for the entity or None
+    """
+    if not sg_entity:
+        return None
+    return (sg_entity["type"], sg_entity["id"])
+
+
+def find_missing_paths(paths, max_workers=8):
+    """
+    Check that all of the specified paths exist on disk.  The paths are checked
+    in parallel as the latency of each check dominates on network storage.
+
+    :param paths:       The list of paths to check.  Empty paths are always
+                        considered missing
+    :param max_workers: The maximum number of paths to check at once
+    :returns:           A list of the paths that couldn't be found, in the order
+                        they were specified
+    """
+    unique_paths = list(dict.fromkeys(p for p in paths if p))
+    exists = {}
+    if unique_paths:
+        with get_profiler().span(
+            "find_missing_paths", "io", count=len(unique_paths)
+        ), ThreadPoolExecutor(
+            max_workers=min(max_workers, len(unique_paths))
+        ) as executor:
+            exists = dict(zip(unique_paths, executor.map(os.path.exists, unique_paths)))
+    return [p for p in paths if not p or not exists.get(p)]
+
+
+def warm_page_cache(paths, max_workers=4, chunk_size=8 * 1024 * 1024):
+    """
+    Read the specified files in background threads so that their contents are in
+    the OS page cache by the time they're needed.  The data read is discarded and
+    any errors are ignored - this is purely an optimisation.
+
+    :param paths:       The list of files to read
+    :param max_workers: The maximum number of files to read at once
+    :param chunk_size:  The size of each read in bytes
+    :returns:           A list of the (daemon) threads doing the reading
+    """
+    to_read = deque(dict.fromkeys(p for p in paths if p))
+
+    def read_files():
+        while True:
+            try:
+                path = to_read.popleft()
+            except IndexError:
+                return
+            try:
+                with open(path, "rb") as f:
+                    while f.read(chunk_size):
+                        pass
+            except (IOError, OSError):
+                pass
+
+    threads = []
+    for _ in range(min(max_workers, len(to_read))):
+        thread = threading.Thread(target=read_files, name="tk-mari-page-cache")
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def find_udim_tiles(path):
+    """
+    Find all tiles on disk for a texture path containing a $UDIM token.
+
+    :param path:    The texture path, e.g. '/textures/diffuse.$UDIM.tif'
+    :returns:       A dictionary of UDIM number to the path of the tile
+    """
+    dir_name, file_name = os.path.split(path)
+    if "$UDIM" not in file_name:
+        return {}
+    head, tail = file_name.split("$UDIM", 1)
+    pattern = re.compile(r"^%s(\d{4})%s$" % (re.escape(head), re.escape(tail)))
+
+    tiles = {}
+    try:
+        file_names = os.listdir(dir_name)
+    except OSError:
+        return tiles
+    for name in file_names:
+        match = pattern.match(name)
+        if match:
+            tiles[int(match.group(1))] = os.path.join(dir_name, name)
+    return tiles
+
+
+def hash_files(paths, max_workers=4, chunk_size=8 * 1024 * 1024):
+    """
+    Compute the sha256 digest of the content of each of the specified files.  The
+    files are hashed in parallel.
+
+    :param paths:       The list of files to hash
+    :param max_workers: The maximum number of files to hash at once
+    :param chunk_size:  The size of each read in bytes
+    :returns:           A dictionary of path to the hex digest of the file content
+    """
+
+    def hash_file(path):
+        file_hash = hashlib.sha256()
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    unique_paths = list(dict.fromkeys(paths))
+    if not unique_paths:
+        return {}
+    with get_profiler().span(
+        "hash_files", "io", count=len(unique_paths)
+    ), ThreadPoolExecutor(max_workers=min(max_workers, len(unique_paths))) as executor:
+        return dict(zip(unique_paths, executor.map(hash_file, unique_paths)))
+
+
+def get_tiles_fingerprint(tile_digests):
+    """
+    Combine the digests of the tiles of a texture into a single fingerprint for the
+    texture content.
+
+    :param tile_digests:    A dictionary of UDIM number to the hex digest of the tile
+    :returns:               The hex digest fingerprint of all tiles or None if there
+                            are no tiles
+    """
+    if not tile_digests:
+        return None
+    fingerprint = hashlib.sha256()
+    for udim in sorted(tile_digests):
+        fingerprint.update(("%d:%s;" % (udim, tile_digests[udim])).encode("utf-8"))
+    return fingerprint.hexdigest()
+
+
+def fingerprint_udim_tiles(path):
+    """
+    Compute a fingerprint for the content of all tiles of a texture on disk.  This
+    doesn't use the Mari API so can be run on a worker thread.
+
+    :param path:    The texture path containing a $UDIM token
+    :returns:       Tuple containing the fingerprint, or None if no tiles were found,
+                    and a dictionary of UDIM number to the hex digest of each tile
+    """
+    tiles = find_udim_tiles(path)
+    file_digests = hash_files(list(tiles.values()))
+    tile_digests = dict((udim, file_digests[p]) for udim, p in tiles.items())
+    return (get_tiles_fingerprint(tile_digests), tile_digests)
+
+
+def verify_udim_tiles(path, expected_udims=None, max_workers=8):
+    """
+    Check the tiles of a texture on disk.  The tiles are found with a single scan
+    of the texture directory and their sizes are read in parallel as the latency
+    of each stat dominates on network storage.
+
+    This doesn't use the Mari API so can be run on a worker thread.
+
+    :param path:            The texture path containing a $UDIM token
+    :param expected_udims:  The UDIM numbers of the tiles that should exist.  If None
+                            then any tiles found are accepted
+    :param max_workers:     The maximum number of tiles to check at once
+    :returns:               A dictionary containing the "tiles" found as a dictionary of
+                            UDIM number to size in bytes, the tile "count", the total
+                            "bytes" and sorted lists of the "missing" and "empty" UDIMs
+    """
+    tiles = find_udim_tiles(path)
+    sizes = {}
+    if tiles:
+        udims = list(tiles.keys())
+        with get_profiler().span(
+            "verify_udim_tiles", "io", count=len(udims)
+        ), ThreadPoolExecutor(max_workers=min(max_workers, len(udims))) as executor:
+            sizes = dict(
+                zip(udims, executor.map(os.path.getsize, [tiles[u] for u in udims]))
+            )
+
+    missing = set(expected_udims or []) - set(sizes.keys())
+    return {
+        "tiles": sizes,
+        "count": len(sizes),
+        "bytes": sum(sizes.values()),
+        "missing": sorted(missing),
+        "empty": sorted(udim for udim, size in sizes.items() if not size),
+    }
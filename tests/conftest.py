@@ -0,0 +1,102 @@
+# Copyright (c) 2014 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Test configuration for the tk_mari modules that don't need Mari to run.
+
+The sgtk and mari modules are replaced with minimal stand-ins and the tk_mari
+package is made importable without running its __init__, which pulls in the
+modules that need Mari and Qt.
+"""
+
+import os
+import sys
+import types
+
+import pytest
+
+_PACKAGE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "python", "tk_mari"
+)
+
+
+class TankError(Exception):
+    """
+    Stand-in for sgtk.TankError
+    """
+
+
+def _install_stub_modules():
+    """
+    Install the sgtk, mari and tk_mari modules used by the tests.
+    """
+    sgtk = types.ModuleType("sgtk")
+    sgtk.TankError = TankError
+    sgtk.platform = types.ModuleType("sgtk.platform")
+    sgtk.platform.current_engine = lambda: None
+    sgtk.platform.current_bundle = lambda: None
+    sgtk.util = types.ModuleType("sgtk.util")
+    sgtk.util.get_published_file_entity_type = lambda tk: "PublishedFile"
+    sys.modules["sgtk"] = sgtk
+    sys.modules["sgtk.platform"] = sgtk.platform
+    sys.modules["sgtk.util"] = sgtk.util
+
+    mari = types.ModuleType("mari")
+    mari.geo = types.SimpleNamespace(names=lambda: [])
+    sys.modules["mari"] = mari
+
+    tk_mari = types.ModuleType("tk_mari")
+    tk_mari.__path__ = [_PACKAGE_DIR]
+    sys.modules["tk_mari"] = tk_mari
+
+
+_install_stub_modules()
+
+
+class FakeShotgun(object):
+    """
+    Shotgun connection that returns canned records and keeps a log of the
+    queries made.
+    """
+
+    def __init__(self, records=None):
+        """
+        Construction
+
+        :param records: The records returned by find()
+        """
+        self.records = records or []
+        self.find_calls = []
+
+    def find(self, entity_type, filters, fields):
+        self.find_calls.append((entity_type, filters, fields))
+        return [dict(record) for record in self.records]
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    """
+    A fake current engine with a context and a FakeShotgun connection.
+    """
+    import sgtk
+    from tk_mari.publish_cache import get_publish_record_cache
+
+    fake_engine = types.SimpleNamespace(
+        context="context",
+        sgtk=None,
+        shotgun=FakeShotgun(),
+        log_debug=lambda msg: None,
+    )
+    monkeypatch.setattr(sgtk.platform, "current_engine", lambda: fake_engine)
+    monkeypatch.setattr(sgtk.platform, "current_bundle", lambda: fake_engine)
+
+    get_publish_record_cache().invalidate()
+    yield fake_engine
+    get_publish_record_cache().invalidate()
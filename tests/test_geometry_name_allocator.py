@@ -0,0 +1,56 @@
+# Copyright (c) 2014 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+import mari
+
+from tk_mari.geometry import GeometryNameAllocator
+
+
+def test_free_base_name_is_used():
+    allocator = GeometryNameAllocator(["other"])
+    assert allocator.allocate("geo") == "geo"
+
+
+def test_names_are_unique_within_a_batch():
+    allocator = GeometryNameAllocator([])
+    names = [allocator.allocate("geo") for _ in range(4)]
+    assert names == ["geo", "geo_1", "geo_2", "geo_3"]
+
+
+def test_existing_names_are_skipped():
+    allocator = GeometryNameAllocator(["geo", "geo_1", "geo_3"])
+    assert allocator.allocate("geo") == "geo_2"
+    assert allocator.allocate("geo") == "geo_4"
+
+
+def test_suffixed_base_names_are_tracked_separately():
+    allocator = GeometryNameAllocator(["geo", "geo_1"])
+    assert allocator.allocate("geo_1") == "geo_1_1"
+    assert allocator.allocate("geo") == "geo_2"
+
+
+def test_current_name_is_released():
+    allocator = GeometryNameAllocator(["body", "geo"])
+
+    assert allocator.allocate("geo", current_name="body") == "geo_1"
+    assert allocator.allocate("body") == "body"
+
+
+def test_current_name_is_kept_if_it_is_allocated():
+    allocator = GeometryNameAllocator(["geo"])
+
+    assert allocator.allocate("geo_1", current_name="geo_1") == "geo_1"
+    assert allocator.allocate("geo_1") == "geo_1_1"
+
+
+def test_names_are_read_from_the_project(monkeypatch):
+    monkeypatch.setattr(mari.geo, "names", lambda: ["geo"])
+    allocator = GeometryNameAllocator()
+    assert allocator.allocate("geo") == "geo_1"
@@ -0,0 +1,154 @@
+# Copyright (c) 2014 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+import types
+
+import pytest
+
+from tk_mari import publish_cache
+from tk_mari.publish_cache import PublishRecordCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Replace the time used by the cache with a clock the test controls.
+    """
+    now = types.SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(
+        publish_cache, "time", types.SimpleNamespace(time=lambda: now.value)
+    )
+    return now
+
+
+def test_get_returns_a_copy_of_the_cached_record(engine):
+    cache = PublishRecordCache()
+    cache.update("PublishedFile", {"id": 1, "name": "a", "tags": ["x"]})
+
+    record = cache.get("PublishedFile", 1, ["name"])
+    assert record == {"id": 1, "name": "a", "tags": ["x"]}
+
+    record["tags"].append("y")
+    assert cache.get("PublishedFile", 1, ["tags"])["tags"] == ["x"]
+    assert cache.stats() == {"size": 1, "hits": 2, "misses": 0}
+
+
+def test_get_misses_when_fields_are_missing(engine):
+    cache = PublishRecordCache()
+    cache.update("PublishedFile", {"id": 1, "name": "a"})
+
+    assert cache.get("PublishedFile", 1, ["name", "path"]) is None
+    assert cache.get("PublishedFile", 2, ["name"]) is None
+    assert cache.get("TankPublishedFile", 1, ["name"]) is None
+    assert cache.stats()["misses"] == 3
+
+
+def test_update_merges_fields(engine):
+    cache = PublishRecordCache()
+    cache.update("PublishedFile", {"id": 1, "name": "a", "version_number": 1})
+    cache.update("PublishedFile", {"id": 1, "path": {"local_path": "/a"}})
+
+    assert cache.get("PublishedFile", 1, ["name", "path", "version_number"]) == {
+        "id": 1,
+        "name": "a",
+        "version_number": 1,
+        "path": {"local_path": "/a"},
+    }
+
+
+def test_records_expire(engine, clock):
+    cache = PublishRecordCache(ttl=10)
+    cache.update("PublishedFile", {"id": 1, "name": "a"})
+
+    clock.value += 10
+    assert cache.get("PublishedFile", 1, ["name"]) is not None
+
+    clock.value += 1
+    assert cache.get("PublishedFile", 1, ["name"]) is None
+    assert cache.stats()["size"] == 0
+
+
+def test_expired_records_are_not_merged(engine, clock):
+    cache = PublishRecordCache(ttl=10)
+    cache.update("PublishedFile", {"id": 1, "name": "a"})
+
+    clock.value += 11
+    cache.update("PublishedFile", {"id": 1, "path": "/a"})
+
+    assert cache.get("PublishedFile", 1, ["path"]) == {"id": 1, "path": "/a"}
+    assert cache.get("PublishedFile", 1, ["name"]) is None
+
+
+def test_least_recently_used_records_are_evicted(engine):
+    cache = PublishRecordCache(max_size=2)
+    cache.update("PublishedFile", {"id": 1})
+    cache.update("PublishedFile", {"id": 2})
+
+    # using record 1 makes record 2 the least recently used:
+    assert cache.get("PublishedFile", 1, []) is not None
+    cache.update("PublishedFile", {"id": 3})
+
+    assert cache.get("PublishedFile", 2, []) is None
+    assert cache.get("PublishedFile", 1, []) is not None
+    assert cache.get("PublishedFile", 3, []) is not None
+
+
+def test_configure_evicts_to_the_new_size(engine):
+    cache = PublishRecordCache()
+    for publish_id in range(5):
+        cache.update("PublishedFile", {"id": publish_id})
+
+    cache.configure(max_size=2)
+
+    assert cache.stats()["size"] == 2
+    assert cache.get("PublishedFile", 4, []) is not None
+    assert cache.get("PublishedFile", 0, []) is None
+
+
+@pytest.mark.parametrize("settings", [{"ttl": 0}, {"max_size": 0}])
+def test_disabled_cache_holds_nothing(engine, settings):
+    cache = PublishRecordCache()
+    cache.update("PublishedFile", {"id": 1, "name": "a"})
+
+    cache.configure(**settings)
+    assert not cache.enabled
+    assert cache.stats()["size"] == 0
+
+    cache.update("PublishedFile", {"id": 1, "name": "a"})
+    assert cache.get("PublishedFile", 1, ["name"]) is None
+    assert cache.stats() == {"size": 0, "hits": 0, "misses": 0}
+
+
+def test_cache_is_cleared_when_the_context_changes(engine):
+    cache = PublishRecordCache()
+    cache.update("PublishedFile", {"id": 1, "name": "a"})
+
+    engine.context = "another context"
+
+    assert cache.get("PublishedFile", 1, ["name"]) is None
+    assert cache.stats()["size"] == 0
+
+
+def test_invalidate(engine):
+    cache = PublishRecordCache()
+    cache.update("PublishedFile", {"id": 1})
+    cache.update("PublishedFile", {"id": 2})
+    cache.update("TankPublishedFile", {"id": 1})
+
+    cache.invalidate("PublishedFile", 1)
+    assert cache.get("PublishedFile", 1, []) is None
+    assert cache.get("PublishedFile", 2, []) is not None
+
+    cache.invalidate("PublishedFile")
+    assert cache.get("PublishedFile", 2, []) is None
+    assert cache.get("TankPublishedFile", 1, []) is not None
+
+    cache.invalidate()
+    assert cache.stats()["size"] == 0
@@ -0,0 +1,144 @@
+# Copyright (c) 2014 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+import hashlib
+import json
+import os
+import stat
+
+from tk_mari.tiles import TileManifest, commit_staged_tiles
+
+
+def _write_tiles(dir_name, contents):
+    """
+    Write a tile file for each UDIM in contents and return the texture path.
+    """
+    os.makedirs(dir_name, exist_ok=True)
+    for udim, data in contents.items():
+        with open(os.path.join(dir_name, "diffuse.%04d.exr" % udim), "wb") as f:
+            f.write(data)
+    return os.path.join(dir_name, "diffuse.$UDIM.exr")
+
+
+def test_get_manifest_path():
+    assert (
+        TileManifest.get_manifest_path("/publish/v001/diffuse.$UDIM.exr")
+        == "/publish/v001/diffuse.manifest.exr.json"
+    )
+
+
+def test_write_and_read(tmp_path):
+    path = str(tmp_path / "diffuse.$UDIM.exr")
+    tiles = {
+        1001: {"file": "diffuse.1001.exr", "sha256": "a" * 64, "size": 10},
+        1002: {"file": "diffuse.1002.exr", "sha256": "b" * 64, "size": 20},
+    }
+    TileManifest(path, tiles).write()
+
+    manifest = TileManifest.read(path)
+    assert manifest.path == path
+    assert manifest.tiles == tiles
+    # nothing but the manifest is left behind:
+    assert os.listdir(str(tmp_path)) == ["diffuse.manifest.exr.json"]
+
+
+def test_write_to_another_directory(tmp_path):
+    path = str(tmp_path / "publish" / "diffuse.$UDIM.exr")
+    staging_dir = tmp_path / "staging"
+    staging_dir.mkdir()
+
+    TileManifest(path, {1001: {"file": "diffuse.1001.exr"}}).write(str(staging_dir))
+
+    assert os.listdir(str(staging_dir)) == ["diffuse.manifest.exr.json"]
+    with open(str(staging_dir / "diffuse.manifest.exr.json")) as f:
+        assert json.load(f)["path"] == path
+
+
+def test_write_applies_the_umask(tmp_path):
+    path = str(tmp_path / "diffuse.$UDIM.exr")
+    old_umask = os.umask(0o027)
+    try:
+        TileManifest(path).write()
+    finally:
+        os.umask(old_umask)
+
+    mode = stat.S_IMODE(os.stat(TileManifest.get_manifest_path(path)).st_mode)
+    assert mode == 0o640
+
+
+def test_read_missing_or_invalid_manifest(tmp_path):
+    path = str(tmp_path / "diffuse.$UDIM.exr")
+    assert TileManifest.read(path) is None
+
+    with open(TileManifest.get_manifest_path(path), "w") as f:
+        f.write("not json")
+    assert TileManifest.read(path) is None
+
+
+def test_read_manifest_from_a_newer_version(tmp_path):
+    path = str(tmp_path / "diffuse.$UDIM.exr")
+    with open(TileManifest.get_manifest_path(path), "w") as f:
+        json.dump({"version": TileManifest.VERSION + 1, "tiles": {}}, f)
+    assert TileManifest.read(path) is None
+
+
+def test_get_tile_path():
+    manifest = TileManifest(
+        os.path.join("publish", "diffuse.$UDIM.exr"),
+        {1001: {"file": "diffuse.1001.exr"}},
+    )
+    assert manifest.get_tile_path(1001) == os.path.join("publish", "diffuse.1001.exr")
+    assert manifest.get_tile_path(1002) is None
+
+
+def test_commit_staged_tiles(engine, tmp_path):
+    contents = {1001: b"tile 1001", 1002: b"tile 1002"}
+    export_path = _write_tiles(str(tmp_path / "export"), contents)
+    publish_path = str(tmp_path / "publish" / "v001" / "diffuse.$UDIM.exr")
+
+    manifest = commit_staged_tiles(export_path, publish_path)
+
+    assert sorted(os.listdir(str(tmp_path / "publish"))) == ["v001"]
+    assert sorted(os.listdir(str(tmp_path / "publish" / "v001"))) == [
+        "diffuse.1001.exr",
+        "diffuse.1002.exr",
+        "diffuse.manifest.exr.json",
+    ]
+    for udim, data in contents.items():
+        with open(manifest.get_tile_path(udim), "rb") as f:
+            assert f.read() == data
+        assert manifest.tiles[udim]["sha256"] == hashlib.sha256(data).hexdigest()
+        assert manifest.tiles[udim]["size"] == len(data)
+    assert TileManifest.read(publish_path).tiles == manifest.tiles
+
+
+def test_commit_staged_tiles_reuses_unchanged_tiles(engine, tmp_path):
+    previous_path = str(tmp_path / "publish" / "v001" / "diffuse.$UDIM.exr")
+    commit_staged_tiles(
+        _write_tiles(str(tmp_path / "export1"), {1001: b"same", 1002: b"old"}),
+        previous_path,
+    )
+
+    publish_path = str(tmp_path / "publish" / "v002" / "diffuse.$UDIM.exr")
+    manifest = commit_staged_tiles(
+        _write_tiles(str(tmp_path / "export2"), {1001: b"same", 1002: b"new"}),
+        publish_path,
+        previous_path=previous_path,
+    )
+
+    previous_manifest = TileManifest.read(previous_path)
+    assert os.path.samefile(
+        manifest.get_tile_path(1001), previous_manifest.get_tile_path(1001)
+    )
+    assert not os.path.samefile(
+        manifest.get_tile_path(1002), previous_manifest.get_tile_path(1002)
+    )
+    with open(manifest.get_tile_path(1002), "rb") as f:
+        assert f.read() == b"new"
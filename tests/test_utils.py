@@ -0,0 +1,123 @@
+# Copyright (c) 2014 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+import pytest
+from sgtk import TankError
+
+from tk_mari.publish_cache import get_publish_record_cache
+from tk_mari.utils import find_latest_publishes, find_publish_versions
+
+TYPE_FIELD = "published_file_type.PublishedFileType.code"
+PROJECT = {"type": "Project", "id": 1}
+ASSET = {"type": "Asset", "id": 10}
+TASK = {"type": "Task", "id": 100}
+
+
+def _publish(publish_id, name, version_number=1, entity=ASSET, task=TASK):
+    return {
+        "type": "PublishedFile",
+        "id": publish_id,
+        "project": PROJECT,
+        "entity": entity,
+        "task": task,
+        "name": name,
+        TYPE_FIELD: "Alembic Cache",
+        "version_number": version_number,
+    }
+
+
+def test_no_publishes(engine):
+    assert find_publish_versions([]) == {}
+    assert engine.shotgun.find_calls == []
+
+
+def test_versions_are_found_with_a_single_query(engine):
+    body_v1 = _publish(1, "body")
+    body_v2 = _publish(2, "body", version_number=2)
+    head_v1 = _publish(3, "head")
+    engine.shotgun.records = [body_v1, body_v2, head_v1]
+
+    assert find_publish_versions([body_v1, head_v1]) == {1: {1, 2}, 3: {3}}
+
+    assert len(engine.shotgun.find_calls) == 1
+    entity_type, filters, fields = engine.shotgun.find_calls[0]
+    assert entity_type == "PublishedFile"
+    assert set(fields) >= set(["project", "entity", "task", "name", TYPE_FIELD])
+
+    # one 'all' sub-filter per distinct publish, 'or'ed together:
+    assert len(filters) == 1 and filters[0]["filter_operator"] == "any"
+    sub_filters = filters[0]["filters"]
+    assert [f["filter_operator"] for f in sub_filters] == ["all", "all"]
+    assert sorted([c for c in f["filters"] if c[0] == "name"] for f in sub_filters) == [
+        [["name", "is", "body"]],
+        [["name", "is", "head"]],
+    ]
+
+
+def test_versions_of_the_same_publish_share_a_sub_filter(engine):
+    body_v1 = _publish(1, "body")
+    body_v2 = _publish(2, "body", version_number=2)
+    engine.shotgun.records = [body_v1, body_v2]
+
+    assert find_publish_versions([body_v1, body_v2]) == {1: {1, 2}, 2: {1, 2}}
+
+    _, filters, _ = engine.shotgun.find_calls[0]
+    assert len(filters[0]["filters"]) == 1
+
+
+def test_results_are_matched_on_entity_and_task(engine):
+    body = _publish(1, "body")
+    other_asset = _publish(2, "body", entity={"type": "Asset", "id": 11})
+    other_task = _publish(3, "body", task={"type": "Task", "id": 101})
+    no_task = _publish(4, "body", task=None)
+    engine.shotgun.records = [body, other_asset, other_task, no_task]
+
+    versions = find_publish_versions([body, no_task])
+
+    assert versions[1] == {1}
+    # a publish without a task matches versions with any task:
+    assert versions[4] == {1, 3, 4}
+    _, filters, _ = engine.shotgun.find_calls[0]
+    no_task_filter = [
+        f["filters"]
+        for f in filters[0]["filters"]
+        if not any(c[0] == "task" for c in f["filters"])
+    ]
+    assert len(no_task_filter) == 1
+
+
+def test_results_are_added_to_the_publish_record_cache(engine):
+    body = _publish(1, "body")
+    engine.shotgun.records = [body, _publish(2, "body", version_number=2)]
+
+    find_publish_versions([body], fields=["version_number"])
+
+    cached = get_publish_record_cache().get("PublishedFile", 2, ["version_number"])
+    assert cached["version_number"] == 2
+
+
+def test_query_errors_raise_tank_error(engine):
+    def find(*args):
+        raise RuntimeError("connection lost")
+
+    engine.shotgun.find = find
+    with pytest.raises(TankError):
+        find_publish_versions([_publish(1, "body")])
+
+
+def test_latest_publish_is_ranked_by_version_number(engine):
+    body_v1 = _publish(5, "body", version_number=1)
+    body_v3 = _publish(3, "body", version_number=3)
+    body_v2 = _publish(4, "body", version_number=2)
+    engine.shotgun.records = [body_v1, body_v3, body_v2]
+
+    latest = find_latest_publishes([body_v1])
+
+    assert latest[5]["id"] == 3